@@ -28,6 +28,7 @@ from oslo_log import log
 from os_vm_expire.api.controllers import versions
 from os_vm_expire.api import hooks
 from os_vm_expire.common import config
+from os_vm_expire.model import query_stats
 from os_vm_expire.model import repositories
 
 CONF = config.CONF
@@ -39,7 +40,7 @@ def build_wsgi_app(controller=None, transactional=False):
     :param controller: Overrides default application controller
     :param transactional: Adds transaction hook for all requests
     """
-    request_hooks = [hooks.JSONErrorHook()]
+    request_hooks = [hooks.JSONErrorHook(), hooks.MetricsHook()]
     if transactional:
         request_hooks.append(hooks.OSVmExpireTransactionHook())
 
@@ -67,6 +68,7 @@ def main_app(func):
         # starts ensures we don't lose requests due to lazy initialization of
         # db connections.
         repositories.setup_database_engine_and_factory()
+        query_stats.start_dump_thread()
 
         wsgi_app = func(global_config, **local_conf)
 
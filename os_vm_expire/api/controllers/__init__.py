@@ -10,6 +10,7 @@
 #  License for the specific language governing permissions and limitations
 #  under the License.
 import collections
+import functools
 
 from oslo_policy import policy
 import pecan
@@ -67,6 +68,7 @@ def enforce_rbac(action_name='default'):
     """Decorator handling RBAC enforcement on behalf of REST verb methods."""
 
     def rbac_decorator(fn):
+        @functools.wraps(fn)
         def enforcer(inst, *args, **kwargs):
             # Enforce RBAC rules.
 
@@ -90,6 +92,7 @@ def handle_exceptions(operation_name=u._('System')):
 
     def exceptions_decorator(fn):
 
+        @functools.wraps(fn)
         def handler(inst, *args, **kwargs):
             try:
                 return fn(inst, *args, **kwargs)
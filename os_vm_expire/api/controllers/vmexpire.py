@@ -11,11 +11,13 @@
 #  under the License.
 
 # from oslo_log import versionutils
+from oslo_utils import strutils
 import pecan
+import six
 # import time
 # import datetime
 
-# from os_vm_expire import api
+from os_vm_expire import api
 from os_vm_expire.api import controllers
 from os_vm_expire.common import hrefs
 from os_vm_expire.common import utils
@@ -31,12 +33,42 @@ CONF = config.CONF
 LOG = utils.getLogger(__name__)
 
 
+# Listing query parameters kept in navigation hrefs
+LIST_FILTERS = ('all_tenants', 'sort_key', 'sort_dir', 'expire_before',
+                'user_id', 'notified')
+
+
 def _vmexpire_not_found():
     """Throw exception indicating order not found."""
     pecan.abort(404, u._('Not Found. Sorry but your vm is in '
                          'another castle.'))
 
 
+def _load_bulk_ids(key):
+    """Get the ids of a bulk request body, None for the whole project.
+
+    Body is {key: [...]} or {"all_project": true}.
+    """
+    data = api.load_body(pecan.request)
+    ids = data.get(key)
+    all_project = data.get('all_project', False)
+    if not isinstance(all_project, bool):
+        pecan.abort(400, u._('all_project must be a boolean'))
+    if all_project == (ids is not None):
+        pecan.abort(400, u._('Either {0} or all_project '
+                             'must be given').format(key))
+    if all_project:
+        return None
+    valid = isinstance(ids, list) and ids and all(
+        isinstance(i, six.string_types) and i for i in ids)
+    if not valid:
+        pecan.abort(400, u._('{0} must be a list of ids').format(key))
+    if len(ids) > CONF.max_limit_paging:
+        pecan.abort(400, u._('Too many {0}, at most {1} allowed').format(
+            key, CONF.max_limit_paging))
+    return ids
+
+
 class VmExpireController(controllers.ACLMixin):
 
     """Handles Order retrieval and deletion requests."""
@@ -56,19 +88,7 @@ class VmExpireController(controllers.ACLMixin):
         # if null get all else get expiration for instance
         # ctxt = controllers._get_vmexpire_context(pecan.request)
         vm_repo = self.vmexpire_repo
-        instances = []
-        if instance_id is None:
-            all_tenants = pecan.request.GET.get('all_tenants')
-            if all_tenants is not None:
-                ctxt = controllers._get_vmexpire_context(pecan.request)
-                if ctxt.is_admin:
-                    instances = vm_repo.get_entities()
-                else:
-                    pecan.response.status = 403
-                    return "all_tenants is restricted to admin users"
-            else:
-                instances = vm_repo.get_project_entities(str(self.project_id))
-        else:
+        if instance_id is not None:
             instance = vm_repo.get(entity_id=str(instance_id))
             # url = hrefs.convert_vmexpire_to_href(instance.id)
             repo.commit()
@@ -76,16 +96,59 @@ class VmExpireController(controllers.ACLMixin):
                 'vmexpire': hrefs.convert_to_hrefs(instance.to_dict_fields())
                 }
 
-        total = len(instances)
+        params = pecan.request.GET
+        project_id = str(self.project_id)
+        if params.get('all_tenants') is not None:
+            ctxt = controllers._get_vmexpire_context(pecan.request)
+            if not ctxt.is_admin:
+                pecan.response.status = 403
+                return "all_tenants is restricted to admin users"
+            project_id = None
+
+        try:
+            expire_before = params.get('expire_before')
+            if expire_before is not None:
+                expire_before = float(expire_before)
+            notified = params.get('notified')
+            if notified is not None:
+                notified = strutils.bool_from_string(notified, strict=True)
+            instances, offset, limit, total = vm_repo.get_vmexpire_list(
+                project_id=project_id,
+                offset_arg=params.get('offset'),
+                limit_arg=params.get('limit'),
+                marker=params.get('marker'),
+                sort_key=params.get('sort_key'),
+                sort_dir=params.get('sort_dir'),
+                expire_before=expire_before,
+                user_id=params.get('user_id'),
+                notified=notified
+            )
+        except ValueError as e:
+            repo.rollback()
+            pecan.abort(400, str(e))
+
         instances_resp = [
             hrefs.convert_to_hrefs(o.to_dict_fields())
             for o in instances
         ]
-        instances_resp_overall = hrefs.add_nav_hrefs(
-            'vmexpires',
-            0, total, total,
-            {'vmexpires': instances_resp}
-            )
+        filters = dict((k, params[k]) for k in LIST_FILTERS if k in params)
+        resources_name = self.project_id + '/vmexpires'
+        if params.get('marker'):
+            marker = instances[-1].id if instances else None
+            instances_resp_overall = hrefs.add_marker_nav_hrefs(
+                resources_name,
+                marker, limit, len(instances),
+                {'vmexpires': instances_resp},
+                params=filters
+                )
+        else:
+            # without limit, the list goes up to the last element
+            instances_resp_overall = hrefs.add_nav_hrefs(
+                resources_name,
+                offset, limit or total, total,
+                {'vmexpires': instances_resp},
+                params=filters
+                )
         instances_resp_overall = hrefs.add_self_href(self.project_id + '/vmexpires/', instances_resp_overall)
         instances_resp_overall.update({'total': total})
         repo.commit()
@@ -95,7 +158,9 @@ class VmExpireController(controllers.ACLMixin):
     @controllers.handle_exceptions(u._('VmExpire add'))
     @controllers.enforce_rbac('vmexpire:add')
     @controllers.enforce_content_types(['application/json'])
-    def on_post(self, meta, instance_id):
+    def on_post(self, meta, instance_id=None):
+        if instance_id is None:
+            return self._add_all()
         instance = None
         try:
             instance = self.vmexpire_repo.add_vm(instance_id)
@@ -109,11 +174,32 @@ class VmExpireController(controllers.ACLMixin):
             'vmexpire': hrefs.convert_to_hrefs(instance.to_dict_fields())
         }
 
+    def _add_all(self):
+        """Add several instances of the project.
+
+        Body is {"instance_ids": [...]} or {"all_project": true}.
+        """
+        instance_ids = _load_bulk_ids('instance_ids')
+        try:
+            results = self.vmexpire_repo.add_vms(
+                instance_uuids=instance_ids,
+                project_id=self.project_id
+            )
+        except Exception as e:
+            repo.rollback()
+            pecan.response.status = 403
+            return str(e)
+        repo.commit()
+        pecan.response.status = 202
+        return {'vmexpires': results}
+
     @index.when(method='PUT', template='json')
     @controllers.handle_exceptions(u._('VmExpire extend'))
     @controllers.enforce_rbac('vmexpire:extend')
     @controllers.enforce_content_types(['application/json'])
-    def on_put(self, meta, instance_id):
+    def on_put(self, meta, instance_id=None):
+        if instance_id is None:
+            return self._extend_all()
         instance = None
         try:
             instance = self.vmexpire_repo.extend_vm(entity_id=instance_id)
@@ -127,6 +213,25 @@ class VmExpireController(controllers.ACLMixin):
             'vmexpire': hrefs.convert_to_hrefs(instance.to_dict_fields())
         }
 
+    def _extend_all(self):
+        """Extend several expirations of the project.
+
+        Body is {"ids": [...]} or {"all_project": true}.
+        """
+        entity_ids = _load_bulk_ids('ids')
+        try:
+            result = self.vmexpire_repo.extend_vms(
+                project_id=self.project_id,
+                entity_ids=entity_ids
+            )
+        except Exception as e:
+            repo.rollback()
+            pecan.response.status = 403
+            return str(e)
+        repo.commit()
+        pecan.response.status = 202
+        return result
+
     @index.when(method='DELETE', template='json')
     @controllers.handle_exceptions(u._('VmExpire expiration deletion'))
     @controllers.enforce_rbac('vmexpire:delete')
@@ -12,11 +12,14 @@
 # implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import time
+
 import pecan
 import webob
 
 from oslo_serialization import jsonutils
 
+from os_vm_expire.common import metrics
 from os_vm_expire.model import repositories
 
 
@@ -32,6 +35,38 @@ class JSONErrorHook(pecan.hooks.PecanHook):
             return exc.body
 
 
+def _get_handler_name(handler):
+    """Get the Class.method name of a routed controller handler."""
+    # generic handlers are routed as functions, named Class.method
+    name = getattr(handler, '__qualname__', None)
+    if name is None:
+        # python 2 has no qualified names, only methods know their class
+        name = getattr(handler, '__name__', 'unknown')
+        owner = getattr(handler, 'im_class', None)
+        if owner is not None:
+            name = '%s.%s' % (owner.__name__, name)
+    return name
+
+
+class MetricsHook(pecan.hooks.PecanHook):
+    """Observes the duration of requests per controller method."""
+
+    def on_route(self, state):
+        state.request.environ['os_vm_expire.start'] = time.time()
+
+    def after(self, state):
+        start = state.request.environ.get('os_vm_expire.start')
+        if start is None:
+            return
+        controller, _, method = _get_handler_name(
+            getattr(state, 'controller', None)).rpartition('.')
+        metrics.API_REQUEST_SECONDS.observe(
+            time.time() - start,
+            controller=controller or 'unknown',
+            method=method,
+            status=state.response.status_int)
+
+
 class OSVmExpireTransactionHook(pecan.hooks.TransactionHook):
     """Custom hook for Barbican transactions."""
     def __init__(self):
@@ -0,0 +1,30 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import webob
+
+from os_vm_expire.api import middleware as mw
+from os_vm_expire.common import metrics
+
+
+class MetricsMiddleware(mw.Middleware):
+    """Serves the metrics of the API process at /metrics.
+
+    Should come first in the pipeline, metrics are not authenticated.
+    """
+
+    def process_request(self, req):
+        if req.method != 'GET' or req.path_info.rstrip('/') != '/metrics':
+            return None
+        resp = webob.Response(body=metrics.render())
+        resp.headers['Content-Type'] = metrics.CONTENT_TYPE
+        return resp
@@ -14,27 +14,33 @@
 """
 Osvmexpire worker server.
 """
+import collections
 import datetime
 from email.mime.text import MIMEText
 import eventlet
+import heapq
+import itertools
 import os
-import smtplib
 import sys
+import threading
 import time
 
 
 from os_vm_expire.common import config
+from os_vm_expire.common import keystone
+from os_vm_expire.common import mail
+from os_vm_expire.common import metrics
 from os_vm_expire.common import utils
+from os_vm_expire.model import models
+from os_vm_expire.model import plan
+from os_vm_expire.model import query_stats
 from os_vm_expire.model import repositories
 from os_vm_expire import version
 
+from oslo_config import cfg
 from oslo_log import log
 from oslo_service import service
 
-# import futurist
-from futurist import periodics
-import requests
-
 # Oslo messaging RPC server uses eventlet.
 eventlet.monkey_patch()
 
@@ -57,8 +63,8 @@ def fail(returncode, e):
     sys.exit(returncode)
 
 
-def delete_vm(instance_id, project_id, token):
-    '''Delete a VM on expiration
+def _get_server_url(instance_id, project_id):
+    '''Get the nova url of a VM
 
     conf in [cleaner]
     nova_url = http://controller.genouest.org:8774/v2.1/%(tenant_id)s
@@ -68,14 +74,24 @@ def delete_vm(instance_id, project_id, token):
         'project_id': project_id
         }
     LOG.debug('Nova URI:' + nova_url)
-    headers = {
-        'X-Auth-Token': token,
-        'Content-Type': 'application/json',
-        'Accept': 'application/json'
-    }
-    r = requests.delete(nova_url + '/servers/' + instance_id, headers=headers)
+    return nova_url + '/servers/' + instance_id
+
+
+def delete_vm(instance_id, project_id, token):
+    '''Delete a VM on expiration'''
+    r = keystone.request('delete', _get_server_url(instance_id, project_id),
+                         'cleaner', token=token, headers=keystone.JSON_HEADERS,
+                         service='nova')
+    return _check_deleted(r, instance_id, project_id)
+
+
+def _check_deleted(r, instance_id, project_id):
+    """Check the nova response to a VM deletion, a missing VM is deleted."""
+    if r is None:
+        LOG.error('DELETE:Error:No token to delete instance %s' % instance_id)
+        return False
     if r.status_code == 404:
-        LOG.info('DELETE:VmNotFound:' + str(instance_id) + ':' + str(project_id))
+        LOG.info('DELETE:VmNotFound:%s:%s' % (instance_id, project_id))
         return True
     if r.status_code != 204:
         LOG.error('DELETE:Error:Failed to delete instance ' + str(instance_id))
@@ -86,235 +102,725 @@ def delete_vm(instance_id, project_id, token):
 
 
 def get_identity_token():
-    conf_cleaner = config.CONF.cleaner
-    ks_uri = conf_cleaner.auth_uri
-
-    auth = {
-        'auth': {
-            'scope':
-                {'project': {
-                    'name': conf_cleaner.admin_service,
-                    'domain':
-                        {
-                            'name': conf_cleaner.admin_project_domain_name
-                        }
-                    }
-                 },
-            'identity': {
-                    'password': {
-                        'user': {
-                            'domain': {
-                                'name': conf_cleaner.admin_user_domain_name
-                            },
-                            'password': conf_cleaner.admin_password,
-                            'name': conf_cleaner.admin_user
-                        }
-                    },
-                    'methods': ['password']
-                }
-        }
-    }
-    r = requests.post(ks_uri + '/auth/tokens', json=auth)
-    if 'X-Subject-Token' not in r.headers:
-        LOG.error('Could not get authorization')
-        return None
-    token = r.headers['X-Subject-Token']
-    return token
+    return keystone.get_token('cleaner')
 
 
 def get_project_name(project_id, token):
     LOG.debug("Get project name")
-    # fetch user from identity to get user email
-    headers = {
-        'X-Auth-Token': token,
-        'Content-Type': 'application/json',
-        'Accept': 'application/json'
-    }
-    ks_uri = config.CONF.cleaner.auth_uri
     try:
-        r = requests.get(ks_uri + '/projects/' + project_id, headers=headers)
+        project = keystone.get_project(project_id, 'cleaner', token=token)
     except Exception:
         LOG.exception('Failed to get project name for id ' + str(project_id))
         return None
-    if r.status_code != 200:
-        return None
-    project = r.json()
-    if 'project' in project:
-        return project['project']['name']
+    if project:
+        return project['name']
     return None
 
 
-def send_email(instance, token, delete=False):
-    LOG.debug("Send expiration notification mail")
-    # fetch user from identity to get user email
-    headers = {
-        'X-Auth-Token': token,
-        'Content-Type': 'application/json',
-        'Accept': 'application/json'
-    }
-    ks_uri = config.CONF.cleaner.auth_uri
-    r = requests.get(ks_uri + '/users/' + instance.user_id, headers=headers)
-    if r.status_code != 200:
-        return False
-    user = r.json()
-    email = None
-    if 'user' in user and 'email' in user['user']:
-        email = user['user']['email']
-    if email is None:
-        LOG.error('Could not get email for user ' + instance.user_id)
-        return False
-    # send email
-    to = [email]
-    if (not delete) and config.CONF.smtp.email_smtp_copy_expire_notif_to is not None:
-        to = [email, config.CONF.smtp.email_smtp_copy_delete_notif_to]
-    if delete and config.CONF.smtp.email_smtp_copy_delete_notif_to is not None:
-        to = [email, config.CONF.smtp.email_smtp_copy_delete_notif_to]
+def _get_email(user_id, token):
+    """Get the email of a user from identity."""
+    return _get_user_email(keystone.get_user(user_id, 'cleaner', token=token),
+                           user_id)
 
-    project_name = get_project_name(instance.project_id, token)
 
-    if project_name is None:
-        project_name = instance.project_id
+def _get_user_email(user, user_id):
+    if user is None:
+        return None
+    email = user.get('email')
+    if email is None:
+        LOG.error('Could not get email for user ' + user_id)
+    return email
 
-    LOG.info("Send expiration message for instance %s" % (instance.instance_id))
 
-    subject = '[openstack] VM %s [project: %s] expiration' % (
-        instance.instance_name,
-        project_name
-    )
+def _get_recipients(email, expire=True, delete=False):
+    """Get message recipients with the configured copies."""
+    conf_smtp = config.CONF.smtp
+    to = [email]
+    if expire and conf_smtp.email_smtp_copy_expire_notif_to is not None:
+        to.append(conf_smtp.email_smtp_copy_expire_notif_to)
+    if delete and conf_smtp.email_smtp_copy_delete_notif_to is not None:
+        to.append(conf_smtp.email_smtp_copy_delete_notif_to)
+    return to
 
-    message = ('VM %s (id: %s, project: %s) will expire at %s,' +
-               'connect to openstack dashboard in vmexpires section to extend its duration else ' +
-               ' it will be deleted.') % (
-        instance.instance_name,
-        instance.instance_id,
-        instance.project_id,
-        str(datetime.datetime.fromtimestamp(instance.expire))
-        )
+
+def _get_message(instance, delete=False):
     if delete:
-        message = ('VM %s (id: %s, project: %s) has expired at %s' +
-                   ' and has been deleted.') % (
+        return ('VM %s (id: %s, project: %s) has expired at %s'
+                ' and has been deleted.') % (
             instance.instance_name,
             instance.instance_id,
             instance.project_id,
             str(datetime.datetime.fromtimestamp(instance.expire))
             )
-    LOG.info('NOTIF %s: %s' % (instance.id, message))
-    # Create a text/plain message
+    return ('VM %s (id: %s, project: %s) will expire at %s,'
+            'connect to openstack dashboard in vmexpires section to extend '
+            'its duration else '
+            ' it will be deleted.') % (
+        instance.instance_name,
+        instance.instance_id,
+        instance.project_id,
+        str(datetime.datetime.fromtimestamp(instance.expire))
+        )
+
+
+def _get_mime(to, subject, message):
+    """Create a text/plain message, None if no sender is configured."""
     msg = MIMEText(message, 'plain', 'utf-8')
 
     msg['Subject'] = subject
     msg['From'] = config.CONF.smtp.email_smtp_from
     if msg['From'] is None:
         LOG.error('Missing smtp.email_smtp_from in config')
-        return False
+        return None
     msg['To'] = ', '.join(to)
+    return msg
+
+
+def _send(to, subject, message, smtp_pool=None):
+    msg = _get_mime(to, subject, message)
+    if msg is None:
+        return False
 
     # Send the message via our own SMTP server, but don't include the
     # envelope header.
     try:
-        s = smtplib.SMTP(config.CONF.smtp.email_smtp_host,
-                         config.CONF.smtp.email_smtp_port)
-        if config.CONF.smtp.email_smtp_tls:
-            s.starttls()
-        if config.CONF.smtp.email_smtp_user:
-            s.login(config.CONF.smtp.email_smtp_user,
-                    config.CONF.smtp.email_smtp_password)
-        s.sendmail(msg['From'], to, msg.as_string())
-        s.quit()
+        mail.sendmail(msg['From'], to, msg.as_string(), pool=smtp_pool)
     except Exception:
-        LOG.error('Failed to send expiration notification mail to ' + email)
+        LOG.error('Failed to send expiration notification mail to ' + to[0])
         return False
 
     return True
 
 
-# Every hour
-@periodics.periodic(3600)
+def send_email(instance, token, delete=False, smtp_pool=None):
+    LOG.debug("Send expiration notification mail")
+    # fetch user from identity to get user email
+    email = _get_email(instance.user_id, token)
+    if email is None:
+        return False
+    project_name = get_project_name(instance.project_id, token)
+    to, subject, message = _get_notification(instance, email, project_name,
+                                             delete)
+    return _send(to, subject, message, smtp_pool=smtp_pool)
+
+
+def _get_notification(instance, email, project_name, delete=False):
+    """Get recipients, subject and text of the mail about a VM."""
+    to = _get_recipients(email, expire=not delete, delete=delete)
+
+    if project_name is None:
+        project_name = instance.project_id
+
+    LOG.info("Send expiration message for instance %s" % (
+        instance.instance_id))
+
+    subject = '[openstack] VM %s [project: %s] expiration' % (
+        instance.instance_name,
+        project_name
+    )
+
+    message = _get_message(instance, delete=delete)
+    LOG.info('NOTIF %s: %s' % (instance.id, message))
+    return to, subject, message
+
+
+def _get_digest_line(instance):
+    return 'VM %s (id: %s, project: %s), expiration date %s' % (
+        instance.instance_name,
+        instance.instance_id,
+        instance.project_id,
+        str(datetime.datetime.fromtimestamp(instance.expire))
+    )
+
+
+def send_digest(user_id, notices, token, smtp_pool=None):
+    """Send a single mail listing all the expiration notices of a user.
+
+    :param user_id: id of the user owning the VMs
+    :param notices: list of (task, action) for the VMs of the user
+    :returns: True if mail was sent
+    """
+    LOG.debug("Send expiration digest mail to user %s" % (user_id))
+    email = _get_email(user_id, token)
+    if email is None:
+        return False
+    project_names = {}
+    for task, _ in notices:
+        if task.project_id not in project_names:
+            project_names[task.project_id] = (
+                get_project_name(task.project_id, token) or task.project_id)
+    to, subject, message = _get_digest(user_id, notices, email, project_names)
+    return _send(to, subject, message, smtp_pool=smtp_pool)
+
+
+def _get_digest(user_id, notices, email, project_names):
+    """Get recipients, subject and text of a digest mail."""
+    deleted = [task for (task, action) in notices if action == DELETE]
+    expiring = [task for (task, action) in notices if action != DELETE]
+    to = _get_recipients(email, expire=bool(expiring), delete=bool(deleted))
+
+    subject = '[openstack] %d VM(s) expiration [project: %s]' % (
+        len(notices),
+        ', '.join(sorted(project_names.values()))
+    )
+    lines = []
+    if expiring:
+        lines.append('The following VMs will expire, connect to openstack '
+                     'dashboard in vmexpires section to extend their '
+                     'duration else they will be deleted:')
+        lines.extend(' - %s' % _get_digest_line(task) for task in expiring)
+    if deleted:
+        if lines:
+            lines.append('')
+        lines.append('The following VMs have expired and have been '
+                     'deleted:')
+        lines.extend(' - %s' % _get_digest_line(task) for task in deleted)
+    message = '\n'.join(lines)
+    LOG.info('NOTIF DIGEST %s: %d VMs' % (user_id, len(notices)))
+    return to, subject, message
+
+
+# Actions a cleaner pass can take on an expiring VM
+NOTIFY_FIRST = plan.NOTIFY_FIRST
+NOTIFY_LAST = plan.NOTIFY_LAST
+DELETE = plan.DELETE
+# Outbox only: mail sent once a VM is deleted
+DELETION_NOTICE = 'deletion_notice'
+
+# Snapshot of a VmExpire row handed over to green threads: they must not
+# touch ORM objects attached to the cleaner session.
+ExpireTask = collections.namedtuple(
+    'ExpireTask',
+    ['id', 'instance_id', 'instance_name', 'project_id', 'user_id', 'expire']
+)
+
+# Snapshot of a VmExpireOutbox row
+OutboxEntry = collections.namedtuple(
+    'OutboxEntry', ['id', 'action', 'attempts', 'task']
+)
+
+
+def get_shard():
+    """Get the (shard_index, shard_count) of this cleaner.
+
+    :returns: None if there is a single cleaner
+    """
+    conf_cleaner = config.CONF.cleaner
+    if conf_cleaner.shard_count <= 1:
+        return None
+    return (conf_cleaner.shard_index, conf_cleaner.shard_count)
+
+
+def in_shard(instance_id):
+    """Check if this cleaner handles an instance.
+
+    Instances are spread over [cleaner] shard_count cleaners with a stable
+    hash of their id, identical on all nodes and stored in database so
+    that queries only read the rows of their shard.
+    """
+    shard = get_shard()
+    if shard is None:
+        return True
+    return models.get_shard_hash(instance_id) % shard[1] == shard[0]
+
+
+def _get_task(entity):
+    return ExpireTask(
+        entity.id,
+        entity.instance_id,
+        entity.instance_name,
+        entity.project_id,
+        entity.user_id,
+        entity.expire
+    )
+
+
+def _get_stage_tasks(repo, now, check_time, last_check_time):
+    """Get the VMs needing an action, stage by stage.
+
+    Each stage is a query on the notification state so that only rows
+    needing work are read. Stages go from deletion to first notice so
+    that a VM gets at most one action per pass.
+    :returns: list of (task, action)
+    """
+    conf_cleaner = config.CONF.cleaner
+    mintime = (conf_cleaner.notify_before_days * 3600 * 24)
+    # backward compat, if notif time not set and notif already sent, set to
+    # now()
+    if repo.set_missing_notified_time(now):
+        repositories.commit()
+    shard = get_shard()
+    stages = [
+        (DELETE, repo.get_deletion_entities(now, now - mintime, shard=shard)),
+        (NOTIFY_LAST, repo.get_last_notice_entities(last_check_time,
+                                                    shard=shard)),
+        (NOTIFY_FIRST, repo.get_first_notice_entities(check_time,
+                                                      shard=shard)),
+    ]
+    tasks = []
+    for action, entities in stages:
+        count = len(tasks)
+        tasks.extend((_get_task(entity), action) for entity in entities)
+        metrics.CLEANER_ROWS.inc(len(tasks) - count, stage=action)
+        LOG.debug("%d VMs to %s" % (len(tasks) - count, action))
+    return tasks
+
+
+def _run_action(task, action, token, smtp_pool=None):
+    """Execute the remote part of an action (mail or nova deletion).
+
+    Runs in a green thread, returns True on success.
+    """
+    try:
+        if action == DELETE:
+            return delete_vm(task.instance_id, task.project_id, token)
+        return send_email(task, token, delete=False, smtp_pool=smtp_pool)
+    except Exception as e:
+        LOG.exception("expiration handling error: " + str(e))
+        return False
+
+
+def _apply_action(repo, task, action, now):
+    """Record the result of a successful action in database."""
+    try:
+        if action == NOTIFY_FIRST:
+            repo.set_notified(task.id, notified_time=now)
+        elif action == NOTIFY_LAST:
+            repo.set_notified(task.id, last=True)
+        elif action == DELETE:
+            repo.delete_entity_by_id(entity_id=task.id)
+        repositories.commit()
+    except Exception as e:
+        LOG.exception("expiration %s error: %s" % (action, str(e)))
+        repositories.rollback()
+
+
+def _apply_digest(repo, notices, now):
+    """Record all the notices of a sent digest in a single transaction."""
+    first = [task.id for (task, action) in notices if action == NOTIFY_FIRST]
+    last = [task.id for (task, action) in notices if action == NOTIFY_LAST]
+    try:
+        if first:
+            repo.set_notified_all(first, notified_time=now)
+        if last:
+            repo.set_notified_all(last, last=True)
+        repositories.commit()
+    except Exception as e:
+        LOG.exception("expiration digest error: " + str(e))
+        repositories.rollback()
+
+
+def _process_actions(repo, actions, token, now, pool, smtp_pool):
+    """Send one mail per VM and record the results."""
+    results = pool.imap(
+        _run_action,
+        [task for (task, _) in actions],
+        [action for (_, action) in actions],
+        itertools.repeat(token),
+        itertools.repeat(smtp_pool)
+    )
+    for (task, action), res in zip(actions, results):
+        if not res:
+            continue
+        _apply_action(repo, task, action, now)
+        if action == DELETE:
+            pool.spawn_n(send_email, task, token, True, smtp_pool)
+
+
+def _process_digest(repo, actions, token, now, pool, smtp_pool):
+    """Delete expired VMs, then send one mail per user for all notices."""
+    deletions = [(task, action) for (task, action) in actions
+                 if action == DELETE]
+    results = pool.imap(
+        _run_action,
+        [task for (task, _) in deletions],
+        [action for (_, action) in deletions],
+        itertools.repeat(token)
+    )
+    notices = collections.OrderedDict()
+    for (task, action), res in zip(deletions, results):
+        if not res:
+            continue
+        _apply_action(repo, task, action, now)
+        notices.setdefault(task.user_id, []).append((task, action))
+    for task, action in actions:
+        if action != DELETE:
+            notices.setdefault(task.user_id, []).append((task, action))
+
+    results = pool.imap(
+        send_digest,
+        list(notices.keys()),
+        list(notices.values()),
+        itertools.repeat(token),
+        itertools.repeat(smtp_pool)
+    )
+    for user_notices, res in zip(notices.values(), results):
+        if res:
+            _apply_digest(repo, user_notices, now)
+
+
+def _get_outbox_values(task):
+    return {
+        'vmexpire_id': task.id,
+        'instance_id': task.instance_id,
+        'instance_name': task.instance_name,
+        'project_id': task.project_id,
+        'user_id': task.user_id,
+        'expire': task.expire
+    }
+
+
+def _get_entry(entity):
+    return OutboxEntry(
+        entity.id,
+        entity.action,
+        entity.attempts,
+        ExpireTask(
+            entity.vmexpire_id,
+            entity.instance_id,
+            entity.instance_name,
+            entity.project_id,
+            entity.user_id,
+            entity.expire
+        )
+    )
+
+
+def enqueue(outbox_repo, actions, now):
+    """Queue the actions of a pass in the outbox.
+
+    Actions already queued, identified by their idempotency key, are
+    skipped so that a VM waiting for a retry is not queued twice.
+    """
+    try:
+        queued = outbox_repo.enqueue_all(
+            [(action, _get_outbox_values(task)) for (task, action) in actions],
+            now)
+        repositories.commit()
+    except Exception as e:
+        LOG.exception("outbox enqueue error: " + str(e))
+        repositories.rollback()
+        return 0
+    LOG.debug("%d actions queued in outbox" % queued)
+    return queued
+
+
+def _run_entry(entry, token, smtp_pool=None):
+    """Execute an outbox action in a green thread.
+
+    :returns: None on success, else the error
+    """
+    try:
+        if entry.action == DELETE:
+            res = delete_vm(entry.task.instance_id, entry.task.project_id,
+                            token)
+        else:
+            res = send_email(entry.task, token,
+                             delete=entry.action == DELETION_NOTICE,
+                             smtp_pool=smtp_pool)
+    except Exception as e:
+        LOG.exception("outbox %s error: %s" % (entry.action, str(e)))
+        return str(e)
+    return None if res else '%s failed' % entry.action
+
+
+def _apply_entry(repo, outbox_repo, entry, error, now):
+    """Record the result of an outbox action in a single transaction."""
+    task = entry.task
+    try:
+        if error:
+            next_attempt = outbox_repo.retry_later(entry.id, entry.attempts,
+                                                   now, error)
+            LOG.warning("outbox %s of %s failed %d times, next attempt at "
+                        "%s" % (entry.action, task.instance_id,
+                                entry.attempts + 1,
+                                datetime.datetime.fromtimestamp(
+                                    next_attempt)))
+        else:
+            if entry.action == NOTIFY_FIRST:
+                repo.set_notified(task.id, notified_time=now)
+            elif entry.action == NOTIFY_LAST:
+                repo.set_notified(task.id, last=True)
+            elif entry.action == DELETE:
+                repo.delete_by_instance_id(task.instance_id)
+                outbox_repo.enqueue_all(
+                    [(DELETION_NOTICE, _get_outbox_values(task))], now)
+            outbox_repo.complete(entry.id)
+        repositories.commit()
+    except Exception as e:
+        LOG.exception("outbox %s error: %s" % (entry.action, str(e)))
+        repositories.rollback()
+
+
+def _drop_stale(repo, outbox_repo, entries):
+    """Drop the queued actions of VMs extended or removed meanwhile."""
+    expires = repo.get_expires([entry.task.id for entry in entries
+                                if entry.action != DELETION_NOTICE])
+    valid = []
+    for entry in entries:
+        stale = expires.get(entry.task.id) != entry.task.expire
+        if entry.action != DELETION_NOTICE and stale:
+            LOG.debug("outbox %s of %s is stale, dropped" % (
+                entry.action, entry.task.instance_id))
+            outbox_repo.complete(entry.id)
+        else:
+            valid.append(entry)
+    repositories.commit()
+    return valid
+
+
+def drain(repo, outbox_repo, token, now, pool, smtp_pool):
+    """Execute the outbox actions due now.
+
+    Deletions run first, each followed in the same transaction by the
+    removal of the expiration and the queuing of a deletion notice. Failed
+    actions are retried later with exponential backoff.
+    :returns: number of attempted actions
+    """
+    try:
+        entries = [_get_entry(entity) for entity in
+                   outbox_repo.get_ready(now, shard=get_shard())]
+        entries = _drop_stale(repo, outbox_repo, entries)
+    except Exception as e:
+        LOG.exception("outbox query error: " + str(e))
+        repositories.rollback()
+        return 0
+    deletions = [entry for entry in entries if entry.action == DELETE]
+    results = pool.imap(_run_entry, deletions, itertools.repeat(token))
+    for entry, error in zip(deletions, results):
+        _apply_entry(repo, outbox_repo, entry, error, now)
+
+    # deletion notices of the VMs just deleted
+    notices = [entry for entry in entries if entry.action != DELETE]
+    if deletions:
+        queued = set(entry.id for entry in notices)
+        notices.extend(
+            _get_entry(entity) for entity in
+            outbox_repo.get_ready(now, shard=get_shard())
+            if entity.action == DELETION_NOTICE and entity.id not in queued)
+        repositories.commit()
+    if config.CONF.cleaner.email_digest:
+        by_user = collections.OrderedDict()
+        for entry in notices:
+            by_user.setdefault(entry.task.user_id, []).append(entry)
+        results = pool.imap(
+            send_digest,
+            list(by_user.keys()),
+            [[(entry.task,
+               DELETE if entry.action == DELETION_NOTICE else entry.action)
+              for entry in user_entries]
+             for user_entries in by_user.values()],
+            itertools.repeat(token),
+            itertools.repeat(smtp_pool)
+        )
+        for user_entries, res in zip(by_user.values(), results):
+            for entry in user_entries:
+                _apply_entry(repo, outbox_repo, entry,
+                             None if res else 'digest failed', now)
+    else:
+        results = pool.imap(_run_entry, notices, itertools.repeat(token),
+                            itertools.repeat(smtp_pool))
+        for entry, error in zip(notices, results):
+            _apply_entry(repo, outbox_repo, entry, error, now)
+    return len(deletions) + len(notices)
+
+
+def _asyncio_available():
+    """Check the asyncio engine can run, its modules need Python 3.7."""
+    if sys.version_info < (3, 7):
+        return False
+    from os_vm_expire.common import aio
+    return aio.is_available()
+
+
+def _get_pool(conf_cleaner):
+    """Get the pool running the remote calls of a pass and its SMTP pool."""
+    smtp_pool_size = min(conf_cleaner.workers,
+                         config.CONF.smtp.email_smtp_pool_size)
+    if conf_cleaner.engine == 'asyncio':
+        from os_vm_expire.cmd import cleaner_aio
+        return cleaner_aio.get_pool(conf_cleaner.workers, smtp_pool_size), None
+    # Mails share a few SMTP connections instead of one per message
+    return (eventlet.GreenPool(conf_cleaner.workers),
+            mail.SMTPPool(smtp_pool_size))
+
+
 def check(started_at):
+    start = time.time()
     token = get_identity_token()
     conf_cleaner = config.CONF.cleaner
     LOG.debug("check instances")
     repo = repositories.get_vmexpire_repository()
     now = int(time.mktime(datetime.datetime.now().timetuple()))
-    check_time = now + (conf_cleaner.notify_before_days * 3600 * 24)
-    last_check_time = now + (conf_cleaner.notify_before_days_last * 3600 * 24)
-    entities = repo.get_entities(expiration_filter=check_time)
-    for entity in entities:
+    check_time, last_check_time = plan.get_check_times(now)
+    try:
+        actions = _get_stage_tasks(repo, now, check_time, last_check_time)
+    except Exception as e:
+        LOG.exception("expiration query error: " + str(e))
+        repositories.rollback()
+        return
+
+    # Mails and nova deletions are sent concurrently, results are consumed
+    # in order by this thread which is the only one writing to database.
+    pool, smtp_pool = _get_pool(conf_cleaner)
+    if conf_cleaner.outbox:
+        outbox_repo = repositories.get_outbox_repository()
+        enqueue(outbox_repo, actions, now)
+        drain(repo, outbox_repo, token, now, pool, smtp_pool)
+    elif conf_cleaner.email_digest:
+        _process_digest(repo, actions, token, now, pool, smtp_pool)
+    else:
+        _process_actions(repo, actions, token, now, pool, smtp_pool)
+    if smtp_pool is None:
+        pool.close()
+    else:
+        pool.waitall()
+        smtp_pool.close()
+        smtp_pool.log_stats()
+    keystone.log_cache_stats()
+    metrics.CLEANER_PASS_SECONDS.observe(time.time() - start)
+    LOG.debug("check done, %d actions in %.2fs" % (len(actions),
+                                                   time.time() - start))
+
+
+class Scheduler(object):
+    """Runs cleaner passes when notifications or deletions are due.
+
+    A min-heap holds the due timestamps (first notice, last notice,
+    deletion) of the VMs due before the next refresh. Passes run when the
+    earliest one is reached, with at least min_check_interval and at most
+    check_interval seconds between two passes. Due times are reloaded
+    after each pass and every scheduler_refresh_interval seconds, to see
+    the VMs added or extended by the API and the worker. Actions still due
+    after a pass, because they failed, only wake up the check_interval
+    passes.
+    """
+
+    def __init__(self, repo, started_at=None):
+        self.repo = repo
+        self.started_at = started_at
+        self.heap = []
+        self.last_run = None
+        self.next_refresh = 0
+
+    def refresh(self, now):
+        conf_cleaner = config.CONF.cleaner
         try:
-            if entity.expire < check_time and not entity.notified:
-                # notify
-                LOG.debug("First expiration notification %s" % (entity.id))
-                res = send_email(entity, token, delete=False)
-                if res:
-                    entity.notified = True
-                    entity.notified_time = now
-                    try:
-                        entity.save()
-                        repositories.commit()
-                    except Exception as e:
-                        LOG.exception("expiration save error: " + str(e))
-                        repositories.rollback()
-            elif entity.expire < last_check_time and not entity.notified_last:
-                # notify_last
-                LOG.debug("Last expiration notification %s" % (entity.id))
-                res = send_email(entity, token, delete=False)
-                if res:
-                    entity.notified_last = True
-                    try:
-                        entity.save()
-                        repositories.commit()
-                    except Exception as e:
-                        LOG.exception("expiration save error: " + str(e))
-                        repositories.rollback()
-            elif entity.expire < now and entity.notified_last:  # expired and last notification send at least notify_before_days days before
-                mintime = (conf_cleaner.notify_before_days * 3600 * 24)
-                if not entity.notified_time and entity.notified:
-                    # backward compat, if notif time not set and notif already sent, set to now()
-                    entity.notified_time = now
-                    try:
-                        entity.save()
-                        repositories.commit()
-                    except Exception as e:
-                        LOG.exception("expiration save error: " + str(e))
-                        repositories.rollback()
-                if (now - entity.notified_time) < mintime:
-                    LOG.debug("Last expiration notification %s sent before %d days" % (entity.id, mintime))
-                    continue
-                # delete
-                LOG.debug("Delete VM %s" % (entity.id))
-                res = delete_vm(entity.instance_id, entity.project_id, token)
-                if res:
-                    try:
-                        repo.delete_entity_by_id(entity_id=entity.id)
-                        repositories.commit()
-                    except Exception as e:
-                        LOG.exception("expiration deletion error: " + str(e))
-                        repositories.rollback()
-                    send_email(entity, token, delete=True)
+            self.heap = self.repo.get_due_times(
+                now + conf_cleaner.scheduler_refresh_interval,
+                conf_cleaner.notify_before_days * 3600 * 24,
+                conf_cleaner.notify_before_days_last * 3600 * 24,
+                shard=get_shard())
+            if conf_cleaner.outbox:
+                # retries of failed outbox actions
+                self.heap.extend(
+                    repositories.get_outbox_repository().get_next_attempts(
+                        now + conf_cleaner.scheduler_refresh_interval,
+                        shard=get_shard()))
+            repositories.commit()
         except Exception as e:
-            LOG.exception("expiration handling error: " + str(e))
+            LOG.exception("expiration schedule error: " + str(e))
+            repositories.rollback()
+            # fall back to check_interval passes until the next refresh
+            self.heap = []
+        if self.last_run is not None:
+            # actions due before the last pass were tried by it and failed,
+            # they are retried by the next check_interval pass
+            self.heap = [due for due in self.heap if due[0] > self.last_run]
+        heapq.heapify(self.heap)
+        self.next_refresh = now + conf_cleaner.scheduler_refresh_interval
+        if self.heap:
+            LOG.debug("%d due actions, next at %s" % (
+                len(self.heap),
+                datetime.datetime.fromtimestamp(self.heap[0][0])))
+
+    def next_run(self):
+        """Timestamp of the next cleaner pass."""
+        conf_cleaner = config.CONF.cleaner
+        if self.last_run is None:
+            return 0
+        next_run = self.last_run + conf_cleaner.check_interval
+        if self.heap:
+            next_run = min(next_run, max(
+                self.heap[0][0],
+                self.last_run + conf_cleaner.min_check_interval))
+        return next_run
+
+    def run_pending(self, now=None):
+        """Run a cleaner pass if one is due.
+
+        :returns: seconds to wait before the next call
+        """
+        now = now or time.time()
+        if now >= self.next_refresh:
+            self.refresh(now)
+        if now >= self.next_run():
+            while self.heap and self.heap[0][0] <= now:
+                heapq.heappop(self.heap)
+            self.last_run = now
+            check(self.started_at)
+            now = time.time()
+            self.refresh(now)
+        return max(0, min(self.next_run(), self.next_refresh) - now)
+
 
 class CleanerServer(service.Service):
 
     def __init__(self):
         super(CleanerServer, self).__init__()
+        conf_cleaner = config.CONF.cleaner
+        if conf_cleaner.shard_index >= conf_cleaner.shard_count:
+            raise RuntimeError('[cleaner] shard_index must be lower than '
+                               'shard_count')
+        if conf_cleaner.engine == 'asyncio' and not _asyncio_available():
+            raise RuntimeError('[cleaner] engine asyncio needs Python 3.7 or '
+                               'later, aiohttp and aiosmtplib')
+        if conf_cleaner.shard_count > 1:
+            LOG.info('Cleaner shard %d of %d' % (
+                conf_cleaner.shard_index, conf_cleaner.shard_count))
         repositories.setup_database_engine_and_factory()
-        started_at = time.time()
-        callables = [(check, (started_at,), {})]
-        self.w = periodics.PeriodicWorker(callables)
+        self.scheduler = Scheduler(repositories.get_vmexpire_repository(),
+                                   started_at=time.time())
+        self._stopped = threading.Event()
+        self._metrics_server = None
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                delay = self.scheduler.run_pending()
+            except Exception as e:
+                LOG.exception("cleaner error: " + str(e))
+                delay = config.CONF.cleaner.min_check_interval
+            self._stopped.wait(delay)
 
     def start(self):
         LOG.info("Starting the CleanerServer")
-        self.w.start()
+        conf_metrics = config.CONF.metrics
+        self._metrics_server = metrics.start_http_server(
+            conf_metrics.listen_host, conf_metrics.cleaner_port)
         super(CleanerServer, self).start()
+        self.tg.add_thread(self._run)
+        query_stats.add_dump_timer(self.tg)
 
     def stop(self):
         LOG.info("Halting the CleanerServer")
-        self.w.stop()
+        self._stopped.set()
+        if self._metrics_server is not None:
+            self._metrics_server.shutdown()
+        query_stats.dump_stats()
         super(CleanerServer, self).stop()
 
 
+plan_opt = cfg.BoolOpt('plan',
+                       default=False,
+                       help='Print the actions and remote calls of a cleaner '
+                            'pass, without running it, and exit')
+
+
 def main():
+    # config.CONF is parsed on import, CLI options need a fresh parser
+    config.CONF.clear()
+    config.CONF.register_cli_opt(plan_opt)
     try:
         config.CONF(sys.argv[1:],
                     project='os-vm-expire',
@@ -323,6 +829,12 @@ def main():
         # Import and configure logging.
         log.setup(config.CONF, 'osvmexpire')
         LOG = log.getLogger(__name__)
+
+        if config.CONF.plan:
+            repositories.setup_database_engine_and_factory()
+            print(plan.format_plan(plan.get_plan()))
+            return
+
         LOG.debug("Booting up os-vm-expire cleaner node...")
 
         service.launch(
@@ -0,0 +1,135 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Coroutines of the cleaner asyncio engine.
+
+Only imported by os_vm_expire.cmd.cleaner when [cleaner] engine is asyncio,
+so that the default eventlet engine runs on Pythons without asyncio.
+"""
+import asyncio
+
+from os_vm_expire.cmd import cleaner
+from os_vm_expire.common import aio
+from os_vm_expire.common import keystone
+
+LOG = cleaner.LOG
+
+
+async def delete_vm_async(pool, instance_id, project_id, token):
+    '''Asyncio counterpart of delete_vm'''
+    r = await pool.http.request('delete',
+                                cleaner._get_server_url(instance_id,
+                                                        project_id),
+                                token=token, headers=keystone.JSON_HEADERS,
+                                service='nova')
+    return cleaner._check_deleted(r, instance_id, project_id)
+
+
+async def get_project_name_async(pool, project_id, token):
+    try:
+        project = await pool.http.get_object('project', project_id,
+                                             token=token)
+    except Exception:
+        LOG.exception('Failed to get project name for id ' + str(project_id))
+        return None
+    if project:
+        return project['name']
+    return None
+
+
+async def _get_email_async(pool, user_id, token):
+    user = await pool.http.get_object('user', user_id, token=token)
+    return cleaner._get_user_email(user, user_id)
+
+
+async def _send_async(pool, to, subject, message):
+    msg = cleaner._get_mime(to, subject, message)
+    if msg is None:
+        return False
+    try:
+        await pool.smtp_pool.sendmail(msg['From'], to, msg.as_string())
+    except Exception:
+        LOG.error('Failed to send expiration notification mail to ' + to[0])
+        return False
+    return True
+
+
+async def send_email_async(pool, instance, token, delete=False,
+                           smtp_pool=None):
+    """Asyncio counterpart of send_email, smtp_pool is not used."""
+    email = await _get_email_async(pool, instance.user_id, token)
+    if email is None:
+        return False
+    project_name = await get_project_name_async(pool, instance.project_id,
+                                                token)
+    to, subject, message = cleaner._get_notification(instance, email,
+                                                     project_name, delete)
+    return await _send_async(pool, to, subject, message)
+
+
+async def send_digest_async(pool, user_id, notices, token, smtp_pool=None):
+    """Asyncio counterpart of send_digest, smtp_pool is not used."""
+    email = await _get_email_async(pool, user_id, token)
+    if email is None:
+        return False
+    project_ids = sorted(set(task.project_id for (task, _) in notices))
+    names = await asyncio.gather(
+        *[get_project_name_async(pool, project_id, token)
+          for project_id in project_ids])
+    project_names = dict(
+        (project_id, name or project_id)
+        for (project_id, name) in zip(project_ids, names))
+    to, subject, message = cleaner._get_digest(user_id, notices, email,
+                                               project_names)
+    return await _send_async(pool, to, subject, message)
+
+
+async def _run_action_async(pool, task, action, token, smtp_pool=None):
+    try:
+        if action == cleaner.DELETE:
+            return await delete_vm_async(pool, task.instance_id,
+                                         task.project_id, token)
+        return await send_email_async(pool, task, token, delete=False)
+    except Exception as e:
+        LOG.exception("expiration handling error: " + str(e))
+        return False
+
+
+async def _run_entry_async(pool, entry, token, smtp_pool=None):
+    try:
+        if entry.action == cleaner.DELETE:
+            res = await delete_vm_async(pool, entry.task.instance_id,
+                                        entry.task.project_id, token)
+        else:
+            res = await send_email_async(
+                pool, entry.task, token,
+                delete=entry.action == cleaner.DELETION_NOTICE)
+    except Exception as e:
+        LOG.exception("outbox %s error: %s" % (entry.action, str(e)))
+        return str(e)
+    return None if res else '%s failed' % entry.action
+
+
+# Coroutines run instead of the remote calls of the cleaner
+ASYNC_CALLS = {
+    cleaner._run_action: _run_action_async,
+    cleaner._run_entry: _run_entry_async,
+    cleaner.send_email: send_email_async,
+    cleaner.send_digest: send_digest_async,
+}
+
+
+def get_pool(size, smtp_pool_size):
+    """Get the pool running the remote calls of a pass as coroutines."""
+    return aio.Pool(size, ASYNC_CALLS, smtp_pool_size)
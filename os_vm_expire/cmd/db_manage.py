@@ -49,6 +49,7 @@ class DatabaseManager(object):
         self.add_upgrade_args()
         self.add_history_args()
         self.add_current_args()
+        self.add_clean_args()
 
     def get_main_parser(self):
         """Create top-level parser and arguments."""
@@ -98,6 +99,37 @@ class DatabaseManager(object):
                                         'revision.')
         create_parser.set_defaults(func=self.current)
 
+    def add_clean_args(self):
+        """Create 'clean' command parser and arguments."""
+        create_parser = self.subparsers.add_parser(
+            'clean',
+            help='Clean up soft deletions in the database')
+        create_parser.add_argument('--db-url', '-d', default=None,
+                                   help='URL to the database.')
+        create_parser.add_argument('--min-days', '-m', type=int, default=90,
+                                   help='minimum number of days to keep soft '
+                                        'deletions. default is %(default)s '
+                                        'days.')
+        create_parser.add_argument('--batch-size', '-b', type=int,
+                                   default=None,
+                                   help='number of rows per delete '
+                                        'statement, defaults to '
+                                        'db_delete_batch_size.')
+        create_parser.add_argument('--sleep', '-s', type=float, default=None,
+                                   help='seconds to wait between delete '
+                                        'statements, defaults to '
+                                        'db_delete_batch_sleep.')
+        create_parser.add_argument('--verbose', '-V', action='store_true',
+                                   help='Show verbose information about the '
+                                        'clean up.')
+        create_parser.add_argument('--log-file', '-L',
+                                   default=CONF.log_file,
+                                   type=str,
+                                   help='Set log file location. '
+                                        'Default value for log_file can be '
+                                        'found in osvmexpire.conf')
+        create_parser.set_defaults(func=self.clean)
+
     def revision(self, args):
         """Process the 'revision' Alembic command."""
         config = commands.init_config()
@@ -123,6 +155,17 @@ class DatabaseManager(object):
         config.osvmexpire = CONF
         commands.current(args.verbose, config=config)
 
+    def clean(self, args):
+        # clean sets up logging on import, only once the CLI is parsed
+        from os_vm_expire.model import clean
+        clean.clean_command(
+            sql_url=args.db_url,
+            min_num_days=args.min_days,
+            verbose=args.verbose,
+            log_file=args.log_file,
+            batch_size=args.batch_size,
+            sleep=args.sleep)
+
     def execute(self):
         """Parse the command line arguments."""
         args = self.parser.parse_args()
@@ -20,6 +20,7 @@ from os_vm_expire.common import config
 # from os_vm_expire.model import clean
 # from os_vm_expire.model.migration import commands
 from os_vm_expire.model.models import VmExclude
+from os_vm_expire.model import plan
 from os_vm_expire.model import repositories
 import os_vm_expire.version
 
@@ -49,6 +50,16 @@ def args(*args, **kwargs):
     return _decorator
 
 
+def _read_ids(path):
+    """Read one id per line, None if the file cannot be read."""
+    try:
+        with open(path) as f:
+            return [line.strip() for line in f if line.strip()]
+    except IOError as e:
+        print("Failure to read %s: %s" % (path, str(e)))
+        return None
+
+
 class VmExcludeCommands(object):
     """Class for managing VM excludes"""
 
@@ -83,7 +94,7 @@ class VmExcludeCommands(object):
             exclude_type = 1
         elif excludeType == 'user':
             exclude_type = 2
-        excludes = repo.get_type_entities(exclude_type=exclude_type)
+        excludes = repo.iter_type_entities(exclude_type=exclude_type)
         headers = [
             'id',
             'type',
@@ -180,7 +191,6 @@ class VmExpireCommands(object):
     def list(self, instanceid=None, days=None):
         repositories.setup_database_engine_and_factory()
         repo = repositories.get_vmexpire_repository()
-        res = repo.get_all_by(instance_id=instanceid, project_id=None)
         headers = [
             'id',
             'expire',
@@ -199,11 +209,10 @@ class VmExpireCommands(object):
             except Exception as e:
                 print(str(e))
                 return
+        res = repo.iter_all_by(instance_id=instanceid, project_id=None,
+                               expire_before=limit)
         pt = prettytable.PrettyTable(headers)
         for instance in res:
-            if limit and instance.expire > limit:
-                continue
-
             pt.add_row(
                 [
                     instance.id,
@@ -223,9 +232,15 @@ class VmExpireCommands(object):
 
     extend_description = "Extend a VM duration"
 
-    @args('--id', metavar='<id>', dest='expirationid',
+    @args('--id', metavar='<id>', dest='expirationid', default=None,
           help='Expiration id')
-    def extend(self, expirationid):
+    @args('--project', metavar='<project-id>', dest='projectid',
+          default=None, help='Extend all the expirations of a project')
+    @args('--from-file', metavar='<path>', dest='fromfile', default=None,
+          help='File with one expiration id per line')
+    def extend(self, expirationid=None, projectid=None, fromfile=None):
+        if projectid or fromfile:
+            return self._extend_all(projectid, fromfile)
         if not expirationid:
             print("Missing id parameter")
             return
@@ -235,6 +250,35 @@ class VmExpireCommands(object):
         repositories.commit()
         print("VM expiration successfully extended!")
 
+    def _extend_all(self, projectid=None, fromfile=None):
+        expiration_ids = None
+        if fromfile:
+            expiration_ids = _read_ids(fromfile)
+            if expiration_ids is None:
+                return
+        repositories.setup_database_engine_and_factory()
+        repo = repositories.get_vmexpire_repository()
+        try:
+            res = repo.extend_vms(project_id=projectid,
+                                  entity_ids=expiration_ids)
+        except Exception as e:
+            repositories.rollback()
+            print("Failure to extend VM expirations: %s" % str(e))
+            return
+        repositories.commit()
+        pt = prettytable.PrettyTable(['id', 'result'])
+        for result in ('extended', 'capped', 'not_found'):
+            for expiration_id in res[result]:
+                pt.add_row([expiration_id, result])
+        if six.PY3:
+            print(encodeutils.safe_encode(pt.get_string()).decode())
+        else:
+            print(encodeutils.safe_encode(pt.get_string()))
+        print("%d extended until %s, %d capped by max_vm_total_duration" % (
+            len(res['extended']),
+            datetime.datetime.fromtimestamp(res['expire']),
+            len(res['capped'])))
+
     remove_description = "Deletes a VM expiration"
 
     @args('--id', metavar='<expiration-id>', dest='expirationid',
@@ -252,8 +296,14 @@ class VmExpireCommands(object):
     add_description = "Add a VM to the expiration database"
 
     @args('--id', metavar='<instance-id>', dest='instanceid',
-          help='Instance id')
-    def add(self, instanceid):
+          default=None, help='Instance id')
+    @args('--from-file', metavar='<path>', dest='fromfile', default=None,
+          help='File with one instance id per line')
+    @args('--all-project', metavar='<project-id>', dest='allproject',
+          default=None, help='Add all the instances of a project')
+    def add(self, instanceid=None, fromfile=None, allproject=None):
+        if fromfile or allproject:
+            return self._add_all(fromfile, allproject)
         if not instanceid:
             print("Missing id parameter")
             return
@@ -267,6 +317,77 @@ class VmExpireCommands(object):
         repositories.commit()
         print("VM expiration successfully generated!")
 
+    def _add_all(self, fromfile=None, allproject=None):
+        instance_ids = None
+        if fromfile:
+            instance_ids = _read_ids(fromfile)
+            if instance_ids is None:
+                return
+        repositories.setup_database_engine_and_factory()
+        repo = repositories.get_vmexpire_repository()
+        try:
+            res = repo.add_vms(instance_uuids=instance_ids,
+                               project_id=allproject)
+        except Exception as e:
+            repositories.rollback()
+            print("Failure to add VM expirations: %s" % str(e))
+            return
+        repositories.commit()
+        pt = prettytable.PrettyTable(['instance.id', 'result', 'id'])
+        for item in res:
+            pt.add_row([item['instance_id'], item['result'],
+                        item.get('id', '')])
+        if six.PY3:
+            print(encodeutils.safe_encode(pt.get_string()).decode())
+        else:
+            print(encodeutils.safe_encode(pt.get_string()))
+        print("%d added out of %d instances" % (
+            len([item for item in res if item['result'] == 'added']),
+            len(res)))
+
+    reconcile_description = ("Sync VM expirations with the instances "
+                             "listed by Nova")
+
+    @args('--dry-run', action='store_true', dest='dryrun', default=False,
+          help='Only show what would be done')
+    def reconcile(self, dryrun=False):
+        repositories.setup_database_engine_and_factory()
+        repo = repositories.get_vmexpire_repository()
+        try:
+            res = repo.reconcile(dry_run=dryrun)
+        except Exception as e:
+            repositories.rollback()
+            print("Failure to reconcile VM expirations: %s" % str(e))
+            return
+        pt = prettytable.PrettyTable(['action', 'instance.id'])
+        for action in ('removed', 'added', 'excluded'):
+            for instance_id in res[action]:
+                pt.add_row([action, instance_id])
+        if six.PY3:
+            print(encodeutils.safe_encode(pt.get_string()).decode())
+        else:
+            print(encodeutils.safe_encode(pt.get_string()))
+        print("%d removed, %d added, %d excluded%s" % (
+            len(res['removed']), len(res['added']), len(res['excluded']),
+            ' (dry run)' if dryrun else ''))
+
+    plan_description = ("Show the actions and remote calls of a cleaner "
+                        "pass, without running it")
+
+    def plan(self):
+        repositories.setup_database_engine_and_factory()
+        try:
+            res = plan.get_plan()
+        except Exception as e:
+            print("Failure to plan cleaner actions: %s" % str(e))
+            return
+        finally:
+            repositories.rollback()
+        if six.PY3:
+            print(encodeutils.safe_encode(plan.format_plan(res)).decode())
+        else:
+            print(encodeutils.safe_encode(plan.format_plan(res)))
+
 
 CATEGORIES = {
     'vm': VmExpireCommands,
@@ -0,0 +1,316 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Asyncio HTTP and SMTP clients of the cleaner asyncio engine.
+
+aiohttp and aiosmtplib are optional, they are only needed when
+[cleaner] engine is asyncio (pip install os-vm-expire[asyncio]).
+"""
+import asyncio
+import time
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+try:
+    import aiosmtplib
+except ImportError:
+    aiosmtplib = None
+
+from os_vm_expire.common import cache
+from os_vm_expire.common import config
+from os_vm_expire.common import http
+from os_vm_expire.common import keystone
+from os_vm_expire.common import metrics
+from os_vm_expire.common import utils
+
+LOG = utils.getLogger(__name__)
+
+
+def is_available():
+    """Check if the asyncio engine dependencies are installed."""
+    return aiohttp is not None and aiosmtplib is not None
+
+
+class Response(object):
+    """Status and decoded json body of an HTTP response."""
+
+    def __init__(self, status_code, body=None):
+        self.status_code = status_code
+        self.body = body
+
+    def json(self):
+        return self.body
+
+
+class HTTPClient(object):
+    """Sends keystone authenticated requests over an aiohttp session.
+
+    Tokens come from the process wide keystone token cache, renewed in the
+    loop executor so that authentication does not block other coroutines.
+    A rejected token is renewed and the request sent once again, as
+    keystone.request does. Idempotent requests are retried on connection
+    errors and 5xx responses with the [http] retries and retry_backoff
+    options.
+
+    :param group_name: config group holding the service credentials
+    """
+
+    def __init__(self, group_name):
+        self.group_name = group_name
+        self._session = None
+
+    def _get_session(self):
+        if self._session is None:
+            conf_http = config.CONF.http
+            connector = aiohttp.TCPConnector(
+                limit_per_host=conf_http.pool_size)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(
+                    sock_connect=conf_http.connect_timeout,
+                    sock_read=conf_http.read_timeout))
+        return self._session
+
+    async def _send_timed(self, service, method, url, headers, **kwargs):
+        with metrics.remote_call(service, method):
+            r = await self._send(method, url, headers, **kwargs)
+        return metrics.check_response(service, method, r)
+
+    async def _send(self, method, url, headers, **kwargs):
+        conf_http = config.CONF.http
+        retries = 0
+        if method.upper() in http.RETRY_METHODS:
+            retries = conf_http.retries
+        for attempt in range(retries + 1):
+            if attempt:
+                await asyncio.sleep(
+                    conf_http.retry_backoff * 2 ** (attempt - 1))
+            try:
+                async with self._get_session().request(
+                        method, url, headers=headers, **kwargs) as r:
+                    if r.status in http.RETRY_STATUSES and attempt < retries:
+                        continue
+                    body = None
+                    if r.content_type == 'application/json':
+                        body = await r.json()
+                    return Response(r.status, body)
+            except aiohttp.ClientError:
+                if attempt == retries:
+                    raise
+
+    async def _get_token(self, token_cache):
+        """Get a token, authenticating in a thread not to block the loop."""
+        return await asyncio.get_event_loop().run_in_executor(
+            None, token_cache.get_token)
+
+    async def request(self, method, url, token=None, headers=None,
+                      service='keystone', **kwargs):
+        """Asyncio counterpart of keystone.request.
+
+        :returns: Response or None if no token could be obtained
+        """
+        token_cache = keystone.get_token_cache(self.group_name)
+        if token is None:
+            token = await self._get_token(token_cache)
+        if not token:
+            return None
+        headers = dict(headers or {})
+        headers['X-Auth-Token'] = token
+        r = await self._send_timed(service, method, url, headers, **kwargs)
+        if r.status_code == 401:
+            LOG.info('Token rejected, renewing it for %s', self.group_name)
+            token_cache.invalidate(token)
+            token = await self._get_token(token_cache)
+            if not token:
+                return r
+            headers['X-Auth-Token'] = token
+            r = await self._send_timed(service, method, url, headers,
+                                       **kwargs)
+        return r
+
+    async def get_object(self, object_type, object_id, token=None):
+        """Asyncio counterpart of keystone.get_project and get_user."""
+        metadata_cache, key = keystone._get_object_cache(
+            object_type, object_id, self.group_name)
+        obj = metadata_cache.get(key)
+        if obj is not cache.MISSING:
+            return obj
+        r = await self.request(
+            'get', '%s/%ss/%s' % (key[0], object_type, object_id),
+            token=token, headers=keystone.JSON_HEADERS)
+        return keystone._cache_object(object_type, metadata_cache, key, r)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class SMTPSession(object):
+    """Asyncio counterpart of mail.SMTPSession."""
+
+    def __init__(self):
+        self._smtp = None
+        self._count = 0
+
+    async def _connect(self):
+        conf_smtp = config.CONF.smtp
+        smtp = aiosmtplib.SMTP(hostname=conf_smtp.email_smtp_host,
+                               port=conf_smtp.email_smtp_port,
+                               timeout=conf_smtp.email_smtp_timeout)
+        await smtp.connect(start_tls=conf_smtp.email_smtp_tls)
+        if conf_smtp.email_smtp_user:
+            await smtp.login(conf_smtp.email_smtp_user,
+                             conf_smtp.email_smtp_password)
+        self._smtp = smtp
+        self._count = 0
+
+    async def close(self):
+        if self._smtp is None:
+            return
+        try:
+            await self._smtp.quit()
+        except Exception:
+            LOG.debug('Error closing SMTP connection', exc_info=True)
+        self._smtp = None
+
+    async def sendmail(self, sender, to, message):
+        """Send a message, reconnecting once if the connection was lost."""
+        if self._count >= config.CONF.smtp.email_smtp_max_messages:
+            await self.close()
+        for attempt in (1, 2):
+            if self._smtp is None:
+                await self._connect()
+            try:
+                await self._smtp.sendmail(sender, to, message)
+                self._count += 1
+                return
+            except (aiosmtplib.SMTPServerDisconnected,
+                    aiosmtplib.SMTPConnectError, OSError):
+                self._smtp = None
+                if attempt == 2:
+                    raise
+                LOG.info('SMTP connection lost, reconnecting')
+
+
+class SMTPPool(object):
+    """Asyncio counterpart of mail.SMTPPool.
+
+    Must be created by a coroutine running on the loop using it.
+    :param size: maximum number of open connections
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._sessions = asyncio.LifoQueue()
+        for _ in range(self.size):
+            self._sessions.put_nowait(SMTPSession())
+        self.sent = 0
+        self.failures = 0
+        self.send_time = 0.0
+        self.max_send_time = 0.0
+
+    async def sendmail(self, sender, to, message):
+        """Send a message over one of the pooled connections."""
+        start = time.time()
+        smtp_session = await self._sessions.get()
+        try:
+            with metrics.remote_call('smtp', 'sendmail'):
+                await smtp_session.sendmail(sender, to, message)
+        except Exception:
+            self.failures += 1
+            raise
+        finally:
+            self._sessions.put_nowait(smtp_session)
+        duration = time.time() - start
+        self.sent += 1
+        self.send_time += duration
+        self.max_send_time = max(self.max_send_time, duration)
+
+    async def close(self):
+        for _ in range(self.size):
+            smtp_session = self._sessions.get_nowait()
+            await smtp_session.close()
+            self._sessions.put_nowait(smtp_session)
+
+    def log_stats(self):
+        average = self.send_time / self.sent if self.sent else 0
+        LOG.info('SMTP: %(sent)d messages sent, %(failures)d failures, '
+                 'send time avg %(avg).3fs max %(max).3fs',
+                 {'sent': self.sent, 'failures': self.failures,
+                  'avg': average, 'max': self.max_send_time})
+
+
+class Pool(object):
+    """Runs the remote calls of a cleaner pass on a private event loop.
+
+    Offers the imap, spawn_n and waitall calls of the eventlet.GreenPool
+    used by the cleaner: the coroutine function mapped to func in calls is
+    run instead of func, with this pool as first argument. At most size
+    coroutines run at a time, imap returns once they are all done so that
+    the database is only used by the calling thread.
+
+    :param size: maximum number of concurrent coroutines
+    :param calls: dict of function to its coroutine counterpart
+    :param smtp_pool_size: maximum number of open SMTP connections
+    """
+
+    def __init__(self, size, calls, smtp_pool_size):
+        self.size = size
+        self.calls = calls
+        self.loop = asyncio.new_event_loop()
+        self.http = HTTPClient('cleaner')
+        self.smtp_pool = None
+        self._smtp_pool_size = smtp_pool_size
+        self._semaphore = None
+        self._pending = []
+
+    async def _bounded(self, func, args):
+        async with self._semaphore:
+            return await self.calls[func](self, *args)
+
+    async def _gather(self, calls):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.size)
+            self.smtp_pool = SMTPPool(self._smtp_pool_size)
+        return await asyncio.gather(
+            *[self._bounded(func, args) for (func, args) in calls])
+
+    def imap(self, func, *iterables):
+        return self.loop.run_until_complete(
+            self._gather([(func, args) for args in zip(*iterables)]))
+
+    def spawn_n(self, func, *args):
+        self._pending.append((func, args))
+
+    def waitall(self):
+        pending, self._pending = self._pending, []
+        if pending:
+            self.loop.run_until_complete(self._gather(pending))
+
+    async def _close(self):
+        await self.http.close()
+        if self.smtp_pool is not None:
+            await self.smtp_pool.close()
+            self.smtp_pool.log_stats()
+
+    def close(self):
+        """Run the pending calls, then close connections and loop."""
+        self.waitall()
+        try:
+            self.loop.run_until_complete(self._close())
+        finally:
+            self.loop.close()
@@ -0,0 +1,102 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+In-memory caches.
+"""
+import collections
+import threading
+import time
+
+from os_vm_expire.common import utils
+
+LOG = utils.getLogger(__name__)
+
+# Returned by LRUCache.get when key is not cached
+MISSING = object()
+
+# Log cache statistics every STATS_LOG_INTERVAL lookups
+STATS_LOG_INTERVAL = 1000
+
+
+class LRUCache(object):
+    """Bounded cache with least recently used eviction and expiration.
+
+    Entries expire after ttl seconds. Negative entries (the remote object
+    does not exist) are stored with their own, usually shorter, ttl.
+
+    :param name: cache name, used in logs
+    :param max_size: maximum number of entries, 0 disables the cache
+    :param ttl: lifetime of entries in seconds
+    :param negative_ttl: lifetime of negative entries in seconds
+    """
+
+    def __init__(self, name, max_size, ttl, negative_ttl=None):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Get a cached value, or MISSING if not cached or expired."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] > time.time():
+                # mark as most recently used
+                self._data[key] = self._data.pop(key)
+                self.hits += 1
+                value = entry[1]
+            else:
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                value = MISSING
+            lookups = self.hits + self.misses
+        if lookups % STATS_LOG_INTERVAL == 0:
+            self.log_stats()
+        return value
+
+    def set(self, key, value, negative=False):
+        """Cache a value, negative entries expire after negative_ttl."""
+        if self.max_size <= 0:
+            return
+        ttl = self.negative_ttl if negative else self.ttl
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time() + ttl, value)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key=None):
+        """Remove a key, or all keys if key is None."""
+        with self._lock:
+            if key is None:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
+
+    def __len__(self):
+        return len(self._data)
+
+    def log_stats(self):
+        LOG.info('Cache %(name)s: %(size)d entries, %(hits)d hits, '
+                 '%(misses)d misses, %(evictions)d evictions',
+                 {'name': self.name, 'size': len(self._data),
+                  'hits': self.hits, 'misses': self.misses,
+                  'evictions': self.evictions})
@@ -66,6 +66,20 @@ mail_opts = [
                default=None,
                help=u._('Email where expiration notifications should be sent,'
                         ' leave empty if no copy is needed')),
+    cfg.IntOpt('email_smtp_pool_size',
+               default=2,
+               min=1,
+               help=u._('Maximum number of SMTP connections kept open by '
+                        'a cleaner pass')),
+    cfg.IntOpt('email_smtp_max_messages',
+               default=100,
+               min=1,
+               help=u._('Number of messages sent over an SMTP connection '
+                        'before reconnecting')),
+    cfg.IntOpt('email_smtp_timeout',
+               default=30,
+               min=1,
+               help=u._('SMTP connection and command timeout in seconds')),
 
 ]
 
@@ -99,6 +113,70 @@ cleaner_opts = [
     cfg.IntOpt('notify_before_days_last',
                default=2,
                help=u._("os-vm-expire send last notification before X days")),
+    cfg.IntOpt('workers',
+               default=1,
+               min=1,
+               help=u._("Number of green threads used by a cleaner pass to "
+                        "send notifications and delete VMs concurrently. "
+                        "Database updates are always done sequentially.")),
+    cfg.BoolOpt('email_digest',
+                default=False,
+                help=u._("Send a single mail per user and cleaner pass "
+                         "listing all the user VMs to expire or deleted, "
+                         "instead of one mail per VM.")),
+    cfg.StrOpt('engine',
+               default='eventlet',
+               choices=['eventlet', 'asyncio'],
+               help=u._("Runtime of the notifications and deletions of a "
+                        "cleaner pass: eventlet green threads, or asyncio "
+                        "coroutines with aiohttp and aiosmtplib (Python "
+                        "3.7 or later, install os-vm-expire[asyncio]). "
+                        "workers bounds the "
+                        "concurrent calls in both cases.")),
+    cfg.IntOpt('check_interval',
+               default=3600,
+               min=1,
+               help=u._("Maximum time in seconds between two cleaner "
+                        "passes. Passes are otherwise run when a "
+                        "notification or deletion is due.")),
+    cfg.IntOpt('min_check_interval',
+               default=60,
+               min=1,
+               help=u._("Minimum time in seconds between two cleaner "
+                        "passes.")),
+    cfg.IntOpt('scheduler_refresh_interval',
+               default=300,
+               min=1,
+               help=u._("Interval in seconds between two loads of the "
+                        "next due notifications and deletions from the "
+                        "database, to take into account VMs added or "
+                        "extended meanwhile.")),
+    cfg.BoolOpt('outbox',
+                default=False,
+                help=u._("Queue notifications and deletions in a database "
+                         "outbox, then execute them with retries and "
+                         "exponential backoff on failure.")),
+    cfg.IntOpt('outbox_retry_backoff',
+               default=60,
+               min=1,
+               help=u._("Delay in seconds before retrying a failed outbox "
+                        "action, doubled on each attempt.")),
+    cfg.IntOpt('outbox_max_backoff',
+               default=86400,
+               min=1,
+               help=u._("Maximum delay in seconds between two attempts of "
+                        "an outbox action.")),
+    cfg.IntOpt('shard_count',
+               default=1,
+               min=1,
+               help=u._("Number of cleaner processes sharing the VMs. Each "
+                        "VM is handled by a single cleaner, chosen by a "
+                        "hash of its instance id.")),
+    cfg.IntOpt('shard_index',
+               default=0,
+               min=0,
+               help=u._("Index of this cleaner, from 0 to shard_count - 1. "
+                        "Each cleaner process must have its own index.")),
 ]
 
 
@@ -112,6 +190,11 @@ worker_opts = [
     cfg.StrOpt('nova_url',
                default='http://controller:8774/v2.1',
                help=u._("Openstack nova compute url")),
+    cfg.IntOpt('nova_page_size',
+               default=1000,
+               min=1,
+               help=u._("Number of servers per Nova request when listing "
+                        "all instances for reconciliation")),
     cfg.StrOpt('admin_service',
                default='service',
                help=u._("service project name")),
@@ -128,6 +211,101 @@ worker_opts = [
                help=u._("os-vm-expire service project domain name")),
 ]
 
+http_opt_group = cfg.OptGroup(name='http',
+                              title='HTTP Client Options')
+
+http_opts = [
+    cfg.IntOpt('pool_size',
+               default=10,
+               min=1,
+               help=u._("Maximum number of connections kept open per "
+                        "Keystone or Nova host")),
+    cfg.FloatOpt('connect_timeout',
+                 default=5.0,
+                 min=0.0,
+                 help=u._("Timeout in seconds to connect to Keystone or "
+                          "Nova")),
+    cfg.FloatOpt('read_timeout',
+                 default=30.0,
+                 min=0.0,
+                 help=u._("Timeout in seconds to wait for a Keystone or "
+                          "Nova response")),
+    cfg.IntOpt('retries',
+               default=3,
+               min=0,
+               help=u._("Number of retries on connection errors and on "
+                        "5xx responses of idempotent requests")),
+    cfg.FloatOpt('retry_backoff',
+                 default=0.5,
+                 min=0.0,
+                 help=u._("Backoff factor between retries, retry n waits "
+                          "retry_backoff * 2 ^ (n - 1) seconds")),
+]
+
+metrics_opt_group = cfg.OptGroup(name='metrics',
+                                 title='Metrics Options')
+
+metrics_opts = [
+    cfg.HostAddressOpt('listen_host',
+                       default='127.0.0.1',
+                       help=u._("Address the worker and cleaner metrics "
+                                "listeners bind to")),
+    cfg.PortOpt('worker_port',
+                default=0,
+                help=u._("Port of the worker metrics listener, serving "
+                         "Prometheus metrics at /metrics. 0 disables it.")),
+    cfg.PortOpt('cleaner_port',
+                default=0,
+                help=u._("Port of the cleaner metrics listener, serving "
+                         "Prometheus metrics at /metrics. 0 disables it.")),
+    cfg.FloatOpt('slow_query_threshold',
+                 default=1.0,
+                 min=0.0,
+                 help=u._("SQL statements taking at least this number of "
+                          "seconds are logged as warnings with the "
+                          "repository method running them. 0 disables "
+                          "the slow query log.")),
+    cfg.IntOpt('query_stats_interval',
+               default=0,
+               min=0,
+               help=u._("Interval in seconds between logs of the SQL "
+                        "statements aggregates: count, total, p50, p99 and "
+                        "max durations per statement fingerprint and the "
+                        "repository methods running them. 0 disables the "
+                        "aggregates.")),
+    cfg.IntOpt('query_stats_top',
+               default=10,
+               min=1,
+               help=u._("Number of statement fingerprints logged with the "
+                        "SQL statements aggregates, by total time")),
+]
+
+keystone_cache_opt_group = cfg.OptGroup(name='keystone_cache',
+                                        title='Keystone Cache Options')
+
+keystone_cache_opts = [
+    cfg.IntOpt('token_refresh_before',
+               default=300,
+               min=0,
+               help=u._("Renew cached keystone tokens this number of seconds "
+                        "before they expire")),
+    cfg.IntOpt('metadata_cache_size',
+               default=10000,
+               min=0,
+               help=u._("Maximum number of keystone projects and users kept "
+                        "in cache, 0 disables the cache")),
+    cfg.IntOpt('metadata_cache_ttl',
+               default=600,
+               min=0,
+               help=u._("Time in seconds keystone projects and users are "
+                        "kept in cache")),
+    cfg.IntOpt('metadata_negative_ttl',
+               default=60,
+               min=0,
+               help=u._("Time in seconds unknown keystone projects and users "
+                        "are kept in cache")),
+]
+
 queue_opt_group = cfg.OptGroup(name='queue',
                                title='Queue Application Options')
 
@@ -184,6 +362,13 @@ ks_queue_opts = [
     cfg.IntOpt('thread_pool_size', default=10,
                help=u._('Define the number of max threads to be used for '
                         'notification server processing functionality.')),
+    cfg.IntOpt('batch_size', default=0, min=0,
+               help=u._('Process notifications by batches of up to this '
+                        'number of messages, with a single commit per '
+                        'batch. 0 processes notifications one by one.')),
+    cfg.IntOpt('batch_timeout', default=1, min=1,
+               help=u._('Maximum time in seconds to wait for a batch of '
+                        'notifications to fill up.')),
 ]
 
 
@@ -207,6 +392,39 @@ common_opts = [
     cfg.IntOpt('max_vm_total_duration',
                default=MAX_VM_TOTAL_DURATION_DAYS,
                help=u._("Maximum life of VM in days, whatever the extends")),
+    cfg.IntOpt('exclude_refresh_interval',
+               default=30,
+               min=0,
+               help=u._("Interval in seconds between checks of exclusions "
+                        "changes made by other processes. Exclusions are "
+                        "kept in memory and reloaded on change.")),
+    cfg.IntOpt('db_batch_size',
+               default=500,
+               min=1,
+               help=u._("Number of rows fetched per round trip when "
+                        "iterating over large database results.")),
+    cfg.IntOpt('db_delete_batch_size',
+               default=1000,
+               min=1,
+               help=u._("Number of rows removed per DELETE statement on "
+                        "bulk deletions, each batch is committed on its "
+                        "own to keep table locks short.")),
+    cfg.FloatOpt('db_delete_batch_sleep',
+                 default=0.0,
+                 min=0.0,
+                 help=u._("Seconds to wait between two bulk deletion "
+                          "batches.")),
+]
+
+paging_opts = [
+    cfg.IntOpt('default_limit_paging', default=100,
+               min=1,
+               help=u._("Page size of 'marker' paging when no 'limit' "
+                        "URL parameter is given.")),
+    cfg.IntOpt('max_limit_paging', default=1000,
+               min=1,
+               help=u._("Maximum page size for the 'limit' paging URL "
+                        "parameter.")),
 ]
 
 host_opts = [
@@ -224,12 +442,16 @@ host_opts = [
 def list_opts():
     yield None, context_opts
     yield None, common_opts
+    yield None, paging_opts
     yield None, host_opts
     yield None, _options.eventlet_backdoor_opts
     yield queue_opt_group, queue_opts
     yield ks_queue_opt_group, ks_queue_opts
     yield cleaner_opt_group, cleaner_opts
     yield worker_opt_group, worker_opts
+    yield keystone_cache_opt_group, keystone_cache_opts
+    yield http_opt_group, http_opts
+    yield metrics_opt_group, metrics_opts
     yield mail_opt_group, mail_opts
 
 
@@ -285,6 +507,7 @@ def new_config():
     log.register_options(conf)
     conf.register_opts(context_opts)
     conf.register_opts(common_opts)
+    conf.register_opts(paging_opts)
     conf.register_opts(host_opts)
     conf.register_opts(_options.eventlet_backdoor_opts)
     conf.register_opts(_options.periodic_opts)
@@ -296,6 +519,9 @@ def new_config():
     conf.register_opts(ks_queue_opts, group=ks_queue_opt_group)
     conf.register_opts(cleaner_opts, group=cleaner_opt_group)
     conf.register_opts(worker_opts, group=worker_opt_group)
+    conf.register_opts(keystone_cache_opts, group=keystone_cache_opt_group)
+    conf.register_opts(http_opts, group=http_opt_group)
+    conf.register_opts(metrics_opts, group=metrics_opt_group)
     conf.register_opts(mail_opts, group=mail_opt_group)
 
     # Update default values from libraries that carry their own oslo.config
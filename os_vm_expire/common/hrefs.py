@@ -9,6 +9,8 @@
 #  WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 #  License for the specific language governing permissions and limitations
 #  under the License.
+from six.moves.urllib import parse
+
 from os_vm_expire.common import utils
 
 
@@ -33,18 +35,21 @@ def convert_to_hrefs(fields):
     return fields
 
 
-def convert_list_to_href(resources_name, offset, limit):
+def convert_list_to_href(resources_name, offset, limit, params=None):
     """Supports pretty output of paged-list hrefs.
 
     Convert the offset/limit info to a HATEOAS-style href
     suitable for use in a list navigation paging interface.
+    :param params: optional dict of other query parameters (filters, sort)
     """
     resource = '{0}?limit={1}&offset={2}'.format(resources_name, limit,
                                                  offset)
+    if params:
+        resource += '&' + parse.urlencode(sorted(params.items()))
     return utils.hostname_for_refs(resource=resource)
 
 
-def previous_href(resources_name, offset, limit):
+def previous_href(resources_name, offset, limit, params=None):
     """Supports pretty output of previous-page hrefs.
 
     Create a HATEOAS-style 'previous' href suitable for use in a list
@@ -52,10 +57,10 @@ def previous_href(resources_name, offset, limit):
     currently viewed page.
     """
     offset = max(0, offset - limit)
-    return convert_list_to_href(resources_name, offset, limit)
+    return convert_list_to_href(resources_name, offset, limit, params)
 
 
-def next_href(resources_name, offset, limit):
+def next_href(resources_name, offset, limit, params=None):
     """Supports pretty output of next-page hrefs.
 
     Create a HATEOAS-style 'next' href suitable for use in a list
@@ -63,27 +68,49 @@ def next_href(resources_name, offset, limit):
     currently viewed page.
     """
     offset = offset + limit
-    return convert_list_to_href(resources_name, offset, limit)
+    return convert_list_to_href(resources_name, offset, limit, params)
 
 
 def add_nav_hrefs(resources_name, offset, limit,
-                  total_elements, data):
+                  total_elements, data, params=None):
     """Adds next and/or previous hrefs to paged list responses.
 
     :param resources_name: Name of api resource
     :param offset: Element number (ie. index) where current page starts
     :param limit: Max amount of elements listed on current page
     :param total_elements: Total number of elements
+    :param params: optional dict of other query parameters to keep in hrefs
     :returns: augmented dictionary with next and/or previous hrefs
     """
     if offset > 0:
         data.update({'previous': previous_href(resources_name,
                                                offset,
-                                               limit)})
+                                               limit,
+                                               params)})
     if total_elements > (offset + limit):
         data.update({'next': next_href(resources_name,
                                        offset,
-                                       limit)})
+                                       limit,
+                                       params)})
+    return data
+
+
+def add_marker_nav_hrefs(resources_name, marker, limit, count, data,
+                         params=None):
+    """Adds next href to keyset (marker) paged list responses.
+
+    :param resources_name: Name of api resource
+    :param marker: id of the last element of current page
+    :param limit: Max amount of elements listed on current page
+    :param count: number of elements listed on current page
+    :param params: optional dict of other query parameters to keep in hrefs
+    :returns: augmented dictionary with next href
+    """
+    if marker and count >= limit:
+        params = dict(params or {}, marker=marker)
+        resource = '{0}?limit={1}&{2}'.format(
+            resources_name, limit, parse.urlencode(sorted(params.items())))
+        data.update({'next': utils.hostname_for_refs(resource=resource)})
     return data
 
 
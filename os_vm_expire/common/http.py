@@ -0,0 +1,103 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+HTTP client shared by calls to Keystone and Nova.
+"""
+import threading
+
+import requests
+from requests import adapters
+from urllib3.util import retry
+
+from os_vm_expire.common import config
+from os_vm_expire.common import utils
+
+LOG = utils.getLogger(__name__)
+
+# Responses retried for idempotent requests
+RETRY_STATUSES = (500, 502, 503, 504)
+RETRY_METHODS = frozenset(['GET', 'HEAD', 'DELETE', 'PUT', 'OPTIONS'])
+
+_SESSION = None
+_SESSION_LOCK = threading.Lock()
+
+
+def _get_retry(conf_http):
+    kwargs = {
+        'total': conf_http.retries,
+        'backoff_factor': conf_http.retry_backoff,
+        'status_forcelist': RETRY_STATUSES,
+        # give the last response back instead of raising
+        'raise_on_status': False,
+    }
+    try:
+        return retry.Retry(allowed_methods=RETRY_METHODS, **kwargs)
+    except TypeError:
+        # urllib3 < 1.26
+        return retry.Retry(method_whitelist=RETRY_METHODS, **kwargs)
+
+
+def _create_session():
+    conf_http = config.CONF.http
+    session = requests.Session()
+    adapter = adapters.HTTPAdapter(pool_connections=conf_http.pool_size,
+                                   pool_maxsize=conf_http.pool_size,
+                                   max_retries=_get_retry(conf_http))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_session():
+    """Get the process wide pooled HTTP session."""
+    global _SESSION
+    if _SESSION is None:
+        with _SESSION_LOCK:
+            if _SESSION is None:
+                _SESSION = _create_session()
+    return _SESSION
+
+
+def reset():
+    """Close the pooled connections, a new session is created on next use."""
+    global _SESSION
+    with _SESSION_LOCK:
+        if _SESSION is not None:
+            _SESSION.close()
+        _SESSION = None
+
+
+def request(method, url, **kwargs):
+    """Send a request over the pooled session, with default timeouts.
+
+    :param method: http method (get, post, delete...)
+    :param url: url to query
+    :returns: requests response
+    """
+    conf_http = config.CONF.http
+    kwargs.setdefault('timeout', (conf_http.connect_timeout,
+                                  conf_http.read_timeout))
+    return get_session().request(method, url, **kwargs)
+
+
+def get(url, **kwargs):
+    return request('get', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('post', url, **kwargs)
+
+
+def delete(url, **kwargs):
+    return request('delete', url, **kwargs)
@@ -0,0 +1,279 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Keystone helpers shared by the API, worker and cleaner services.
+"""
+import calendar
+import threading
+import time
+
+from oslo_utils import timeutils
+import requests
+
+from os_vm_expire.common import cache
+from os_vm_expire.common import config
+from os_vm_expire.common import http
+from os_vm_expire.common import metrics
+from os_vm_expire.common import utils
+
+LOG = utils.getLogger(__name__)
+
+# Lifetime assumed for tokens when keystone does not give expires_at
+DEFAULT_TOKEN_LIFETIME = 3600
+
+_TOKEN_CACHES = {}
+_TOKEN_CACHES_LOCK = threading.Lock()
+
+_METADATA_CACHES = {}
+
+JSON_HEADERS = {
+    'Content-Type': 'application/json',
+    'Accept': 'application/json'
+}
+
+
+def _get_auth_request(conf_group):
+    return {
+        'auth': {
+            'scope':
+                {'project': {
+                    'name': conf_group.admin_service,
+                    'domain':
+                        {
+                            'name': conf_group.admin_project_domain_name
+                        }
+                    }
+                 },
+            'identity': {
+                    'password': {
+                        'user': {
+                            'domain': {
+                                'name': conf_group.admin_user_domain_name
+                            },
+                            'password': conf_group.admin_password,
+                            'name': conf_group.admin_user
+                        }
+                    },
+                    'methods': ['password']
+                }
+        }
+    }
+
+
+def _get_expires_at(response):
+    """Get token expiration timestamp from a keystone auth response."""
+    try:
+        expires_at = response.json()['token']['expires_at']
+        return calendar.timegm(
+            timeutils.parse_isotime(expires_at).utctimetuple()
+        )
+    except Exception:
+        LOG.debug('No expires_at in keystone token, using default lifetime')
+        return time.time() + DEFAULT_TOKEN_LIFETIME
+
+
+class TokenCache(object):
+    """Caches the keystone token of a service account.
+
+    The token is shared by all threads of the process and renewed
+    [keystone_cache] token_refresh_before seconds before it expires.
+    Authentication is serialized so that a burst of callers triggers a
+    single keystone request.
+
+    :param group_name: config group holding the service credentials
+                       (cleaner or worker)
+    """
+
+    def __init__(self, group_name):
+        self.group_name = group_name
+        self._lock = threading.Lock()
+        self._token = None
+        self._expires_at = 0
+
+    def _is_valid(self):
+        refresh_before = config.CONF.keystone_cache.token_refresh_before
+        if self._token is None:
+            return False
+        return time.time() < self._expires_at - refresh_before
+
+    def _authenticate(self):
+        conf_group = getattr(config.CONF, self.group_name)
+        try:
+            with metrics.remote_call('keystone', 'auth'):
+                r = http.post(conf_group.auth_uri + '/auth/tokens',
+                              json=_get_auth_request(conf_group))
+        except requests.exceptions.RequestException:
+            LOG.exception('Could not get authorization')
+            return None, 0
+        if 'X-Subject-Token' not in r.headers:
+            LOG.error('Could not get authorization')
+            metrics.REMOTE_CALL_ERRORS.inc(service='keystone',
+                                           operation='auth')
+            return None, 0
+        return r.headers['X-Subject-Token'], _get_expires_at(r)
+
+    def get_token(self):
+        """Get a valid token, authenticating if needed."""
+        if self._is_valid():
+            return self._token
+        with self._lock:
+            if not self._is_valid():
+                LOG.debug('Renew keystone token for %s', self.group_name)
+                self._token, self._expires_at = self._authenticate()
+            return self._token
+
+    def invalidate(self, token=None):
+        """Drop the cached token.
+
+        :param token: only drop the cached token if it is this one, so that
+                      concurrent callers do not renew it several times
+        """
+        with self._lock:
+            if token is None or token == self._token:
+                self._token = None
+                self._expires_at = 0
+
+
+def get_token_cache(group_name):
+    """Get the process wide token cache for a service account."""
+    if group_name not in _TOKEN_CACHES:
+        with _TOKEN_CACHES_LOCK:
+            if group_name not in _TOKEN_CACHES:
+                _TOKEN_CACHES[group_name] = TokenCache(group_name)
+    return _TOKEN_CACHES[group_name]
+
+
+def get_token(group_name):
+    """Get a token for the service account defined in group_name."""
+    return get_token_cache(group_name).get_token()
+
+
+def _send(service, method, url, **kwargs):
+    with metrics.remote_call(service, method):
+        r = getattr(http, method)(url, **kwargs)
+    return metrics.check_response(service, method, r)
+
+
+def request(method, url, group_name, token=None, headers=None,
+            service='keystone', **kwargs):
+    """Send an authenticated request to an openstack service.
+
+    If the token is rejected (401), it is renewed and the request is
+    sent once again.
+
+    :param method: http method (get, post, delete...)
+    :param url: url to query
+    :param group_name: config group holding the service credentials
+    :param token: token to use, defaults to the cached one
+    :param service: name of the queried service in metrics
+    :returns: requests response or None if no token could be obtained
+    """
+    token_cache = get_token_cache(group_name)
+    if token is None:
+        token = token_cache.get_token()
+    if not token:
+        return None
+    headers = dict(headers or {})
+    headers['X-Auth-Token'] = token
+    r = _send(service, method, url, headers=headers, **kwargs)
+    if r.status_code == 401:
+        LOG.info('Token rejected, renewing it for %s', group_name)
+        token_cache.invalidate(token)
+        token = token_cache.get_token()
+        if not token:
+            return r
+        headers = dict(headers, **{'X-Auth-Token': token})
+        r = _send(service, method, url, headers=headers, **kwargs)
+    return r
+
+
+def get_metadata_cache(name):
+    """Get the process wide cache for keystone objects of a type."""
+    if name not in _METADATA_CACHES:
+        with _TOKEN_CACHES_LOCK:
+            if name not in _METADATA_CACHES:
+                conf_cache = config.CONF.keystone_cache
+                _METADATA_CACHES[name] = cache.LRUCache(
+                    name,
+                    conf_cache.metadata_cache_size,
+                    conf_cache.metadata_cache_ttl,
+                    negative_ttl=conf_cache.metadata_negative_ttl
+                )
+    return _METADATA_CACHES[name]
+
+
+def _get_object_cache(object_type, object_id, group_name):
+    """Get the metadata cache and cache key of a keystone object."""
+    ks_uri = getattr(config.CONF, group_name).auth_uri
+    return (get_metadata_cache(object_type), (ks_uri, str(object_id)))
+
+
+def _cache_object(object_type, metadata_cache, key, r):
+    """Cache a keystone object from its response.
+
+    Objects not found (404) are cached too, other errors are not.
+    :returns: object dict or None
+    """
+    if r is None:
+        return None
+    if r.status_code == 404:
+        metadata_cache.set(key, None, negative=True)
+        return None
+    if r.status_code != 200:
+        return None
+    obj = (r.json() or {}).get(object_type)
+    metadata_cache.set(key, obj)
+    return obj
+
+
+def _get_object(object_type, object_id, group_name, token=None):
+    """Get a keystone object (project, user) through the metadata cache.
+
+    :returns: object dict or None
+    """
+    metadata_cache, key = _get_object_cache(object_type, object_id,
+                                            group_name)
+    obj = metadata_cache.get(key)
+    if obj is not cache.MISSING:
+        return obj
+    r = request('get', '%s/%ss/%s' % (key[0], object_type, object_id),
+                group_name, token=token, headers=JSON_HEADERS)
+    return _cache_object(object_type, metadata_cache, key, r)
+
+
+def get_project(project_id, group_name, token=None):
+    """Get a keystone project, cached.
+
+    :param project_id: keystone project id
+    :param group_name: config group holding the service credentials
+    :param token: token to use, defaults to the cached one
+    :returns: project dict or None if not found
+    """
+    return _get_object('project', project_id, group_name, token=token)
+
+
+def get_user(user_id, group_name, token=None):
+    """Get a keystone user, cached.
+
+    :param user_id: keystone user id
+    :param group_name: config group holding the service credentials
+    :param token: token to use, defaults to the cached one
+    :returns: user dict or None if not found
+    """
+    return _get_object('user', user_id, group_name, token=token)
+
+
+def log_cache_stats():
+    for metadata_cache in _METADATA_CACHES.values():
+        metadata_cache.log_stats()
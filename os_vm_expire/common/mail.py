@@ -0,0 +1,156 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+SMTP sessions reused to send several messages.
+"""
+import contextlib
+import smtplib
+import socket
+import threading
+import time
+
+from six.moves import queue
+
+from os_vm_expire.common import config
+from os_vm_expire.common import metrics
+from os_vm_expire.common import utils
+
+LOG = utils.getLogger(__name__)
+
+# Errors after which the connection is dropped and opened again
+CONNECTION_ERRORS = (smtplib.SMTPServerDisconnected,
+                     smtplib.SMTPConnectError,
+                     smtplib.SMTPHeloError,
+                     socket.error)
+
+
+class SMTPSession(object):
+    """An SMTP connection kept open between messages.
+
+    The connection is opened on first use and renewed after
+    [smtp] email_smtp_max_messages messages or on connection errors.
+    """
+
+    def __init__(self):
+        self._smtp = None
+        self._count = 0
+
+    def _connect(self):
+        conf_smtp = config.CONF.smtp
+        smtp = smtplib.SMTP(conf_smtp.email_smtp_host,
+                            conf_smtp.email_smtp_port,
+                            timeout=conf_smtp.email_smtp_timeout)
+        if conf_smtp.email_smtp_tls:
+            smtp.starttls()
+        if conf_smtp.email_smtp_user:
+            smtp.login(conf_smtp.email_smtp_user,
+                       conf_smtp.email_smtp_password)
+        self._smtp = smtp
+        self._count = 0
+
+    def close(self):
+        if self._smtp is None:
+            return
+        try:
+            self._smtp.quit()
+        except Exception:
+            LOG.debug('Error closing SMTP connection', exc_info=True)
+        self._smtp = None
+
+    def sendmail(self, sender, to, message):
+        """Send a message, reconnecting once if the connection was lost."""
+        if self._count >= config.CONF.smtp.email_smtp_max_messages:
+            self.close()
+        for attempt in (1, 2):
+            if self._smtp is None:
+                self._connect()
+            try:
+                self._smtp.sendmail(sender, to, message)
+                self._count += 1
+                return
+            except CONNECTION_ERRORS:
+                self._smtp = None
+                if attempt == 2:
+                    raise
+                LOG.info('SMTP connection lost, reconnecting')
+
+
+class SMTPPool(object):
+    """Bounded pool of SMTP sessions shared by the cleaner green threads.
+
+    :param size: maximum number of open connections, defaults to
+                 [smtp] email_smtp_pool_size
+    """
+
+    def __init__(self, size=None):
+        self.size = size or config.CONF.smtp.email_smtp_pool_size
+        self._sessions = queue.LifoQueue()
+        for _ in range(self.size):
+            self._sessions.put(SMTPSession())
+        self._lock = threading.Lock()
+        self.sent = 0
+        self.failures = 0
+        self.send_time = 0.0
+        self.max_send_time = 0.0
+
+    @contextlib.contextmanager
+    def session(self):
+        smtp_session = self._sessions.get()
+        try:
+            yield smtp_session
+        finally:
+            self._sessions.put(smtp_session)
+
+    def sendmail(self, sender, to, message):
+        """Send a message over one of the pooled connections."""
+        start = time.time()
+        try:
+            with self.session() as smtp_session:
+                smtp_session.sendmail(sender, to, message)
+        except Exception:
+            with self._lock:
+                self.failures += 1
+            raise
+        duration = time.time() - start
+        with self._lock:
+            self.sent += 1
+            self.send_time += duration
+            self.max_send_time = max(self.max_send_time, duration)
+
+    def close(self):
+        """Close all connections, the pool can still be used afterwards."""
+        sessions = [self._sessions.get() for _ in range(self.size)]
+        for smtp_session in sessions:
+            smtp_session.close()
+            self._sessions.put(smtp_session)
+
+    def log_stats(self):
+        average = self.send_time / self.sent if self.sent else 0
+        LOG.info('SMTP: %(sent)d messages sent, %(failures)d failures, '
+                 'send time avg %(avg).3fs max %(max).3fs',
+                 {'sent': self.sent, 'failures': self.failures,
+                  'avg': average, 'max': self.max_send_time})
+
+
+def sendmail(sender, to, message, pool=None):
+    """Send a message over a pool, or over a one-off connection."""
+    with metrics.remote_call('smtp', 'sendmail'):
+        if pool is not None:
+            pool.sendmail(sender, to, message)
+            return
+        smtp_session = SMTPSession()
+        try:
+            smtp_session.sendmail(sender, to, message)
+        finally:
+            smtp_session.close()
@@ -0,0 +1,281 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Process metrics in the Prometheus text exposition format.
+
+Metrics are kept in memory by each process: the API exposes them with the
+metrics paste filter, the worker and cleaner with a small HTTP listener
+([metrics] worker_port and cleaner_port).
+"""
+import contextlib
+import functools
+import socket
+import threading
+import time
+from wsgiref import simple_server
+
+from os_vm_expire.common import utils
+
+LOG = utils.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Upper bounds in seconds of the latency histograms buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0, 60.0, 300.0)
+
+_REGISTRY = []
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', '\\\\')
+                     .replace('"', '\\"').replace('\n', '\\n'))
+        for (name, value) in zip(names, values))
+
+
+class Metric(object):
+    """Base class of metrics, values are stored per label values.
+
+    :param name: metric name
+    :param documentation: help text
+    :param labelnames: names of the labels given to inc or observe
+    """
+
+    metric_type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _REGISTRY.append(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError('%s expects labels %s' % (
+                self.name, ', '.join(self.labelnames)))
+        return tuple(labels[name] for name in self.labelnames)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def _samples(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation),
+                 '# TYPE %s %s' % (self.name, self.metric_type)]
+        with self._lock:
+            lines.extend(self._samples())
+        return lines
+
+
+class Counter(Metric):
+    """Value which only goes up."""
+
+    metric_type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self):
+        return ['%s%s %s' % (self.name, _format_labels(self.labelnames, key),
+                             _format_value(value))
+                for (key, value) in sorted(self._values.items())]
+
+
+class Histogram(Metric):
+    """Distribution of observed values, usually durations in seconds."""
+
+    metric_type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(
+                key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    def get_count(self, **labels):
+        counts, _ = self._values.get(self._key(labels), ([0], 0.0))
+        return counts[-1]
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Observe the duration of the with block."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def _samples(self):
+        samples = []
+        names = self.labelnames + ('le',)
+        for key, (counts, total) in sorted(self._values.items()):
+            for bound, count in zip(self.buckets, counts):
+                samples.append('%s_bucket%s %s' % (
+                    self.name,
+                    _format_labels(names, key + (_format_value(bound),)),
+                    _format_value(count)))
+            labels = _format_labels(self.labelnames, key)
+            samples.append('%s_count%s %s' % (
+                self.name, labels, _format_value(counts[-1])))
+            samples.append('%s_sum%s %s' % (
+                self.name, labels, _format_value(total)))
+        return samples
+
+
+NOTIFICATIONS = Counter(
+    'osvmexpire_notifications_total',
+    'Nova notifications processed by the worker',
+    ['event_type', 'status'])
+NOTIFICATION_SECONDS = Histogram(
+    'osvmexpire_notification_seconds',
+    'Duration of the processing of a Nova notification by the worker',
+    ['event_type'])
+DB_QUERY_SECONDS = Histogram(
+    'osvmexpire_db_query_seconds',
+    'Duration of repository methods',
+    ['repository', 'method'])
+SLOW_QUERIES = Counter(
+    'osvmexpire_db_slow_queries_total',
+    'SQL statements slower than [metrics] slow_query_threshold, per '
+    'repository method',
+    ['method'])
+REMOTE_CALL_SECONDS = Histogram(
+    'osvmexpire_remote_call_seconds',
+    'Duration of Keystone, Nova and SMTP calls',
+    ['service', 'operation'])
+REMOTE_CALL_ERRORS = Counter(
+    'osvmexpire_remote_call_errors_total',
+    'Keystone, Nova and SMTP calls failed or answered with a 5xx status',
+    ['service', 'operation'])
+CLEANER_PASS_SECONDS = Histogram(
+    'osvmexpire_cleaner_pass_seconds',
+    'Duration of cleaner passes')
+CLEANER_ROWS = Counter(
+    'osvmexpire_cleaner_rows_total',
+    'Expirations read by the cleaner, per stage',
+    ['stage'])
+API_REQUEST_SECONDS = Histogram(
+    'osvmexpire_api_request_seconds',
+    'Duration of API requests per controller method',
+    ['controller', 'method', 'status'])
+
+
+@contextlib.contextmanager
+def remote_call(service, operation):
+    """Time a call to Keystone, Nova or SMTP, exceptions count as errors."""
+    start = time.time()
+    try:
+        yield
+    except Exception:
+        REMOTE_CALL_ERRORS.inc(service=service, operation=operation)
+        raise
+    finally:
+        REMOTE_CALL_SECONDS.observe(time.time() - start, service=service,
+                                    operation=operation)
+
+
+def check_response(service, operation, r):
+    """Count missing or 5xx responses as errors, returns the response."""
+    if r is None or r.status_code >= 500:
+        REMOTE_CALL_ERRORS.inc(service=service, operation=operation)
+    return r
+
+
+def timed(histogram, **labels):
+    """Decorator observing the duration of each call of a function."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with histogram.time(**labels):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def render():
+    """Get all the metrics in the Prometheus text format."""
+    lines = []
+    for metric in _REGISTRY:
+        lines.extend(metric.render())
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def clear():
+    """Reset all the metrics."""
+    for metric in _REGISTRY:
+        metric.clear()
+
+
+def metrics_app(environ, start_response):
+    """WSGI application serving the metrics on any path."""
+    body = render()
+    start_response('200 OK', [('Content-Type', CONTENT_TYPE),
+                              ('Content-Length', str(len(body)))])
+    return [body]
+
+
+class _QuietHandler(simple_server.WSGIRequestHandler):
+    def log_message(self, format, *args):
+        LOG.debug('metrics: ' + format, *args)
+
+
+def start_http_server(host, port):
+    """Serve the metrics over HTTP in a background thread.
+
+    :returns: the server, or None if port is 0 or already in use
+    """
+    if not port:
+        return None
+    try:
+        server = simple_server.make_server(host, port, metrics_app,
+                                           handler_class=_QuietHandler)
+    except socket.error:
+        # with several worker processes, only the first one gets the port
+        LOG.warning('Could not serve metrics on %s:%d', host, port,
+                    exc_info=True)
+        return None
+    thread = threading.Thread(target=server.serve_forever,
+                              name='metrics')
+    thread.daemon = True
+    thread.start()
+    LOG.info('Serving metrics on http://%s:%d/metrics', host, port)
+    return server
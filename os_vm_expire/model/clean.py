@@ -17,6 +17,7 @@
 from os_vm_expire.common import config
 from os_vm_expire.model import models
 from os_vm_expire.model import repositories as repo
+from oslo_db import options
 from oslo_log import log
 from oslo_utils import timeutils
 
@@ -30,11 +31,16 @@ log.setup(CONF, 'osvmexpire')
 LOG = log.getLogger(__name__)
 
 
-def cleanup_softdeletes(model, threshold_date=None):
+def cleanup_softdeletes(model, threshold_date=None, batch_size=None,
+                        sleep=None):
     """Remove soft deletions from a table.
 
+    Rows are deleted by batches, each batch being committed.
     :param model: table class to remove soft deletions
     :param threshold_date: soft deletions older than this date will be removed
+    :param batch_size: rows per batch, defaults to CONF.db_delete_batch_size
+    :param sleep: seconds to wait between batches, defaults to
+                  CONF.db_delete_batch_sleep
     :returns: total number of entries removed from the database
     """
     LOG.debug("Cleaning soft deletes: %s", model.__name__)
@@ -43,38 +49,48 @@ def cleanup_softdeletes(model, threshold_date=None):
     query = query.filter_by(deleted=True)
     if threshold_date:
         query = query.filter(model.deleted_at <= threshold_date)
-    delete_count = query.delete()
+    delete_count = repo.delete_in_batches(query, batch_size=batch_size,
+                                          sleep=sleep, session=session)
     LOG.info("Cleaned up %(delete_count)s entries for %(model_name)s",
              {'delete_count': delete_count,
               'model_name': model.__name__})
     return delete_count
 
 
-def cleanup_all(threshold_date=None):
+def cleanup_all(threshold_date=None, batch_size=None, sleep=None):
     """Clean up the main soft deletable resources.
 
     This function contains an order of calls to
     clean up the soft-deletable resources.
     :param threshold_date: soft deletions older than this date will be removed
+    :param batch_size: rows per delete batch
+    :param sleep: seconds to wait between delete batches
     :returns: total number of entries removed from the database
     """
     LOG.debug("Cleaning up soft deletions where deletion date"
               " is older than %s", str(threshold_date))
     total = 0
     total += cleanup_softdeletes(models.VmExpire,
-                                 threshold_date=threshold_date)
+                                 threshold_date=threshold_date,
+                                 batch_size=batch_size,
+                                 sleep=sleep)
 
     LOG.info("Cleaned up %s soft deleted entries", total)
     return total
 
 
-def clean_command(sql_url, min_num_days, verbose, log_file):
+def clean_command(sql_url, min_num_days, verbose, log_file,
+                  batch_size=None, sleep=None):
     """Clean command to clean up the database.
 
     :param sql_url: sql connection string to connect to a database
     :param min_num_days: clean up soft deletions older than this date
     :param verbose: If True, log and print more information
     :param log_file: If set, override the log_file configured
+    :param batch_size: rows per delete batch, defaults to
+                       CONF.db_delete_batch_size
+    :param sleep: seconds to wait between delete batches, defaults to
+                  CONF.db_delete_batch_sleep
     """
     if verbose:
         # The verbose flag prints out log events to the screen, otherwise
@@ -93,7 +109,9 @@ def clean_command(sql_url, min_num_days, verbose, log_file):
     stop_watch.start()
     try:
         if sql_url:
-            CONF.set_override('sql_connection', sql_url)
+            # the [database] options are registered by oslo.db
+            options.set_defaults(CONF)
+            CONF.set_override('connection', sql_url, group='database')
         repo.setup_database_engine_and_factory()
 
         threshold_date = None
@@ -102,7 +120,9 @@ def clean_command(sql_url, min_num_days, verbose, log_file):
                 days=min_num_days)
         else:
             threshold_date = current_time
-        cleanup_total += cleanup_all(threshold_date=threshold_date)
+        cleanup_total += cleanup_all(threshold_date=threshold_date,
+                                     batch_size=batch_size,
+                                     sleep=sleep)
         repo.commit()
 
     except Exception as ex:
@@ -121,7 +141,7 @@ def clean_command(sql_url, min_num_days, verbose, log_file):
         repo.clear()
 
         if sql_url:
-            CONF.clear_override('sql_connection')
+            CONF.clear_override('connection', group='database')
 
         log.setup(CONF, 'osvmexpire')  # reset the overrides
 
@@ -0,0 +1,55 @@
+# Copyright 2026 OpenStack Foundation
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+"""create exclude version table
+
+Revision ID: 0917a70dbfbc
+Revises: 3cf9516e9a67
+Create Date: 2026-10-18 09:12:41.104277
+
+"""
+import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '0917a70dbfbc'
+down_revision = '3cf9516e9a67'
+
+
+def upgrade():
+    ctx = op.get_context()
+    con = op.get_bind()
+    table_exists = ctx.dialect.has_table(con, 'vmexclude_version')
+    if not table_exists:
+        table = op.create_table(
+            'vmexclude_version',
+            sa.Column('id', sa.String(length=36), nullable=False),
+            sa.Column('created_at', sa.DateTime(), nullable=False),
+            sa.Column('updated_at', sa.DateTime(), nullable=False),
+            sa.Column('deleted_at', sa.DateTime(), nullable=True),
+            sa.Column('deleted', sa.Boolean(), nullable=False),
+            sa.Column('version', sa.Integer, index=False, nullable=False),
+            sa.PrimaryKeyConstraint('id'),
+        )
+        now = datetime.datetime.utcnow()
+        op.bulk_insert(table, [{
+            'id': 'vmexclude',
+            'created_at': now,
+            'updated_at': now,
+            'deleted': False,
+            'version': 0
+        }])
@@ -0,0 +1,52 @@
+# Copyright 2026 OpenStack Foundation
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+"""add vmexpire shard hash
+
+Revision ID: 4b8d2f9a6c13
+Revises: c7e1d94a2f68
+Create Date: 2026-10-18 19:05:12.384716
+
+"""
+import zlib
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '4b8d2f9a6c13'
+down_revision = 'c7e1d94a2f68'
+
+
+def upgrade():
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+    columns = [column['name'] for column in inspector.get_columns('vmexpire')]
+    if 'shard_hash' not in columns:
+        op.add_column('vmexpire', sa.Column('shard_hash', sa.BigInteger,
+                                            nullable=True))
+
+    # models.get_shard_hash of the existing rows
+    vmexpire = sa.table('vmexpire', sa.column('id'),
+                        sa.column('instance_id'), sa.column('shard_hash'))
+    rows = bind.execute(
+        sa.select([vmexpire.c.id, vmexpire.c.instance_id]).where(
+            vmexpire.c.shard_hash.is_(None))
+    ).fetchall()
+    for (entity_id, instance_id) in rows:
+        bind.execute(vmexpire.update().where(
+            vmexpire.c.id == entity_id
+        ).values(
+            shard_hash=zlib.crc32(instance_id.encode('utf-8')) & 0xffffffff))
@@ -0,0 +1,43 @@
+# Copyright 2026 OpenStack Foundation
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+"""add cleaner indexes
+
+Revision ID: 5d1c3b8e2a47
+Revises: 0917a70dbfbc
+Create Date: 2026-10-18 14:02:19.538120
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '5d1c3b8e2a47'
+down_revision = '0917a70dbfbc'
+
+INDEXES = [
+    ('ix_vmexpire_expire_notified', 'vmexpire',
+     ['expire', 'notified', 'notified_last']),
+    ('ix_vmexpire_user_id', 'vmexpire', ['user_id']),
+    ('ix_vmexclude_exclude_id', 'vmexclude', ['exclude_id']),
+]
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    for name, table, columns in INDEXES:
+        existing = [index['name'] for index in inspector.get_indexes(table)]
+        if name not in existing:
+            op.create_index(name, table, columns, unique=False)
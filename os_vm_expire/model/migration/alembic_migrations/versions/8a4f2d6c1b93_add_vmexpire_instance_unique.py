@@ -0,0 +1,56 @@
+# Copyright 2026 OpenStack Foundation
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+"""add vmexpire instance unique constraint
+
+Revision ID: 8a4f2d6c1b93
+Revises: 5d1c3b8e2a47
+Create Date: 2026-10-18 17:41:05.214387
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '8a4f2d6c1b93'
+down_revision = '5d1c3b8e2a47'
+
+
+def upgrade():
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+    existing = [uc['name'] for uc in
+                inspector.get_unique_constraints('vmexpire')]
+    if '_vmexpire_uc' in existing:
+        return
+
+    # keep the most recent expiration of duplicated instances
+    vmexpire = sa.table('vmexpire', sa.column('id'),
+                        sa.column('instance_id'), sa.column('created_at'))
+    duplicates = bind.execute(
+        sa.select([vmexpire.c.instance_id]).group_by(
+            vmexpire.c.instance_id
+        ).having(sa.func.count() > 1)
+    ).fetchall()
+    for (instance_id,) in duplicates:
+        ids = [row[0] for row in bind.execute(
+            sa.select([vmexpire.c.id]).where(
+                vmexpire.c.instance_id == instance_id
+            ).order_by(vmexpire.c.created_at.desc())
+        )]
+        bind.execute(vmexpire.delete().where(vmexpire.c.id.in_(ids[1:])))
+
+    with op.batch_alter_table('vmexpire') as batch_op:
+        batch_op.create_unique_constraint('_vmexpire_uc', ['instance_id'])
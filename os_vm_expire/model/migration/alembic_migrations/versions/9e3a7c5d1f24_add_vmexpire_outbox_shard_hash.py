@@ -0,0 +1,53 @@
+# Copyright 2026 OpenStack Foundation
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+"""add vmexpire outbox shard hash
+
+Revision ID: 9e3a7c5d1f24
+Revises: 4b8d2f9a6c13
+Create Date: 2026-10-18 19:41:37.905128
+
+"""
+import zlib
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '9e3a7c5d1f24'
+down_revision = '4b8d2f9a6c13'
+
+
+def upgrade():
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+    columns = [column['name'] for column in
+               inspector.get_columns('vmexpire_outbox')]
+    if 'shard_hash' not in columns:
+        op.add_column('vmexpire_outbox',
+                      sa.Column('shard_hash', sa.BigInteger, nullable=True))
+
+    # models.get_shard_hash of the existing rows
+    outbox = sa.table('vmexpire_outbox', sa.column('id'),
+                      sa.column('instance_id'), sa.column('shard_hash'))
+    rows = bind.execute(
+        sa.select([outbox.c.id, outbox.c.instance_id]).where(
+            outbox.c.shard_hash.is_(None))
+    ).fetchall()
+    for (entity_id, instance_id) in rows:
+        bind.execute(outbox.update().where(
+            outbox.c.id == entity_id
+        ).values(
+            shard_hash=zlib.crc32(instance_id.encode('utf-8')) & 0xffffffff))
@@ -0,0 +1,61 @@
+# Copyright 2026 OpenStack Foundation
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+"""create outbox table
+
+Revision ID: c7e1d94a2f68
+Revises: 8a4f2d6c1b93
+Create Date: 2026-10-18 18:20:37.649031
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'c7e1d94a2f68'
+down_revision = '8a4f2d6c1b93'
+
+
+def upgrade():
+    ctx = op.get_context()
+    con = op.get_bind()
+    table_exists = ctx.dialect.has_table(con, 'vmexpire_outbox')
+    if not table_exists:
+        op.create_table(
+            'vmexpire_outbox',
+            sa.Column('id', sa.String(length=36), nullable=False),
+            sa.Column('created_at', sa.DateTime(), nullable=False),
+            sa.Column('updated_at', sa.DateTime(), nullable=False),
+            sa.Column('deleted_at', sa.DateTime(), nullable=True),
+            sa.Column('deleted', sa.Boolean(), nullable=False),
+            sa.Column('idempotency_key', sa.String(length=255),
+                      nullable=False),
+            sa.Column('action', sa.String(length=32), nullable=False),
+            sa.Column('vmexpire_id', sa.String(length=36), nullable=False),
+            sa.Column('instance_id', sa.String(length=255), nullable=False),
+            sa.Column('instance_name', sa.String(length=255),
+                      nullable=True),
+            sa.Column('project_id', sa.String(length=255), nullable=False),
+            sa.Column('user_id', sa.String(length=255), nullable=False),
+            sa.Column('expire', sa.Integer, nullable=False),
+            sa.Column('attempts', sa.Integer, nullable=False),
+            sa.Column('next_attempt', sa.Integer, nullable=False),
+            sa.Column('last_error', sa.String(length=255), nullable=True),
+            sa.PrimaryKeyConstraint('id'),
+            sa.UniqueConstraint('idempotency_key',
+                                name='_vmexpire_outbox_uc')
+        )
+        op.create_index('ix_vmexpire_outbox_next_attempt',
+                        'vmexpire_outbox', ['next_attempt'], unique=False)
@@ -17,6 +17,8 @@
 """
 Defines database models for osvmexpire
 """
+import zlib
+
 from oslo_serialization import jsonutils as json
 from oslo_utils import timeutils
 import six
@@ -179,6 +181,15 @@ class SoftDeleteMixIn(object):
         self._do_delete_children(session)
 
 
+def get_shard_hash(instance_id):
+    """Stable hash of an instance id, spreading VMs over cleaner shards."""
+    return zlib.crc32(instance_id.encode('utf-8')) & 0xffffffff
+
+
+def _default_shard_hash(context):
+    return get_shard_hash(context.get_current_parameters()['instance_id'])
+
+
 class VmExpire(BASE, ModelBase):
     """Represents a VM."""
 
@@ -191,7 +202,7 @@ class VmExpire(BASE, ModelBase):
         sa.String(255), index=True,
         nullable=False)
     user_id = sa.Column(
-        sa.String(255), index=False,
+        sa.String(255), index=True,
         nullable=False)
     expire = sa.Column(
         sa.Integer, index=False,
@@ -209,9 +220,16 @@ class VmExpire(BASE, ModelBase):
     instance_name = sa.Column(
         sa.String(255), index=False,
         nullable=True)
+    # get_shard_hash of instance_id, cleaners select their shard in SQL
+    shard_hash = sa.Column(
+        sa.BigInteger, index=False,
+        nullable=True, default=_default_shard_hash)
 
     __table_args__ = (sa.UniqueConstraint('instance_id',
-                                          name='_vmexpire_uc'),)
+                                          name='_vmexpire_uc'),
+                      # cleaner scans expire ranges and filters on state
+                      sa.Index('ix_vmexpire_expire_notified',
+                               'expire', 'notified', 'notified_last'),)
 
     def __init__(self, parsed_request=None):
         """Creates secret from a dict."""
@@ -238,7 +256,7 @@ class VmExclude(BASE, ModelBase):
     __tablename__ = 'vmexclude'
 
     exclude_id = sa.Column(
-        sa.String(255), index=False,
+        sa.String(255), index=True,
         nullable=False)
     exclude_type = sa.Column(
         sa.Integer, index=False,
@@ -255,3 +273,88 @@ class VmExclude(BASE, ModelBase):
             'exclude_id': self.exclude_id,
             'exclude_type': self.exclude_type
         }
+
+
+class VmExcludeVersion(BASE, ModelBase):
+    """Version of the exclusions, incremented on each exclusion change."""
+
+    __tablename__ = 'vmexclude_version'
+
+    version = sa.Column(
+        sa.Integer, index=False,
+        nullable=False, default=0)
+
+    def _do_extra_dict_fields(self):
+        """Sub-class hook method: return dict of fields."""
+        return {
+            'id': self.id,
+            'version': self.version
+        }
+
+
+class VmExpireOutbox(BASE, ModelBase):
+    """Cleaner action waiting to be executed, or retried.
+
+    VM data is copied so that deletion notices can be sent once the
+    expiration is deleted.
+    """
+
+    __tablename__ = 'vmexpire_outbox'
+
+    idempotency_key = sa.Column(
+        sa.String(255), index=False,
+        nullable=False)
+    action = sa.Column(
+        sa.String(32), index=False,
+        nullable=False)
+    vmexpire_id = sa.Column(
+        sa.String(36), index=False,
+        nullable=False)
+    instance_id = sa.Column(
+        sa.String(255), index=False,
+        nullable=False)
+    instance_name = sa.Column(
+        sa.String(255), index=False,
+        nullable=True)
+    project_id = sa.Column(
+        sa.String(255), index=False,
+        nullable=False)
+    user_id = sa.Column(
+        sa.String(255), index=False,
+        nullable=False)
+    expire = sa.Column(
+        sa.Integer, index=False,
+        nullable=False)
+    attempts = sa.Column(
+        sa.Integer, index=False,
+        nullable=False, default=0)
+    next_attempt = sa.Column(
+        sa.Integer, index=True,
+        nullable=False)
+    # get_shard_hash of instance_id, cleaners drain their shard in SQL
+    shard_hash = sa.Column(
+        sa.BigInteger, index=False,
+        nullable=True, default=_default_shard_hash)
+    last_error = sa.Column(
+        sa.String(255), index=False,
+        nullable=True)
+
+    __table_args__ = (sa.UniqueConstraint('idempotency_key',
+                                          name='_vmexpire_outbox_uc'),)
+
+    def _do_extra_dict_fields(self):
+        """Sub-class hook method: return dict of fields."""
+        return {
+            'id': self.id,
+            'idempotency_key': self.idempotency_key,
+            'action': self.action,
+            'vmexpire_id': self.vmexpire_id,
+            'instance_id': self.instance_id,
+            'instance_name': self.instance_name,
+            'project_id': self.project_id,
+            'user_id': self.user_id,
+            'expire': self.expire,
+            'attempts': self.attempts,
+            'next_attempt': self.next_attempt,
+            'last_error': self.last_error
+        }
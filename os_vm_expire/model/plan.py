@@ -0,0 +1,96 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Cleaner pass planning.
+
+Counts what a cleaner pass would do without running it. This module has no
+import side effect, unlike os_vm_expire.cmd.cleaner which monkey patches
+the standard library, so that management commands can use it.
+"""
+import collections
+import datetime
+import time
+
+import prettytable
+
+from os_vm_expire.common import config
+from os_vm_expire.model import repositories
+
+# Actions a cleaner pass can take on an expiring VM
+NOTIFY_FIRST = 'notify_first'
+NOTIFY_LAST = 'notify_last'
+DELETE = 'delete'
+
+
+def get_check_times(now):
+    """Get the expiration limits of first and last notices."""
+    conf_cleaner = config.CONF.cleaner
+    return (now + (conf_cleaner.notify_before_days * 3600 * 24),
+            now + (conf_cleaner.notify_before_days_last * 3600 * 24))
+
+
+def get_plan(now=None):
+    """Count the actions of a cleaner pass without running them.
+
+    VMs are counted per project and user with a single aggregated query on
+    the stage criteria of the cleaner. Remote calls are upper bounds,
+    Keystone projects and users being cached between passes, and VMs are
+    counted whatever their cleaner shard.
+    :returns: dict with the (project_id, user_id, first notices, last
+              notices, deletions) 'rows', the 'totals' per action and the
+              remote 'calls' per service
+    """
+    conf_cleaner = config.CONF.cleaner
+    now = now or int(time.mktime(datetime.datetime.now().timetuple()))
+    check_time, last_check_time = get_check_times(now)
+    rows = repositories.get_vmexpire_repository().get_plan_counts(
+        now, check_time, last_check_time,
+        now - conf_cleaner.notify_before_days * 3600 * 24)
+    totals = collections.OrderedDict(
+        (action, sum(row[i] for row in rows))
+        for (i, action) in enumerate((NOTIFY_FIRST, NOTIFY_LAST, DELETE), 2))
+    projects = set(row[0] for row in rows)
+    users = set(row[1] for row in rows)
+    if conf_cleaner.email_digest:
+        mails = len(users)
+    else:
+        # deleted VMs get a deletion notice
+        mails = sum(totals.values())
+    calls = collections.OrderedDict([
+        ('keystone', 1 + len(projects) + len(users)),
+        ('nova', totals[DELETE]),
+        ('smtp', mails),
+    ])
+    return {'rows': rows, 'totals': totals, 'calls': calls}
+
+
+def format_plan(cleaner_plan):
+    """Get the text report of a plan."""
+    pt = prettytable.PrettyTable(['project.id', 'user.id', 'first notices',
+                                  'last notices', 'deletions'])
+    for row in cleaner_plan['rows']:
+        pt.add_row(row)
+    totals = cleaner_plan['totals']
+    calls = cleaner_plan['calls']
+    lines = [
+        pt.get_string(),
+        '%d first notices, %d last notices, %d deletions' % (
+            totals[NOTIFY_FIRST], totals[NOTIFY_LAST], totals[DELETE]),
+        'At most %d Keystone, %d Nova and %d SMTP calls' % (
+            calls['keystone'], calls['nova'], calls['smtp']),
+    ]
+    shard_count = config.CONF.cleaner.shard_count
+    if shard_count > 1:
+        lines.append('Counts cover the %d cleaner shards' % shard_count)
+    return '\n'.join(lines)
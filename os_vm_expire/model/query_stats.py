@@ -0,0 +1,268 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Per statement SQL timing.
+
+Statements are timed with the engine cursor events and tagged with the
+repository method running them. Statements slower than [metrics]
+slow_query_threshold are logged, and durations are aggregated per
+statement fingerprint, the aggregates being logged by a timer every
+[metrics] query_stats_interval seconds.
+"""
+import collections
+import contextlib
+import re
+import threading
+import time
+
+from sqlalchemy import event
+
+from os_vm_expire.common import config
+from os_vm_expire.common import metrics
+from os_vm_expire.common import utils
+
+LOG = utils.getLogger(__name__)
+
+CONF = config.CONF
+
+# Tag of the statements not run by a repository method
+UNTAGGED = '-'
+
+# Execution options of the queries returned by repository methods
+TAG_OPTION = 'osvmexpire_tag'
+LABELS_OPTION = 'osvmexpire_labels'
+
+# Number of recent durations kept per fingerprint for the percentiles
+SAMPLE_SIZE = 1000
+
+_FINGERPRINT_RULES = [
+    (re.compile(r"'(?:[^']|'')*'"), '?'),
+    (re.compile(r'%\(\w+\)s|%s|:\w+|\$\d+'), '?'),
+    (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),
+    (re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)'), '(?+)'),
+    (re.compile(r'\s+'), ' '),
+]
+
+_local = threading.local()
+
+
+def fingerprint(statement):
+    """Get the statement with literals and parameters replaced by ?
+
+    Expanded IN lists become (?+) so that statements only differing by
+    their number of parameters share the same fingerprint.
+    """
+    for (pattern, replacement) in _FINGERPRINT_RULES:
+        statement = pattern.sub(replacement, statement)
+    return statement.strip()
+
+
+def current_tag():
+    """Get the repository method running statements in this thread."""
+    return getattr(_local, 'tag', UNTAGGED)
+
+
+@contextlib.contextmanager
+def tagged(tag):
+    """Tag the statements run in the with block, innermost tag wins."""
+    previous = current_tag()
+    _local.tag = tag
+    try:
+        yield
+    finally:
+        _local.tag = previous
+
+
+def tag_query(query, tag, labels):
+    """Tag the statements of a query whenever it is executed.
+
+    The tag is kept by the queries derived from it. Their statements
+    durations are observed in osvmexpire_db_query_seconds with labels.
+    """
+    return query.execution_options(**{TAG_OPTION: tag,
+                                      LABELS_OPTION: labels})
+
+
+def _percentile(sorted_values, percent):
+    index = int(round(percent / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+class StatementStats(object):
+    """Durations of the statements sharing a fingerprint."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.tags = collections.Counter()
+        self.samples = collections.deque(maxlen=SAMPLE_SIZE)
+
+    def add(self, duration, tag):
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+        self.tags[tag] += 1
+        self.samples.append(duration)
+
+    def percentile(self, percent):
+        return _percentile(sorted(self.samples), percent)
+
+
+class QueryStats(object):
+    """Statement aggregates, reset each time they are dumped.
+
+    :param interval: seconds between dumps, 0 to not aggregate. Dumps are
+                     run by a timer, see add_dump_timer
+    :param top: number of fingerprints dumped, by total time
+    """
+
+    def __init__(self, interval, top=10):
+        self.interval = interval
+        self.top = top
+        self.statements = {}
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def add(self, statement, duration, tag):
+        if not self.interval:
+            return
+        key = fingerprint(statement)
+        with self._lock:
+            stats = self.statements.get(key)
+            if stats is None:
+                stats = self.statements[key] = StatementStats()
+            stats.add(duration, tag)
+
+    def reset(self):
+        """Get and clear the aggregates."""
+        with self._lock:
+            statements, self.statements = self.statements, {}
+            self.started = time.time()
+        return statements
+
+    def dump(self):
+        """Log the aggregates of the most expensive statements."""
+        statements = self.reset()
+        if not statements:
+            return
+        ranked = sorted(statements.items(), key=lambda item: -item[1].total)
+        LOG.info('SQL statements: %(count)d executions of %(fingerprints)d '
+                 'fingerprints, top %(top)d by total time',
+                 {'count': sum(s.count for s in statements.values()),
+                  'fingerprints': len(statements),
+                  'top': min(self.top, len(ranked))})
+        for (key, stats) in ranked[:self.top]:
+            LOG.info('SQL %(count)d x total %(total).3fs p50 %(p50).3fs '
+                     'p99 %(p99).3fs max %(max).3fs by %(tags)s: %(sql)s',
+                     {'count': stats.count, 'total': stats.total,
+                      'p50': stats.percentile(50),
+                      'p99': stats.percentile(99), 'max': stats.max,
+                      'tags': ', '.join(tag for (tag, _) in
+                                        stats.tags.most_common(3)),
+                      'sql': key})
+
+
+_STATS = None
+
+
+def get_stats():
+    return _STATS
+
+
+def dump_stats():
+    """Log the aggregates of the current window, if any."""
+    if _STATS is not None:
+        _STATS.dump()
+
+
+def add_dump_timer(tg):
+    """Dump the aggregates every [metrics] query_stats_interval seconds.
+
+    :param tg: thread group of the oslo.service service running the timer
+    """
+    interval = CONF.metrics.query_stats_interval
+    if interval:
+        tg.add_timer(interval, dump_stats, initial_delay=interval)
+
+
+def _dump_forever(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            dump_stats()
+        except Exception:
+            LOG.exception('Could not log the SQL statements aggregates')
+
+
+def start_dump_thread():
+    """Dump the aggregates from a daemon thread, for WSGI processes.
+
+    :returns: the thread, None when the aggregates are disabled
+    """
+    interval = CONF.metrics.query_stats_interval
+    if not interval:
+        return None
+    thread = threading.Thread(target=_dump_forever, args=(interval,),
+                              name='query-stats-dump')
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    if context is not None:
+        context.query_start_time = time.time()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    start = getattr(context, 'query_start_time', None)
+    if start is None:
+        return
+    duration = time.time() - start
+    options = context.execution_options
+    tag = options.get(TAG_OPTION) or current_tag()
+    if options.get(LABELS_OPTION):
+        metrics.DB_QUERY_SECONDS.observe(duration, **options[LABELS_OPTION])
+    threshold = CONF.metrics.slow_query_threshold
+    if threshold and duration >= threshold:
+        metrics.SLOW_QUERIES.inc(method=tag)
+        LOG.warning('Slow SQL statement, %(duration).3fs in %(tag)s: '
+                    '%(sql)s', {'duration': duration, 'tag': tag,
+                                'sql': fingerprint(statement)})
+    if _STATS is not None:
+        _STATS.add(statement, duration, tag)
+
+
+def setup(engine):
+    """Time the statements of the engine according to [metrics] options.
+
+    Statements are always timed, the queries returned by repository
+    methods being observed when executed.
+    """
+    global _STATS
+
+    conf_metrics = CONF.metrics
+    if _STATS is not None:
+        _STATS.dump()
+    _STATS = None
+    if conf_metrics.query_stats_interval:
+        _STATS = QueryStats(conf_metrics.query_stats_interval,
+                            conf_metrics.query_stats_top)
+    if not event.contains(engine, 'before_cursor_execute',
+                          _before_cursor_execute):
+        event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
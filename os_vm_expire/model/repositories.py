@@ -20,27 +20,37 @@ TODO: The top part of this file was 'borrowed' from Glance, but seems
 quite intense for sqlalchemy, and maybe could be simplified.
 """
 
+import collections
 import datetime
+import functools
+import inspect
 import logging
 import re
+import sys
 import threading
 import time
 
 from oslo_db import exception as db_exc
 from oslo_db.sqlalchemy import session
+from oslo_db.sqlalchemy import utils as db_utils
 from oslo_utils import timeutils
 # from oslo_utils import uuidutils
-import requests
 import sqlalchemy
+from sqlalchemy.dialects import mysql
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects import sqlite
 # from sqlalchemy import func as sa_func
 # from sqlalchemy import or_
 import sqlalchemy.orm as sa_orm
 
 from os_vm_expire.common import config
+from os_vm_expire.common import keystone
+from os_vm_expire.common import metrics
 from os_vm_expire.common import utils
 from os_vm_expire import i18n as u
 from os_vm_expire.model.migration import commands
 from os_vm_expire.model import models
+from os_vm_expire.model import query_stats
 
 LOG = utils.getLogger(__name__)
 
@@ -52,9 +62,18 @@ sa_logger = None
 # Singleton repository references, instantiated via get_xxxx_repository()
 #   functions below.  Please keep this list in alphabetical order.
 _VMEXPIRE_REPOSITORY = None
+_OUTBOX_REPOSITORY = None
 
 CONF = config.CONF
 
+# Exclusion types
+EXCLUDE_DOMAIN = 0
+EXCLUDE_PROJECT = 1
+EXCLUDE_USER = 2
+
+# Id of the single row of the vmexclude_version table
+EXCLUDE_VERSION_ID = 'vmexclude'
+
 _FACADE = None
 _LOCK = threading.Lock()
 
@@ -93,6 +112,7 @@ def setup_database_engine_and_factory():
         sa_logger.setLevel(logging.DEBUG)
 
     _ENGINE = _get_engine(_ENGINE)
+    query_stats.setup(_ENGINE)
 
     # Utilize SQLAlchemy's scoped_session to ensure that we only have one
     # session instance per thread.
@@ -233,12 +253,103 @@ def wrap_db_error(f):
     return _wrap
 
 
+def shard_criteria(column, shard):
+    """Get the criteria selecting the rows of a cleaner shard.
+
+    Rows are spread with their models.get_shard_hash column, rows without
+    hash (inserted by an older version) belong to the first shard.
+    :param column: shard_hash column of the queried table
+    :param shard: (shard_index, shard_count), None for all the rows
+    :returns: list of criteria
+    """
+    if shard is None:
+        return []
+    shard_index, shard_count = shard
+    criterion = column % shard_count == shard_index
+    if shard_index == 0:
+        criterion = sqlalchemy.or_(criterion, column.is_(None))
+    return [criterion]
+
+
+def stream(query, batch_size=None):
+    """Iterate over query results fetching batch_size rows at a time.
+
+    Rows are read with a server side cursor when the driver supports it,
+    so memory does not grow with the number of results.
+    :param batch_size: rows per batch, defaults to CONF.db_batch_size
+    """
+    return query.yield_per(batch_size or CONF.db_batch_size)
+
+
+def delete_in_batches(query, batch_size=None, sleep=None, session=None):
+    """Delete the rows matched by a query, batch_size rows at a time.
+
+    Each batch is one DELETE on a list of ids, committed on its own, so
+    that a large deletion does not lock the table for long.
+    :param query: query selecting the rows of a model to delete
+    :param batch_size: rows per batch, defaults to CONF.db_delete_batch_size
+    :param sleep: seconds to wait between batches, defaults to
+                  CONF.db_delete_batch_sleep
+    :returns: number of deleted rows
+    """
+    session = session or get_session()
+    model = query.column_descriptions[0]['entity']
+    batch_size = batch_size or CONF.db_delete_batch_size
+    if sleep is None:
+        sleep = CONF.db_delete_batch_sleep
+    total = 0
+    while True:
+        ids = [row[0] for row in
+               query.with_entities(model.id).limit(batch_size)]
+        if not ids:
+            break
+        total += session.query(model).filter(
+            model.id.in_(ids)
+        ).delete(synchronize_session=False)
+        session.commit()
+        LOG.info("Deleted %(total)d %(model)s entries so far",
+                 {'total': total, 'model': model.__name__})
+        if len(ids) < batch_size:
+            break
+        if sleep:
+            time.sleep(sleep)
+    return total
+
+
+def clean_paging_values(offset_arg=0, limit_arg=None):
+    """Cleans and safely limits raw paging offset/limit values."""
+    offset_arg = offset_arg or 0
+    limit_arg = limit_arg or CONF.default_limit_paging
+
+    try:
+        offset = int(offset_arg)
+        if offset < 0:
+            offset = 0
+        if offset > sys.maxsize:
+            offset = 0
+    except ValueError:
+        offset = 0
+
+    try:
+        limit = int(limit_arg)
+        if limit < 1:
+            limit = 1
+        if limit > CONF.max_limit_paging:
+            limit = CONF.max_limit_paging
+    except ValueError:
+        limit = CONF.default_limit_paging
+
+    LOG.debug("Clean paging values limit=%(limit)s, offset=%(offset)s",
+              {'limit': limit, 'offset': offset})
+
+    return offset, limit
+
+
 def delete_all_project_resources(project_id):
     """Logic to cleanup all project resources.
 
-    This cleanup uses same alchemy session to perform all db operations as a
-    transaction and will commit only when all db operations are performed
-    without error.
+    Entities are deleted by batches of CONF.db_delete_batch_size rows, each
+    batch is committed on its own.
     """
     session = get_session()
 
@@ -248,72 +359,28 @@ def delete_all_project_resources(project_id):
 
 
 def get_identity_token():
-    conf_worker = config.CONF.worker
-    ks_uri = conf_worker.auth_uri
-
-    auth = {
-        'auth': {
-            'scope':
-                {'project': {
-                    'name': conf_worker.admin_service,
-                    'domain':
-                        {
-                            'name': conf_worker.admin_project_domain_name
-                        }
-                    }
-                 },
-            'identity': {
-                    'password': {
-                        'user': {
-                            'domain': {
-                                'name': conf_worker.admin_user_domain_name
-                            },
-                            'password': conf_worker.admin_password,
-                            'name': conf_worker.admin_user
-                        }
-                    },
-                    'methods': ['password']
-                }
-        }
-    }
-    r = requests.post(ks_uri + '/auth/tokens', json=auth)
-    if 'X-Subject-Token' not in r.headers:
-        LOG.error('Could not get authorization')
-        return None
-    token = r.headers['X-Subject-Token']
-    return token
+    return keystone.get_token('worker')
 
 
 def get_project_domain(project_id):
-    token = get_identity_token()
-    if not token:
-        return None
-    conf_worker = config.CONF.worker
-    ks_uri = conf_worker.auth_uri
-    headers = {
-        'X-Auth-Token': token,
-        'Content-Type': 'application/json'
-    }
-    r = requests.get(ks_uri + '/projects/' + str(project_id), headers=headers)
-    if not r.status_code == 200:
+    project = keystone.get_project(project_id, 'worker')
+    if not project:
         LOG.error('Failed to get domain_id for project ' + str(project_id))
         return None
-    project = r.json()
-    domain_id = project['project']['domain_id']
+    domain_id = project['domain_id']
     return domain_id
 
 
 def get_instance(instance_id):
-    token = get_identity_token()
-    if not token:
-        return None
     conf_worker = config.CONF.worker
     nv_uri = conf_worker.nova_url
     headers = {
-        'X-Auth-Token': token,
         'Content-Type': 'application/json'
     }
-    r = requests.get(nv_uri + '/servers/' + str(instance_id), headers=headers)
+    r = keystone.request('get', nv_uri + '/servers/' + str(instance_id),
+                         'worker', headers=headers, service='nova')
+    if r is None:
+        return None
     if not r.status_code == 200:
         LOG.error('Failed to get information for instance ' + str(instance_id))
         return None
@@ -328,6 +395,125 @@ def get_instance(instance_id):
     return data
 
 
+def list_instances(page_size=None, project_id=None):
+    """Iterate over all the instances known by Nova, page by page.
+
+    :param page_size: servers per request, defaults to
+                      CONF.worker.nova_page_size
+    :param project_id: only list the instances of this project
+    :raises Exception: if a page could not be fetched, so that callers
+                       never work on a partial listing
+    """
+    conf_worker = config.CONF.worker
+    page_size = page_size or conf_worker.nova_page_size
+    headers = {
+        'Content-Type': 'application/json'
+    }
+    marker = None
+    while True:
+        params = {'all_tenants': 1, 'limit': page_size}
+        if project_id:
+            params['project_id'] = project_id
+        if marker:
+            params['marker'] = marker
+        r = keystone.request('get', conf_worker.nova_url + '/servers/detail',
+                             'worker', headers=headers, params=params,
+                             service='nova')
+        if r is None or r.status_code != 200:
+            raise Exception(u._("Failed to list Nova servers"))
+        body = r.json()
+        servers = body.get('servers', [])
+        for server in servers:
+            yield {
+                'id': server['id'],
+                'display_name': server['name'],
+                'tenant_id': server['tenant_id'],
+                'user_id': server['user_id'],
+            }
+        # Nova caps pages to its own [api] max_limit, a short page is not
+        # the last one: stop on an empty page or when no next link is given
+        if not servers:
+            break
+        links = body.get('servers_links')
+        if links is not None and not any(
+                link.get('rel') == 'next' for link in links):
+            break
+        marker = servers[-1]['id']
+
+
+def get_vmexpire_values(instance_uuid, instance_data):
+    """Get the column values of a new expiration, for bulk inserts.
+
+    :param instance_data: instance dict as returned by get_instance
+    """
+    now = timeutils.utcnow()
+    expire = time.mktime(datetime.datetime.now().timetuple())
+    expire += CONF.max_vm_duration * 3600 * 24
+    return {
+        'id': utils.generate_uuid(),
+        'created_at': now,
+        'updated_at': now,
+        'deleted': False,
+        'instance_id': instance_uuid,
+        'instance_name': instance_data['display_name'],
+        'project_id': instance_data['tenant_id'],
+        'user_id': instance_data['user_id'],
+        'expire': int(expire),
+        'notified': False,
+        'notified_last': False,
+    }
+
+
+def _timed_method(fn, tag, labels):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        result = None
+        start = time.time()
+        try:
+            with query_stats.tagged(tag):
+                result = fn(*args, **kwargs)
+        finally:
+            streamed = isinstance(result, sa_orm.Query)
+            if not streamed:
+                metrics.DB_QUERY_SECONDS.observe(time.time() - start,
+                                                 **labels)
+        if streamed:
+            return query_stats.tag_query(result, tag, labels)
+        return result
+    return wrapper
+
+
+def _get_class_attribute(klass, name):
+    """Get an attribute as defined in the class or its bases dicts."""
+    for base in inspect.getmro(klass):
+        if name in vars(base):
+            return vars(base)[name]
+    return None
+
+
+def timed_repository(repo_class):
+    """Class decorator reporting the duration of repository methods.
+
+    Public methods, inherited ones included, are observed in the
+    osvmexpire_db_query_seconds metric, and the SQL statements they run
+    are tagged with the method name for the slow query log and statements
+    aggregates. Methods returning a query, such as streamed reads, run
+    their SQL once the caller executes the query: its statements are
+    tagged and observed instead, the query staying a Query.
+    """
+    for name in dir(repo_class):
+        if name.startswith('_') or name == 'get_session':
+            continue
+        # plain functions of the class dicts, static methods are skipped
+        fn = _get_class_attribute(repo_class, name)
+        if not inspect.isfunction(fn):
+            continue
+        labels = {'repository': repo_class.__name__, 'method': name}
+        setattr(repo_class, name, _timed_method(
+            fn, '%s.%s' % (repo_class.__name__, name), labels))
+    return repo_class
+
+
 class BaseRepo(object):
     """Base repository for the osvmexpire entities.
 
@@ -341,16 +527,34 @@ class BaseRepo(object):
         LOG.debug("Getting session...")
         return session or get_session()
 
-    def get_all_by(self, instance_id=None, project_id=None, session=None):
-        session = self.get_session(session)
+    def _build_all_by_query(self, instance_id, project_id, session,
+                            expire_before=None):
         query = session.query(models.VmExpire)
         if instance_id:
             query = query.filter_by(instance_id=instance_id)
         if project_id:
             query = query.filter_by(project_id=project_id)
+        if expire_before:
+            query = query.filter(models.VmExpire.expire <= expire_before)
+        return query
 
+    def get_all_by(self, instance_id=None, project_id=None, session=None):
+        session = self.get_session(session)
+        query = self._build_all_by_query(instance_id, project_id, session)
         return query.all()
 
+    def iter_all_by(self, instance_id=None, project_id=None,
+                    expire_before=None, batch_size=None, session=None):
+        """Iterate over expirations, reading them by batches.
+
+        :param expire_before: only VMs expiring at or before this timestamp
+        :param batch_size: rows per batch, defaults to CONF.db_batch_size
+        """
+        session = self.get_session(session)
+        query = self._build_all_by_query(instance_id, project_id, session,
+                                         expire_before=expire_before)
+        return stream(query.order_by(models.VmExpire.expire), batch_size)
+
     def get_by_instance(self, instance_id, session=None):
         session = self.get_session(session)
 
@@ -389,60 +593,31 @@ class BaseRepo(object):
     def add_vm(self, instance_uuid, session=None):
         session = self.get_session(session)
 
-        instance = None
-        try:
-            instance = self.get_by_instance(instance_uuid)
-        except Exception:
-            LOG.debug("Fine, instance does not already exists")
-        if instance:
-            LOG.warn("InstanceAlreadyExists:" +
-                     instance_uuid +
-                     ", deleting first"
-                     )
-            self.delete_entity_by_id(entity_id=instance.id)
-
         instance_data = get_instance(instance_uuid)
         if not instance_data:
             LOG.debug("Not found for %s", instance_uuid)
-            entity = None
             _raise_entity_not_found("Openstack instance", instance_uuid)
 
-        entity = models.VmExpire()
-        entity.instance_id = instance_uuid
-        entity.instance_name = instance_data["display_name"]
-
-        entity.project_id = instance_data["tenant_id"]
-        entity.user_id = instance_data["user_id"]
-        entity.expire = int(
-            time.mktime(datetime.datetime.now().timetuple()) +
-            (CONF.max_vm_duration * 3600 * 24)
-            )
-        entity.notified = False
-        entity.notified_last = False
-
         project_domain = None
         try:
-            project_domain = get_project_domain(entity.project_id)
+            project_domain = get_project_domain(instance_data["tenant_id"])
         except Exception:
             LOG.exception('Failed to get domain for project')
 
         exclude_repo = get_vmexclude_repository()
-        if project_domain:
-            exclude_id = exclude_repo.get_exclude_by_id(project_domain)
-            if exclude_id:
-                LOG.debug('domain %s is excluded, skipping' % (project_domain))
-                _raise_entity_invalid(instance_uuid, "domain is excluded")
-
-        exclude_id = exclude_repo.get_exclude_by_id(entity.project_id)
-        if exclude_id:
-            LOG.debug('project %s is excluded, skipping' % (entity.project_id))
-            _raise_entity_invalid(instance_uuid, "project is excluded")
-        exclude_id = exclude_repo.get_exclude_by_id(entity.user_id)
-        if exclude_id:
-            LOG.debug('user %s is excluded, skipping' % (entity.user_id))
-            _raise_entity_invalid(instance_uuid, "user is excluded")
-
-        instance = self.create_from(entity, session)
+        excluded = exclude_repo.get_excluded_type(
+            project_domain, instance_data["tenant_id"],
+            instance_data["user_id"], session=session)
+        if excluded:
+            LOG.debug('%s of %s is excluded, skipping' % (
+                excluded, instance_uuid))
+            _raise_entity_invalid(instance_uuid, "%s is excluded" % excluded)
+
+        # replaces the expiration if the instance is already tracked
+        self.upsert(get_vmexpire_values(instance_uuid, instance_data),
+                    session=session)
+        instance = session.query(models.VmExpire).filter_by(
+            instance_id=instance_uuid).populate_existing().one()
         LOG.debug("NewInstanceExpiration:" + instance_uuid)
         return instance
 
@@ -596,6 +771,19 @@ class BaseRepo(object):
         else:
             return []
 
+    def iter_project_entities(self, project_id, batch_size=None,
+                              session=None):
+        """Iterate over entities of a project, reading them by batches.
+
+        :param batch_size: rows per batch, defaults to CONF.db_batch_size
+        """
+        session = self.get_session(session)
+        query = self._build_get_project_entities_query(project_id, session)
+        if query:
+            return stream(query, batch_size)
+        else:
+            return iter([])
+
     def get_entities(self, expiration_filter=None, session=None):
         """Get all entities
 
@@ -615,6 +803,19 @@ class BaseRepo(object):
         else:
             return []
 
+    def iter_entities(self, expiration_filter=None, batch_size=None,
+                      session=None):
+        """Iterate over all entities, reading them by batches.
+
+        :param expiration_filter: timestamp to compare expiration date with
+        :param batch_size: rows per batch, defaults to CONF.db_batch_size
+        """
+        session = self.get_session(session)
+        query = session.query(models.VmExpire)
+        if expiration_filter:
+            query = query.filter(models.VmExpire.expire < expiration_filter)
+        return stream(query, batch_size)
+
     def get_count(self, project_id, session=None):
         """Gets count of entities associated with a given project
 
@@ -650,9 +851,9 @@ class BaseRepo(object):
         try:
             # query cannot be None as related repo class is expected to
             # implement it otherwise error is raised in build query call
-            for entity in query:
-                # Its a soft delete so its more like entity update
-                entity.delete(session=session)
+            count = delete_in_batches(query, session=session)
+            LOG.info('Deleted %(count)d entities for project %(project)s',
+                     {'count': count, 'project': project_id})
         except sqlalchemy.exc.SQLAlchemyError:
             LOG.exception('Problem finding project related entity to delete')
             if not suppress_exception:
@@ -662,9 +863,575 @@ class BaseRepo(object):
                                 project_id)
 
 
+@timed_repository
 class VmExpireRepo(BaseRepo):
     """Repository for the expire entity."""
 
+    # Columns the expiration list can be sorted on
+    SORT_KEYS = ('expire', 'created_at', 'updated_at', 'instance_id',
+                 'instance_name', 'project_id', 'user_id')
+
+    def get_vmexpire_list(self, project_id=None, offset_arg=None,
+                          limit_arg=None, marker=None, sort_key=None,
+                          sort_dir=None, expire_before=None, user_id=None,
+                          notified=None, session=None):
+        """Get a page of expirations, filtered and sorted in database.
+
+        :param project_id: only get expirations of this project, all
+                           projects if None
+        :param offset_arg: number of elements to skip
+        :param limit_arg: maximum number of elements to return, all the
+                          elements if None and no marker is given
+        :param marker: id of the last element of the previous page, used
+                       instead of offset for keyset pagination
+        :param sort_key: column to sort on, see SORT_KEYS
+        :param sort_dir: asc or desc
+        :param expire_before: only get VMs expiring before this timestamp
+        :param user_id: only get VMs of this user
+        :param notified: only get VMs (not) already notified
+        :param session: existing db session reference. If None, gets session.
+        :returns: tuple (entities, offset, limit, total), limit being None
+                  when all the elements are returned
+        :raises ValueError: on invalid sort or marker
+        """
+        offset, limit = clean_paging_values(offset_arg, limit_arg)
+        if limit_arg is None and not marker:
+            limit = None
+        sort_key = sort_key or 'expire'
+        sort_dir = sort_dir or 'asc'
+        if sort_key not in self.SORT_KEYS:
+            raise ValueError(u._("Invalid sort key {key}").format(
+                key=sort_key))
+        if sort_dir not in ('asc', 'desc'):
+            raise ValueError(u._("Invalid sort direction {dir}").format(
+                dir=sort_dir))
+
+        session = self.get_session(session)
+        query = session.query(models.VmExpire)
+        if project_id is not None:
+            query = query.filter_by(project_id=project_id)
+        if user_id is not None:
+            query = query.filter_by(user_id=user_id)
+        if notified is not None:
+            query = query.filter_by(notified=notified)
+        if expire_before is not None:
+            query = query.filter(models.VmExpire.expire < expire_before)
+
+        total = query.count()
+
+        marker_entity = None
+        if marker:
+            marker_entity = query.filter_by(id=marker).one_or_none()
+            if marker_entity is None:
+                raise ValueError(u._("Invalid marker {id}").format(id=marker))
+            offset = 0
+        query = db_utils.paginate_query(query, models.VmExpire, limit,
+                                        [sort_key, 'id'],
+                                        marker=marker_entity,
+                                        sort_dir=sort_dir)
+        if offset:
+            query = query.offset(offset)
+        entities = query.all()
+
+        LOG.debug('Expirations list, offset=%(offset)s limit=%(limit)s '
+                  'total=%(total)s',
+                  {'offset': offset, 'limit': limit, 'total': total})
+        return entities, offset, limit, total
+
+    def create_all(self, values, batch_size=None, commit=True,
+                   session=None):
+        """Insert expirations with one multi-row INSERT per batch.
+
+        Instances already having an expiration are skipped. Each batch is
+        committed on its own, unless commit is False: the caller then
+        commits and handles duplicate errors.
+        :param values: list of column values dicts, see get_vmexpire_values
+        :param batch_size: rows per INSERT, defaults to CONF.db_batch_size
+        :returns: list of inserted instance ids
+        """
+        session = self.get_session(session)
+        batch_size = batch_size or CONF.db_batch_size
+        table = models.VmExpire.__table__
+        inserted = []
+        for i in range(0, len(values), batch_size):
+            batch = values[i:i + batch_size]
+            existing = set(row[0] for row in session.query(
+                models.VmExpire.instance_id
+            ).filter(
+                models.VmExpire.instance_id.in_(
+                    [value['instance_id'] for value in batch])
+            ))
+            batch = [value for value in batch
+                     if value['instance_id'] not in existing]
+            if not batch:
+                continue
+            if not commit:
+                session.execute(table.insert().values(batch))
+                inserted.extend(value['instance_id'] for value in batch)
+                continue
+            try:
+                session.execute(table.insert().values(batch))
+                session.commit()
+            except (db_exc.DBDuplicateEntry, sqlalchemy.exc.IntegrityError):
+                # instance added meanwhile, next run will handle the batch
+                LOG.warning('Duplicate instance in bulk insert, skipping '
+                            '%d instances', len(batch))
+                session.rollback()
+                continue
+            inserted.extend(value['instance_id'] for value in batch)
+        return inserted
+
+    def upsert(self, values, session=None):
+        """Insert the expiration of an instance, or replace the existing one.
+
+        This is a single statement relying on the _vmexpire_uc unique
+        constraint, so concurrent workers cannot race: ON DUPLICATE KEY
+        UPDATE with MySQL, ON CONFLICT DO UPDATE with PostgreSQL and SQLite.
+        Other dialects fall back to a delete then an insert. The id of an
+        existing expiration is kept.
+        :param values: column values, see get_vmexpire_values
+        """
+        session = self.get_session(session)
+        table = models.VmExpire.__table__
+        dialect = session.get_bind().dialect.name
+        updated = dict((k, v) for k, v in values.items() if k != 'id')
+        if dialect == 'mysql':
+            statement = mysql.insert(table).values(
+                values).on_duplicate_key_update(**updated)
+        elif dialect in ('postgresql', 'sqlite'):
+            insert = (postgresql.insert if dialect == 'postgresql'
+                      else sqlite.insert)
+            statement = insert(table).values(values).on_conflict_do_update(
+                index_elements=[table.c.instance_id], set_=updated)
+        else:
+            self.delete_by_instance_ids([values['instance_id']],
+                                        session=session)
+            statement = table.insert().values(values)
+        session.execute(statement)
+
+    def delete_by_instance_id(self, instance_id, session=None):
+        """Delete the expiration of an instance with a single statement.
+
+        :returns: number of deleted rows, 0 if the instance is not tracked
+        """
+        session = self.get_session(session)
+        return session.query(models.VmExpire).filter_by(
+            instance_id=instance_id
+        ).delete(synchronize_session=False)
+
+    def delete_by_instance_ids(self, instance_ids, session=None):
+        """Delete the expirations of instances, without commit.
+
+        :returns: number of deleted rows
+        """
+        session = self.get_session(session)
+        deleted = 0
+        batch_size = CONF.db_batch_size
+        for i in range(0, len(instance_ids), batch_size):
+            deleted += session.query(models.VmExpire).filter(
+                models.VmExpire.instance_id.in_(
+                    instance_ids[i:i + batch_size])
+            ).delete(synchronize_session=False)
+        return deleted
+
+    def is_excluded(self, server, domains, session=None):
+        """Check an instance against exclusions.
+
+        :param server: instance dict with tenant_id and user_id
+        :param domains: cache of project id => domain id, filled as needed
+        :returns: exclusion type or None
+        """
+        project_id = server['tenant_id']
+        if project_id not in domains:
+            try:
+                domains[project_id] = get_project_domain(project_id)
+            except Exception:
+                LOG.exception('Failed to get domain for project')
+                domains[project_id] = None
+        return get_vmexclude_repository().get_excluded_type(
+            domains[project_id], project_id, server['user_id'],
+            session=session)
+
+    def add_vms(self, instance_uuids=None, project_id=None, session=None):
+        """Add expirations for several instances at once.
+
+        Instances are resolved from the paginated Nova listing instead of
+        one request per instance, checked against the in-memory exclusions
+        and inserted by batches with create_all.
+        :param instance_uuids: instances to add, all the instances of
+                               project_id if None
+        :param project_id: only consider instances of this project
+        :returns: list of dicts with instance_id, result (added, exists,
+                  excluded or not_found) and the expiration id if added
+        """
+        session = self.get_session(session)
+        servers = {}
+        remaining = None
+        if instance_uuids is not None:
+            instance_uuids = list(
+                collections.OrderedDict.fromkeys(instance_uuids))
+            remaining = set(instance_uuids)
+        if remaining is None or remaining:
+            for server in list_instances(project_id=project_id):
+                if remaining is None:
+                    servers[server['id']] = server
+                elif server['id'] in remaining:
+                    servers[server['id']] = server
+                    remaining.discard(server['id'])
+                    if not remaining:
+                        break
+        if instance_uuids is None:
+            instance_uuids = list(servers)
+
+        tracked = set()
+        batch_size = CONF.db_batch_size
+        for i in range(0, len(instance_uuids), batch_size):
+            tracked.update(row[0] for row in session.query(
+                models.VmExpire.instance_id
+            ).filter(
+                models.VmExpire.instance_id.in_(
+                    instance_uuids[i:i + batch_size])
+            ))
+
+        results = collections.OrderedDict()
+        values = []
+        domains = {}
+        for instance_uuid in instance_uuids:
+            result = {'instance_id': instance_uuid}
+            results[instance_uuid] = result
+            server = servers.get(instance_uuid)
+            if server is None:
+                result['result'] = 'not_found'
+            elif instance_uuid in tracked:
+                result['result'] = 'exists'
+            elif self.is_excluded(server, domains, session):
+                result['result'] = 'excluded'
+            else:
+                value = get_vmexpire_values(instance_uuid, server)
+                result['id'] = value['id']
+                values.append(value)
+
+        inserted = set(self.create_all(values, session=session))
+        for value in values:
+            result = results[value['instance_id']]
+            if value['instance_id'] in inserted:
+                result['result'] = 'added'
+            else:
+                # added by someone else meanwhile
+                result['result'] = 'exists'
+                del result['id']
+        LOG.info('Bulk add: %(added)d added out of %(total)d instances',
+                 {'added': len(inserted), 'total': len(results)})
+        return list(results.values())
+
+    def reconcile(self, dry_run=False, session=None):
+        """Sync expirations with the instances listed by Nova.
+
+        Expirations of instances unknown to Nova are removed and
+        expirations are created for instances not tracked yet, unless
+        excluded.
+        :param dry_run: only report what would be done
+        :returns: dict of removed, added and excluded instance ids
+        """
+        session = self.get_session(session)
+        # Read tracked instances before listing Nova, so that instances
+        # created in between are not seen as removed from Nova.
+        tracked = set(row[0] for row in stream(
+            session.query(models.VmExpire.instance_id)))
+        live = collections.OrderedDict(
+            (server['id'], server) for server in list_instances())
+        LOG.info('Reconcile: %(tracked)d tracked, %(live)d Nova instances',
+                 {'tracked': len(tracked), 'live': len(live)})
+
+        removed = sorted(tracked.difference(live))
+        excluded = []
+        values = []
+        domains = {}
+        for instance_uuid, server in live.items():
+            if instance_uuid in tracked:
+                continue
+            if self.is_excluded(server, domains, session):
+                excluded.append(instance_uuid)
+                continue
+            values.append(get_vmexpire_values(instance_uuid, server))
+
+        added = [value['instance_id'] for value in values]
+        if not dry_run:
+            batch_size = CONF.db_delete_batch_size
+            for i in range(0, len(removed), batch_size):
+                delete_in_batches(session.query(models.VmExpire).filter(
+                    models.VmExpire.instance_id.in_(
+                        removed[i:i + batch_size])),
+                    session=session)
+            added = self.create_all(values, session=session)
+        LOG.info('Reconcile: %(removed)d removed, %(added)d added, '
+                 '%(excluded)d excluded',
+                 {'removed': len(removed), 'added': len(added),
+                  'excluded': len(excluded)})
+        return {'removed': removed, 'added': added, 'excluded': excluded}
+
+    def _get_stage_query(self, session, *criteria):
+        """Query expirations in a cleaner stage, ordered by expiration."""
+        return session.query(models.VmExpire).filter(
+            *criteria
+        ).order_by(models.VmExpire.expire)
+
+    def get_first_notice_entities(self, check_time, batch_size=None,
+                                  shard=None, session=None):
+        """Get VMs expiring before check_time not notified yet.
+
+        Rows are streamed by batches of batch_size, CONF.db_batch_size by
+        default.
+        :param shard: (shard_index, shard_count) of the cleaner, None for
+                      all the VMs
+        """
+        session = self.get_session(session)
+        return stream(self._get_stage_query(
+            session,
+            models.VmExpire.notified == sqlalchemy.false(),
+            models.VmExpire.expire < check_time,
+            *shard_criteria(models.VmExpire.shard_hash, shard)
+        ), batch_size)
+
+    def get_last_notice_entities(self, last_check_time, batch_size=None,
+                                 shard=None, session=None):
+        """Get VMs expiring before last_check_time needing a last notice.
+
+        Rows are streamed by batches of batch_size, CONF.db_batch_size by
+        default.
+        :param shard: (shard_index, shard_count) of the cleaner, None for
+                      all the VMs
+        """
+        session = self.get_session(session)
+        return stream(self._get_stage_query(
+            session,
+            models.VmExpire.notified == sqlalchemy.true(),
+            models.VmExpire.notified_last == sqlalchemy.false(),
+            models.VmExpire.expire < last_check_time,
+            *shard_criteria(models.VmExpire.shard_hash, shard)
+        ), batch_size)
+
+    def get_deletion_entities(self, now, notified_before, batch_size=None,
+                              shard=None, session=None):
+        """Get expired VMs whose first notice was sent before notified_before.
+
+        Rows are streamed by batches of batch_size, CONF.db_batch_size by
+        default.
+        :param shard: (shard_index, shard_count) of the cleaner, None for
+                      all the VMs
+        """
+        session = self.get_session(session)
+        return stream(self._get_stage_query(
+            session,
+            models.VmExpire.notified == sqlalchemy.true(),
+            models.VmExpire.notified_last == sqlalchemy.true(),
+            models.VmExpire.expire < now,
+            models.VmExpire.notified_time <= notified_before,
+            *shard_criteria(models.VmExpire.shard_hash, shard)
+        ), batch_size)
+
+    def get_plan_counts(self, now, check_time, last_check_time,
+                        notified_before, session=None):
+        """Count the VMs of each cleaner stage per project and user.
+
+        Stages use the criteria of the get_first_notice_entities,
+        get_last_notice_entities and get_deletion_entities queries, counted
+        by a single aggregated query.
+        :returns: list of (project_id, user_id, first notices, last notices,
+                  deletions) ordered by project and user
+        """
+        session = self.get_session(session)
+        stages = [
+            sqlalchemy.and_(
+                models.VmExpire.notified == sqlalchemy.false(),
+                models.VmExpire.expire < check_time),
+            sqlalchemy.and_(
+                models.VmExpire.notified == sqlalchemy.true(),
+                models.VmExpire.notified_last == sqlalchemy.false(),
+                models.VmExpire.expire < last_check_time),
+            sqlalchemy.and_(
+                models.VmExpire.notified == sqlalchemy.true(),
+                models.VmExpire.notified_last == sqlalchemy.true(),
+                models.VmExpire.expire < now,
+                models.VmExpire.notified_time <= notified_before),
+        ]
+        query = session.query(
+            models.VmExpire.project_id,
+            models.VmExpire.user_id,
+            *[sqlalchemy.func.sum(sqlalchemy.case((stage, 1), else_=0))
+              for stage in stages]
+        ).filter(
+            sqlalchemy.or_(*stages)
+        ).group_by(
+            models.VmExpire.project_id, models.VmExpire.user_id
+        ).order_by(
+            models.VmExpire.project_id, models.VmExpire.user_id)
+        return [(project_id, user_id, int(first), int(last), int(deletions))
+                for (project_id, user_id, first, last, deletions) in query]
+
+    def get_due_times(self, before, notify_delay, last_notify_delay,
+                      limit=None, shard=None, session=None):
+        """Get the next due timestamps of cleaner actions.
+
+        Due times are computed like the cleaner stage queries: first notice
+        notify_delay seconds before expiration, last notice
+        last_notify_delay seconds before, deletion at expiration but not
+        before notify_delay seconds after the first notice.
+        :param before: only get the actions due before this timestamp
+        :param limit: maximum rows per stage, defaults to CONF.db_batch_size
+        :param shard: (shard_index, shard_count) of the cleaner, None for
+                      all the VMs
+        :returns: list of (due timestamp, expiration id, instance id)
+        """
+        session = self.get_session(session)
+        limit = limit or CONF.db_batch_size
+        columns = (models.VmExpire.id, models.VmExpire.instance_id,
+                   models.VmExpire.expire, models.VmExpire.notified_time)
+        stages = [
+            (lambda expire, notified_time: expire - notify_delay,
+             (models.VmExpire.notified == sqlalchemy.false(),
+              models.VmExpire.expire < before + notify_delay)),
+            (lambda expire, notified_time: expire - last_notify_delay,
+             (models.VmExpire.notified == sqlalchemy.true(),
+              models.VmExpire.notified_last == sqlalchemy.false(),
+              models.VmExpire.expire < before + last_notify_delay)),
+            (lambda expire, notified_time: max(
+                expire, (notified_time or 0) + notify_delay),
+             (models.VmExpire.notified == sqlalchemy.true(),
+              models.VmExpire.notified_last == sqlalchemy.true(),
+              models.VmExpire.expire < before)),
+        ]
+        due_times = []
+        for get_due, criteria in stages:
+            query = session.query(*columns).filter(
+                *(criteria + tuple(shard_criteria(models.VmExpire.shard_hash,
+                                                  shard)))
+            ).order_by(models.VmExpire.expire).limit(limit)
+            due_times.extend(
+                (get_due(expire, notified_time), entity_id, instance_id)
+                for entity_id, instance_id, expire, notified_time in query)
+        return due_times
+
+    def get_expires(self, entity_ids, session=None):
+        """Get the current expiration timestamp of expirations.
+
+        :returns: dict of expiration id => expire, missing ids are absent
+        """
+        session = self.get_session(session)
+        expires = {}
+        batch_size = CONF.db_batch_size
+        for i in range(0, len(entity_ids), batch_size):
+            expires.update(session.query(
+                models.VmExpire.id, models.VmExpire.expire
+            ).filter(
+                models.VmExpire.id.in_(entity_ids[i:i + batch_size])
+            ))
+        return expires
+
+    def set_missing_notified_time(self, now, session=None):
+        """Set notified_time of expired VMs notified before it existed.
+
+        :returns: number of updated rows
+        """
+        session = self.get_session(session)
+        return session.query(models.VmExpire).filter(
+            models.VmExpire.notified == sqlalchemy.true(),
+            models.VmExpire.notified_last == sqlalchemy.true(),
+            models.VmExpire.expire < now,
+            models.VmExpire.notified_time.is_(None)
+        ).update({'notified_time': now}, synchronize_session=False)
+
+    def set_notified(self, entity_id, notified_time=None, last=False,
+                     session=None):
+        """Record a first (or last if last is True) expiration notice."""
+        return self.set_notified_all([entity_id], notified_time=notified_time,
+                                     last=last, session=session)
+
+    def set_notified_all(self, entity_ids, notified_time=None, last=False,
+                         session=None):
+        """Record a first (or last) expiration notice for several VMs.
+
+        :returns: number of updated rows
+        """
+        session = self.get_session(session)
+        if last:
+            values = {'notified_last': True}
+        else:
+            values = {'notified': True, 'notified_time': notified_time}
+        values['updated_at'] = timeutils.utcnow()
+        return session.query(models.VmExpire).filter(
+            models.VmExpire.id.in_(entity_ids)
+        ).update(values, synchronize_session='evaluate')
+
+    def extend_vms(self, project_id=None, entity_ids=None, session=None):
+        """Extend several expirations with set-based updates.
+
+        Same rules as extend_vm: expirations are set max_vm_extend days
+        from now and notices are reset, unless the instance would then
+        exceed max_vm_total_duration. Those capped expirations are left
+        untouched and reported.
+        :param project_id: extend the expirations of this project
+        :param entity_ids: extend these expirations (of project_id if given)
+        :returns: dict with new expire and lists of extended, capped and
+                  not_found expiration ids
+        """
+        if project_id is None and entity_ids is None:
+            raise ValueError(u._('A project or expiration ids are required'))
+        session = self.get_session(session)
+        now = time.mktime(datetime.datetime.now().timetuple())
+        new_expire = int(now + CONF.max_vm_extend * 3600 * 24)
+        max_duration = datetime.timedelta(days=CONF.max_vm_total_duration)
+        created_after = datetime.datetime.fromtimestamp(new_expire)
+        created_after -= max_duration
+        values = {
+            'expire': new_expire,
+            'notified': False,
+            'notified_last': False,
+            'updated_at': timeutils.utcnow()
+        }
+
+        def _filter(query, ids=None):
+            query = query.filter(
+                models.VmExpire.deleted == sqlalchemy.false())
+            if project_id is not None:
+                query = query.filter(
+                    models.VmExpire.project_id == project_id)
+            if ids is not None:
+                query = query.filter(models.VmExpire.id.in_(ids))
+            return query
+
+        if entity_ids is None:
+            batches = [None]
+        else:
+            entity_ids = list(collections.OrderedDict.fromkeys(entity_ids))
+            batch_size = CONF.db_batch_size
+            batches = [entity_ids[i:i + batch_size]
+                       for i in range(0, len(entity_ids), batch_size)]
+        extended = []
+        capped = []
+        for ids in batches:
+            for entity_id, created_at in _filter(session.query(
+                    models.VmExpire.id, models.VmExpire.created_at), ids):
+                if created_at < created_after:
+                    capped.append(entity_id)
+                else:
+                    extended.append(entity_id)
+            _filter(session.query(models.VmExpire), ids).filter(
+                models.VmExpire.created_at >= created_after
+            ).update(values, synchronize_session=False)
+        not_found = []
+        if entity_ids is not None:
+            found = set(extended) | set(capped)
+            not_found = [i for i in entity_ids if i not in found]
+        LOG.info('Bulk extend: %(extended)d extended, %(capped)d capped',
+                 {'extended': len(extended), 'capped': len(capped)})
+        return {
+            'expire': new_expire,
+            'extended': extended,
+            'capped': capped,
+            'not_found': not_found
+        }
+
     def _do_entity_name(self):
         """Sub-class hook: return entity name, such as for debugging."""
         return "VMExpire"
@@ -703,6 +1470,214 @@ class VmExpireRepo(BaseRepo):
                 raise Exception(u._('Error deleting entities '))
 
 
+@timed_repository
+class VmExpireOutboxRepo(BaseRepo):
+    """Repository for the cleaner outbox."""
+
+    OUTBOX_FIELDS = ('vmexpire_id', 'instance_id', 'instance_name',
+                     'project_id', 'user_id', 'expire')
+
+    def _do_entity_name(self):
+        """Sub-class hook: return entity name, such as for debugging."""
+        return "VMExpireOutbox"
+
+    def _do_build_get_query(self, entity_id, session):
+        """Sub-class hook: build a retrieve query."""
+        query = session.query(models.VmExpireOutbox)
+        query = query.filter_by(id=entity_id)
+        return query
+
+    def _do_validate(self, values):
+        """Sub-class hook: validate values."""
+        pass
+
+    @staticmethod
+    def get_idempotency_key(action, vmexpire_id, expire):
+        """Key of an action, an action is queued once per expiration date."""
+        return '%s:%s:%d' % (action, vmexpire_id, expire)
+
+    def enqueue_all(self, actions, now, session=None):
+        """Queue actions, skipping those already queued, without commit.
+
+        :param actions: list of (action, values), values giving the
+                        OUTBOX_FIELDS of the VM
+        :param now: timestamp of the first attempt
+        :returns: number of queued actions
+        """
+        session = self.get_session(session)
+        created_at = timeutils.utcnow()
+        rows = collections.OrderedDict()
+        for action, values in actions:
+            key = self.get_idempotency_key(action, values['vmexpire_id'],
+                                           values['expire'])
+            row = dict((field, values[field]) for field in self.OUTBOX_FIELDS)
+            row.update({
+                'id': utils.generate_uuid(),
+                'created_at': created_at,
+                'updated_at': created_at,
+                'deleted': False,
+                'idempotency_key': key,
+                'action': action,
+                'attempts': 0,
+                'next_attempt': now,
+                'shard_hash': models.get_shard_hash(values['instance_id'])
+            })
+            rows[key] = row
+        rows = list(rows.values())
+        table = models.VmExpireOutbox.__table__
+        queued = 0
+        batch_size = CONF.db_batch_size
+        for i in range(0, len(rows), batch_size):
+            batch = rows[i:i + batch_size]
+            existing = set(row[0] for row in session.query(
+                models.VmExpireOutbox.idempotency_key
+            ).filter(
+                models.VmExpireOutbox.idempotency_key.in_(
+                    [row['idempotency_key'] for row in batch])
+            ))
+            batch = [row for row in batch
+                     if row['idempotency_key'] not in existing]
+            if batch:
+                session.execute(table.insert().values(batch))
+                queued += len(batch)
+        return queued
+
+    def get_ready(self, now, limit=None, shard=None, session=None):
+        """Get the actions to attempt now, oldest first.
+
+        :param shard: (shard_index, shard_count) of the cleaner, None for
+                      all the actions
+        """
+        session = self.get_session(session)
+        return session.query(models.VmExpireOutbox).filter(
+            models.VmExpireOutbox.next_attempt <= now,
+            *shard_criteria(models.VmExpireOutbox.shard_hash, shard)
+        ).order_by(
+            models.VmExpireOutbox.next_attempt
+        ).limit(limit or CONF.db_batch_size).all()
+
+    def get_next_attempts(self, before, limit=None, shard=None,
+                          session=None):
+        """Get the next attempt timestamps before a timestamp.
+
+        :param shard: (shard_index, shard_count) of the cleaner, None for
+                      all the actions
+        :returns: list of (next attempt, outbox id, instance id)
+        """
+        session = self.get_session(session)
+        return [tuple(row) for row in session.query(
+            models.VmExpireOutbox.next_attempt,
+            models.VmExpireOutbox.id,
+            models.VmExpireOutbox.instance_id
+        ).filter(
+            models.VmExpireOutbox.next_attempt < before,
+            *shard_criteria(models.VmExpireOutbox.shard_hash, shard)
+        ).order_by(
+            models.VmExpireOutbox.next_attempt
+        ).limit(limit or CONF.db_batch_size)]
+
+    def complete(self, entity_id, session=None):
+        """Remove a done action.
+
+        :returns: number of deleted rows
+        """
+        session = self.get_session(session)
+        return session.query(models.VmExpireOutbox).filter_by(
+            id=entity_id
+        ).delete(synchronize_session=False)
+
+    def retry_later(self, entity_id, attempts, now, error=None,
+                    session=None):
+        """Record a failed attempt and schedule the next one.
+
+        The delay doubles on each attempt, from [cleaner]
+        outbox_retry_backoff up to outbox_max_backoff seconds.
+        :param attempts: number of attempts before this one
+        :returns: timestamp of the next attempt
+        """
+        session = self.get_session(session)
+        conf_cleaner = CONF.cleaner
+        delay = min(conf_cleaner.outbox_retry_backoff * 2 ** attempts,
+                    conf_cleaner.outbox_max_backoff)
+        next_attempt = now + delay
+        session.query(models.VmExpireOutbox).filter_by(
+            id=entity_id
+        ).update({
+            'attempts': attempts + 1,
+            'next_attempt': next_attempt,
+            'last_error': error[:255] if error else None,
+            'updated_at': timeutils.utcnow()
+        }, synchronize_session=False)
+        return next_attempt
+
+    def delete_all_entities(self, suppress_exception=False, session=None):
+        """Deletes all entities.
+
+        :param suppress_exception: Pass True if want to suppress exception
+        :param session: existing db session reference. If None, gets session.
+        """
+        session = self.get_session(session)
+        try:
+            session.query(models.VmExpireOutbox).delete()
+        except sqlalchemy.exc.SQLAlchemyError:
+            LOG.exception('Problem deleting entities')
+            if not suppress_exception:
+                raise Exception(u._('Error deleting entities '))
+
+
+class ExcludeIndex(object):
+    """In-memory index of the exclusions, one set of ids per type.
+
+    The index is reloaded when the exclusions version stored in database
+    changes. The version is checked at most every exclude_refresh_interval
+    seconds, so lookups usually cost no query at all.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._excludes = None
+        self._version = None
+        self._checked_at = 0
+
+    def invalidate(self):
+        """Force a version check on next lookup."""
+        self._checked_at = 0
+
+    def _load(self, session):
+        excludes = {
+            EXCLUDE_DOMAIN: set(),
+            EXCLUDE_PROJECT: set(),
+            EXCLUDE_USER: set()
+        }
+        query = session.query(models.VmExclude.exclude_id,
+                              models.VmExclude.exclude_type)
+        for exclude_id, exclude_type in query:
+            excludes.setdefault(exclude_type, set()).add(exclude_id)
+        return excludes
+
+    def _is_fresh(self, interval):
+        if self._excludes is None:
+            return False
+        return time.time() - self._checked_at < interval
+
+    def get_excludes(self, session):
+        """Get exclusions as a dict of exclude type => set of ids."""
+        interval = CONF.exclude_refresh_interval
+        if self._is_fresh(interval):
+            return self._excludes
+        with self._lock:
+            if not self._is_fresh(interval):
+                exclude_repo = get_vmexclude_repository()
+                version = exclude_repo.get_version(session=session)
+                if self._excludes is None or version != self._version:
+                    LOG.debug('Loading exclusions, version %d', version)
+                    self._excludes = self._load(session)
+                    self._version = version
+                self._checked_at = time.time()
+        return self._excludes
+
+
+@timed_repository
 class VmExcludeRepo(BaseRepo):
     """Repository for the exclude entity."""
 
@@ -720,6 +1695,51 @@ class VmExcludeRepo(BaseRepo):
         """Sub-class hook: validate values."""
         pass
 
+    def get_version(self, session=None):
+        """Get current version of the exclusions."""
+        session = self.get_session(session)
+        version = session.query(models.VmExcludeVersion.version).filter_by(
+            id=EXCLUDE_VERSION_ID).scalar()
+        return version or 0
+
+    def bump_version(self, session=None):
+        """Increment version of the exclusions.
+
+        Must be called on every exclusion change, in the same transaction,
+        so that other processes reload their exclusion index.
+        """
+        session = self.get_session(session)
+        updated = session.query(models.VmExcludeVersion).filter_by(
+            id=EXCLUDE_VERSION_ID).update(
+                {'version': models.VmExcludeVersion.version + 1,
+                 'updated_at': timeutils.utcnow()},
+                synchronize_session=False)
+        if not updated:
+            entity = models.VmExcludeVersion()
+            entity.id = EXCLUDE_VERSION_ID
+            entity.version = 1
+            session.add(entity)
+            session.flush()
+        _EXCLUDE_INDEX.invalidate()
+
+    def get_excluded_type(self, domain_id, project_id, user_id, session=None):
+        """Check if a VM owner is excluded, using the exclusion index.
+
+        :param domain_id: domain of the VM project, may be None
+        :param project_id: project of the VM
+        :param user_id: owner of the VM
+        :return: name of the excluded type (domain, project, user) or None
+        """
+        session = self.get_session(session)
+        excludes = _EXCLUDE_INDEX.get_excludes(session)
+        if domain_id and domain_id in excludes[EXCLUDE_DOMAIN]:
+            return 'domain'
+        if project_id in excludes[EXCLUDE_PROJECT]:
+            return 'project'
+        if user_id in excludes[EXCLUDE_USER]:
+            return 'user'
+        return None
+
     def get_exclude_by_id(self, exclude_id, session=None):
         """Builds query for retrieving exclude related to given entity id.
 
@@ -743,6 +1763,19 @@ class VmExcludeRepo(BaseRepo):
             return session.query(models.VmExclude).filter_by(
                 exclude_type=exclude_type).all()
 
+    def iter_type_entities(self, exclude_type=None, batch_size=None,
+                           session=None):
+        """Iterate over excludes of a type, reading them by batches.
+
+        :param exclude_type: id of osvmexclude type entity, all if None
+        :param batch_size: rows per batch, defaults to CONF.db_batch_size
+        """
+        session = self.get_session(session)
+        query = session.query(models.VmExclude)
+        if exclude_type is not None:
+            query = query.filter_by(exclude_type=exclude_type)
+        return stream(query, batch_size)
+
     def get_exclude_type(self, exclude_name):
         """Get numeric value matching the exclude type (domain,project,user).
 
@@ -750,11 +1783,11 @@ class VmExcludeRepo(BaseRepo):
         :return: matching numeric value for database
         """
         if exclude_name == 'domain':
-            return 0
+            return EXCLUDE_DOMAIN
         elif exclude_name == 'project':
-            return 1
+            return EXCLUDE_PROJECT
         elif exclude_name == 'user':
-            return 2
+            return EXCLUDE_USER
         else:
             return -1
 
@@ -787,8 +1820,15 @@ class VmExcludeRepo(BaseRepo):
                             {'id': entity.exclude_id, 'type': entity.exclude_type})
         else:
             self.create_from(entity, session)
+            self.bump_version(session)
             return entity
 
+    def delete_entity_by_id(self, entity_id, session=None):
+        """Remove the exclusion by its ID."""
+        super(VmExcludeRepo, self).delete_entity_by_id(entity_id,
+                                                       session=session)
+        self.bump_version(session)
+
     def delete_all_entities(self, suppress_exception=False, session=None):
         """Deletes all entities.
 
@@ -798,6 +1838,7 @@ class VmExcludeRepo(BaseRepo):
         session = self.get_session(session)
         try:
             session.query(models.VmExclude).delete()
+            self.bump_version(session)
         except sqlalchemy.exc.SQLAlchemyError:
             LOG.exception('Problem deleting entities')
             if not suppress_exception:
@@ -816,6 +1857,17 @@ def get_vmexclude_repository():
     return _get_repository(_VMEXPIRE_REPOSITORY, VmExcludeRepo)
 
 
+def get_outbox_repository():
+    """Returns a singleton repository instance."""
+    global _OUTBOX_REPOSITORY
+    _OUTBOX_REPOSITORY = _get_repository(_OUTBOX_REPOSITORY,
+                                         VmExpireOutboxRepo)
+    return _OUTBOX_REPOSITORY
+
+
+_EXCLUDE_INDEX = ExcludeIndex()
+
+
 def _get_repository(global_ref, repo_class):
     if not global_ref:
         global_ref = repo_class()
@@ -17,9 +17,10 @@
 """
 Server-side (i.e. worker side) classes and logic.
 """
-import datetime
+import collections
 import functools
 import json
+import threading
 import time
 
 import oslo_messaging
@@ -27,8 +28,9 @@ import oslo_messaging
 from oslo_service import service
 
 from os_vm_expire.common import config
+from os_vm_expire.common import metrics
 from os_vm_expire.common import utils
-from os_vm_expire.model import models
+from os_vm_expire.model import query_stats
 from os_vm_expire.model import repositories
 
 CONF = config.CONF
@@ -36,6 +38,56 @@ CONF = config.CONF
 LOG = utils.getLogger(__name__)
 
 
+# Log worker statistics every STATS_LOG_INTERVAL delete events
+STATS_LOG_INTERVAL = 1000
+
+CREATE_EVENTS = ('instance.create.end', 'compute.instance.create.end')
+DELETE_EVENTS = ('instance.delete.end', 'compute.instance.delete.end')
+
+
+def parse_event(event_type, payload):
+    """Get instance uuid and data of a create or delete notification.
+
+    :returns: (instance uuid, instance dict) for create events,
+              (instance uuid, None) for delete events, (None, None) else
+    """
+    if event_type not in CREATE_EVENTS and event_type not in DELETE_EVENTS:
+        return None, None
+    if 'nova_object.data' in payload:
+        data = payload['nova_object.data']
+        uuid = data['uuid']
+    else:
+        data = payload
+        uuid = payload['instance_id']
+    instance_uuid = str(uuid)
+    if event_type in DELETE_EVENTS:
+        return instance_uuid, None
+    return instance_uuid, {
+        'display_name': data['display_name'] or instance_uuid,
+        'tenant_id': data['tenant_id'],
+        'user_id': data['user_id']
+    }
+
+
+def coalesce_events(messages):
+    """Keep the last create or delete event of each instance.
+
+    A create replaces any existing expiration of the instance and a delete
+    removes it, so only the last event of an instance matters.
+    :param messages: batch of notification messages
+    :returns: ordered dict of instance uuid => instance dict, None to delete
+    """
+    events = collections.OrderedDict()
+    for message in messages:
+        instance_uuid, data = parse_event(message['event_type'],
+                                          message['payload'])
+        if instance_uuid is None:
+            continue
+        events.pop(instance_uuid, None)
+        events[instance_uuid] = data
+    return events
+
+
 def find_function_name(func, if_no_name=None):
     """Returns pretty-formatted function name."""
     return getattr(func, '__name__', if_no_name)
@@ -69,10 +121,25 @@ def transactional(fn):
     return wrapper
 
 
-def monitored(fn):  # pragma: no cover
-    """Provides monitoring capabilities for task methods."""
+def monitored(fn):
+    """Provides monitoring capabilities for task methods.
 
-    return fn
+    Notifications are counted per event type and status, and their
+    processing time observed.
+    """
+    @functools.wraps(fn)
+    def wrapper(self, ctxt, publisher_id, event_type, *args, **kwargs):
+        start = time.time()
+        status = 'error'
+        try:
+            result = fn(self, ctxt, publisher_id, event_type, *args, **kwargs)
+            status = 'ok'
+            return result
+        finally:
+            metrics.NOTIFICATIONS.inc(event_type=event_type, status=status)
+            metrics.NOTIFICATION_SECONDS.observe(time.time() - start,
+                                                 event_type=event_type)
+    return wrapper
 
 
 class Tasks(object):
@@ -88,92 +155,55 @@ class Tasks(object):
     methods on itself, which include the methods in this class.
     """
 
+    def __init__(self):
+        super(Tasks, self).__init__()
+        self.deletes = 0
+        self.untracked_deletes = 0
+        self._stats_lock = threading.Lock()
+
+    def count_deletes(self, events, deleted):
+        """Count delete events, and those of instances not tracked."""
+        with self._stats_lock:
+            previous = self.deletes
+            self.deletes += events
+            self.untracked_deletes += events - deleted
+            interval = self.deletes // STATS_LOG_INTERVAL
+            log = previous // STATS_LOG_INTERVAL != interval
+        if log:
+            self.log_stats()
+
+    def log_stats(self):
+        LOG.info('Worker: %(deletes)d delete events, %(untracked)d of '
+                 'untracked instances',
+                 {'deletes': self.deletes,
+                  'untracked': self.untracked_deletes})
+
     @monitored
     @transactional
     def info(self, ctxt, publisher_id, event_type, payload, metadata):
-        if event_type == 'instance.create.end' or event_type == 'compute.instance.create.end':
-            uuid = None
-            display_name = None
-            tenant_id = None
-            user_id = None
-            if 'nova_object.data' in payload:
-                uuid = payload['nova_object.data']['uuid']
-                display_name = payload['nova_object.data']['display_name']
-                tenant_id = payload['nova_object.data']['tenant_id']
-                user_id = payload['nova_object.data']['user_id']
-            else:
-                uuid = payload['instance_id']
-                display_name = payload['display_name']
-                tenant_id = payload['tenant_id']
-                user_id = payload['user_id']
-            if not display_name:
-                display_name = str(uuid)
-
-            LOG.debug(event_type + ':' + uuid)
+        if event_type in CREATE_EVENTS:
+            instance_uuid, data = parse_event(event_type, payload)
+            LOG.debug(event_type + ':' + instance_uuid)
             repo = repositories.get_vmexpire_repository()
-            instance = None
-            instance_uuid = str(uuid)
-            try:
-                instance = repo.get_by_instance(instance_uuid)
-            except Exception:
-                LOG.debug("Fine, instance does not already exists")
-            if instance:
-                LOG.warn("InstanceAlreadyExists:" +
-                         instance_uuid +
-                         ", deleting first"
-                         )
-                repo.delete_entity_by_id(entity_id=instance.id)
-            entity = models.VmExpire()
-            entity.instance_id = instance_uuid
-            entity.instance_name = display_name
-
-            entity.project_id = tenant_id
-            entity.user_id = user_id
-            entity.expire = int(
-                time.mktime(datetime.datetime.now().timetuple()) +
-                (CONF.max_vm_duration * 3600 * 24)
-                )
-            entity.notified = False
-            entity.notified_last = False
-
-            project_domain = None
-            try:
-                project_domain = repositories.get_project_domain(entity.project_id)
-            except Exception:
-                LOG.exception('Failed to get domain for project')
-
-            exclude_repo = repositories.get_vmexclude_repository()
-            if project_domain:
-                exclude_id = exclude_repo.get_exclude_by_id(project_domain)
-                if exclude_id:
-                    LOG.debug('domain %s is excluded, skipping' % (project_domain))
-                    return
-            exclude_id = exclude_repo.get_exclude_by_id(entity.project_id)
-            if exclude_id:
-                LOG.debug('project %s is excluded, skipping' % (entity.project_id))
-                return
-            exclude_id = exclude_repo.get_exclude_by_id(entity.user_id)
-            if exclude_id:
-                LOG.debug('user %s is excluded, skipping' % (entity.user_id))
+            excluded = repo.is_excluded(data, {})
+            if excluded:
+                LOG.debug('%s of %s is excluded, skipping' % (
+                    excluded, instance_uuid))
+                # as a create replaces any previous expiration
+                repo.delete_by_instance_id(instance_uuid)
                 return
 
-            instance = repo.create_from(entity)
+            repo.upsert(
+                repositories.get_vmexpire_values(instance_uuid, data))
             LOG.debug("NewInstanceExpiration:" + instance_uuid)
-        elif event_type == 'instance.delete.end' or event_type == 'compute.instance.delete.end':
-            uuid = None
-            if 'nova_object.data' in payload:
-                uuid = payload['nova_object.data']['uuid']
-            else:
-                uuid = payload['instance_id']
-            instance_uuid = str(uuid)
+        elif event_type in DELETE_EVENTS:
+            instance_uuid, _ = parse_event(event_type, payload)
             LOG.debug(event_type + ':' + instance_uuid)
             repo = repositories.get_vmexpire_repository()
-            try:
-                instance = repo.get_by_instance(instance_uuid)
-                repo.delete_entity_by_id(entity_id=instance.id)
-                LOG.debug("Delete id:" + instance.id)
-            except Exception:
-                LOG.warn('Failed to delete: ' + instance_uuid)
+            deleted = repo.delete_by_instance_id(instance_uuid)
+            if not deleted:
+                LOG.debug('No expiration to delete for ' + instance_uuid)
+            self.count_deletes(1, deleted)
 
         LOG.debug(publisher_id)
         LOG.debug(event_type)
@@ -187,6 +217,79 @@ class Tasks(object):
         LOG.debug(json.dumps(payload, indent=4))
 
 
+class BatchTasks(object):
+    """Endpoint of the batch notification listener.
+
+    Create and delete events of a batch are coalesced per instance, then
+    applied with bulk deletes and inserts and a single commit. If the batch
+    fails, its notifications are processed again one by one.
+    """
+
+    def __init__(self, tasks=None):
+        self.tasks = tasks or Tasks()
+
+    def _process(self, events):
+        repo = repositories.get_vmexpire_repository()
+        session = repo.get_session()
+        removed = [instance_uuid for instance_uuid, data in events.items()
+                   if data is None]
+        deleted = repo.delete_by_instance_ids(removed, session=session)
+        created = [instance_uuid for instance_uuid, data in events.items()
+                   if data is not None]
+        repo.delete_by_instance_ids(created, session=session)
+        values = []
+        domains = {}
+        for instance_uuid in created:
+            data = events[instance_uuid]
+            excluded = repo.is_excluded(data, domains, session=session)
+            if excluded:
+                LOG.debug('%s of %s is excluded, skipping',
+                          excluded, instance_uuid)
+                continue
+            values.append(repositories.get_vmexpire_values(instance_uuid,
+                                                           data))
+        repo.create_all(values, commit=False, session=session)
+        return len(removed), deleted, len(values)
+
+    def info(self, messages):
+        events = coalesce_events(messages)
+        if not events:
+            return
+        try:
+            removed, deleted, created = self._process(events)
+            repositories.commit()
+            self.tasks.count_deletes(removed, deleted)
+            for message in messages:
+                metrics.NOTIFICATIONS.inc(event_type=message['event_type'],
+                                          status='ok')
+            LOG.debug('Processed %(messages)d notifications: %(deleted)d '
+                      'expirations deleted, %(created)d created',
+                      {'messages': len(messages), 'deleted': deleted,
+                       'created': created})
+        except Exception:
+            LOG.exception('Problem processing a batch of %d notifications, '
+                          'processing them one by one', len(messages))
+            repositories.rollback()
+            for message in messages:
+                self.tasks.info(message['ctxt'], message['publisher_id'],
+                                message['event_type'], message['payload'],
+                                message['metadata'])
+        finally:
+            repositories.clear()
+
+    def warn(self, messages):
+        for message in messages:
+            self.tasks.warn(message['ctxt'], message['publisher_id'],
+                            message['event_type'], message['payload'],
+                            message['metadata'])
+
+    def error(self, messages):
+        for message in messages:
+            self.tasks.error(message['ctxt'], message['publisher_id'],
+                             message['event_type'], message['payload'],
+                             message['metadata'])
+
+
 class TaskServer(Tasks, service.Service):
     """Server to process asynchronous tasking from API nodes.
 
@@ -198,6 +301,7 @@ class TaskServer(Tasks, service.Service):
     """
     def __init__(self):
         super(TaskServer, self).__init__()
+        self._metrics_server = None
 
         # Setting up db engine to avoid lazy initialization
         repositories.setup_database_engine_and_factory()
@@ -211,20 +315,40 @@ class TaskServer(Tasks, service.Service):
                 exchange=conf_opts.control_exchange
                 )
         ]
-        endpoints = [self]
-        self._server = oslo_messaging.get_notification_listener(
-            transport,
-            targets,
-            endpoints,
-            pool=conf_opts.pool_name
-            )
+        if conf_opts.batch_size > 0:
+            LOG.info('Processing notifications by batches of %d',
+                     conf_opts.batch_size)
+            self._server = oslo_messaging.get_batch_notification_listener(
+                transport,
+                targets,
+                [BatchTasks(self)],
+                pool=conf_opts.pool_name,
+                batch_size=conf_opts.batch_size,
+                batch_timeout=conf_opts.batch_timeout
+                )
+        else:
+            endpoints = [self]
+            self._server = oslo_messaging.get_notification_listener(
+                transport,
+                targets,
+                endpoints,
+                pool=conf_opts.pool_name
+                )
 
     def start(self):
         LOG.info("Starting the TaskServer")
+        conf_metrics = CONF.metrics
+        self._metrics_server = metrics.start_http_server(
+            conf_metrics.listen_host, conf_metrics.worker_port)
         self._server.start()
         super(TaskServer, self).start()
+        query_stats.add_dump_timer(self.tg)
 
     def stop(self):
         LOG.info("Halting the TaskServer")
+        self.log_stats()
+        query_stats.dump_stats()
+        if self._metrics_server is not None:
+            self._metrics_server.shutdown()
         super(TaskServer, self).stop()
         self._server.stop()
@@ -11,10 +11,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import datetime
+import email
 import mock
+import oslotest.base as oslotest
 import time
 
+from os_vm_expire.cmd import cleaner
 from os_vm_expire.cmd.cleaner import check as cleaner_check
+from os_vm_expire.common import config
+from os_vm_expire.common import metrics
 from os_vm_expire.model import models
 from os_vm_expire.model import repositories
 # from os_vm_expire.cmd.cleaner import send_email as cleaner_send_email
@@ -96,6 +101,287 @@ class WhenTestingVmExpiresResource(utils.OsVMExpireAPIBaseTestCase):
             found = False
         self.assertFalse(found)
 
+    @mock.patch('requests.get', side_effect=mocked_requests_get)
+    @mock.patch('requests.post', side_effect=mocked_requests_post)
+    @mock.patch('os_vm_expire.cmd.cleaner.delete_vm',
+                side_effect=mocked_delete_vm)
+    @mock.patch('os_vm_expire.cmd.cleaner.send_email',
+                side_effect=mocked_email)
+    def test_vm_expire_cleaned_concurrently(self, mock_email, mock_delete,
+                                            mock_post, mock_get):
+        config.CONF.set_override('workers', 4, group='cleaner')
+        self.addCleanup(config.CONF.clear_override, 'workers', group='cleaner')
+        ids = []
+        for i in range(5):
+            entity = create_vmexpire_model('1234' + str(i))
+            entity.expire = 1
+            create_vmexpire(entity)
+            ids.append(entity.id)
+        expired = create_vmexpire_model('expired')
+        expired.expire = 1
+        expired.notified = True
+        expired.notified_last = True
+        expired.notified_time = 1
+        create_vmexpire(expired)
+        cleaner_check(None)
+        for entity_id in ids:
+            db_entity = get_vmexpire(entity_id)
+            self.assertTrue(db_entity.notified)
+            self.assertFalse(db_entity.notified_last)
+        self.assertRaises(Exception, get_vmexpire, expired.id)
+        mock_delete.assert_called_once_with(
+            expired.instance_id, expired.project_id, 'XXX')
+        # 5 first notifications and 1 deletion notification
+        self.assertEqual(6, mock_email.call_count)
+
+    @mock.patch('requests.get', side_effect=mocked_requests_get)
+    @mock.patch('requests.post', side_effect=mocked_requests_post)
+    @mock.patch('os_vm_expire.cmd.cleaner.send_email',
+                side_effect=mocked_email)
+    def test_vm_expire_metrics(self, mock_email, mock_post, mock_get):
+        passes = metrics.CLEANER_PASS_SECONDS.get_count()
+        rows = metrics.CLEANER_ROWS.get(stage=cleaner.NOTIFY_FIRST)
+        entity = create_vmexpire_model('12345')
+        entity.expire = 1
+        create_vmexpire(entity)
+        cleaner_check(None)
+        self.assertEqual(passes + 1, metrics.CLEANER_PASS_SECONDS.get_count())
+        self.assertEqual(rows + 1,
+                         metrics.CLEANER_ROWS.get(stage=cleaner.NOTIFY_FIRST))
+
+    @mock.patch('requests.get', side_effect=mocked_requests_get)
+    @mock.patch('requests.post', side_effect=mocked_requests_post)
+    @mock.patch('os_vm_expire.cmd.cleaner.delete_vm',
+                side_effect=mocked_delete_vm)
+    @mock.patch('os_vm_expire.cmd.cleaner.send_digest',
+                side_effect=mocked_email)
+    @mock.patch('os_vm_expire.cmd.cleaner.send_email',
+                side_effect=mocked_email)
+    def test_vm_expire_digest(self, mock_email, mock_digest, mock_delete,
+                              mock_post, mock_get):
+        config.CONF.set_override('email_digest', True, group='cleaner')
+        self.addCleanup(config.CONF.clear_override, 'email_digest',
+                        group='cleaner')
+        ids = []
+        for i in range(2):
+            entity = create_vmexpire_model('digest' + str(i))
+            entity.user_id = 'digestuser'
+            entity.expire = 1
+            create_vmexpire(entity)
+            ids.append(entity.id)
+        expired = create_vmexpire_model('digestexpired')
+        expired.user_id = 'digestuser'
+        expired.expire = 1
+        expired.notified = True
+        expired.notified_last = True
+        expired.notified_time = 1
+        create_vmexpire(expired)
+        cleaner_check(None)
+        self.assertFalse(mock_email.called)
+        self.assertEqual(1, mock_digest.call_count)
+        user_id, notices = mock_digest.call_args[0][:2]
+        self.assertEqual('digestuser', user_id)
+        self.assertEqual(
+            sorted([cleaner.DELETE, cleaner.NOTIFY_FIRST,
+                    cleaner.NOTIFY_FIRST]),
+            sorted(action for (_, action) in notices))
+        for entity_id in ids:
+            self.assertTrue(get_vmexpire(entity_id).notified)
+        self.assertRaises(Exception, get_vmexpire, expired.id)
+
+    @mock.patch('os_vm_expire.common.mail.sendmail')
+    @mock.patch('os_vm_expire.cmd.cleaner.get_project_name', return_value='p')
+    @mock.patch('os_vm_expire.cmd.cleaner._get_email', return_value='a@b.c')
+    def test_send_digest(self, mock_get_email, mock_project, mock_sendmail):
+        config.CONF.set_override('email_smtp_from', 'x@b.c', group='smtp')
+        self.addCleanup(config.CONF.clear_override, 'email_smtp_from',
+                        group='smtp')
+        tasks = [
+            cleaner.ExpireTask(str(i), 'vm%d' % i, 'name%d' % i, 'project',
+                               'user', 1)
+            for i in range(3)
+        ]
+        notices = [(tasks[0], cleaner.NOTIFY_FIRST),
+                   (tasks[1], cleaner.NOTIFY_LAST),
+                   (tasks[2], cleaner.DELETE)]
+        self.assertTrue(cleaner.send_digest('user', notices, 'XXX'))
+        mock_get_email.assert_called_once_with('user', 'XXX')
+        mock_project.assert_called_once_with('project', 'XXX')
+        self.assertEqual(1, mock_sendmail.call_count)
+        message = email.message_from_string(mock_sendmail.call_args[0][2])
+        message = message.get_payload(decode=True).decode('utf-8')
+        for i in range(3):
+            self.assertIn('vm%d' % i, message)
+
+
+class WhenTestingOutbox(utils.OsVMExpireAPIBaseTestCase):
+
+    def setUp(self):
+        super(WhenTestingOutbox, self).setUp()
+        config.CONF.set_override('outbox', True, group='cleaner')
+        self.addCleanup(config.CONF.clear_override, 'outbox', group='cleaner')
+        self.outbox_repo = repositories.get_outbox_repository()
+
+    def tearDown(self):
+        super(WhenTestingOutbox, self).tearDown()
+        repositories.get_vmexpire_repository().delete_all_entities()
+        self.outbox_repo.delete_all_entities()
+        repositories.commit()
+
+    def create_expired(self):
+        expired = create_vmexpire_model('expired')
+        expired.expire = 1
+        expired.notified = True
+        expired.notified_last = True
+        expired.notified_time = 1
+        return create_vmexpire(expired)
+
+    @mock.patch('requests.get', side_effect=mocked_requests_get)
+    @mock.patch('requests.post', side_effect=mocked_requests_post)
+    @mock.patch('os_vm_expire.cmd.cleaner.delete_vm',
+                side_effect=mocked_delete_vm)
+    @mock.patch('os_vm_expire.cmd.cleaner.send_email',
+                side_effect=mocked_email)
+    def test_outbox_notifies_and_deletes(self, mock_email, mock_delete,
+                                         mock_post, mock_get):
+        entity = create_vmexpire_model('12345')
+        entity.expire = 1
+        create_vmexpire(entity)
+        self.create_expired()
+        cleaner_check(None)
+        self.assertTrue(get_vmexpire(entity.id).notified)
+        self.assertEqual(
+            [entity.id],
+            [e.id for e in
+             repositories.get_vmexpire_repository().get_entities()])
+        mock_delete.assert_called_once_with(
+            'expiredinstance', 'expiredproject', 'XXX')
+        # first notification and deletion notification
+        self.assertEqual(2, mock_email.call_count)
+        self.assertTrue(mock_email.call_args_list[1][1]['delete'])
+        self.assertEqual([], self.outbox_repo.get_ready(time.time()))
+
+    @mock.patch('requests.get', side_effect=mocked_requests_get)
+    @mock.patch('requests.post', side_effect=mocked_requests_post)
+    @mock.patch('os_vm_expire.cmd.cleaner.send_email', return_value=False)
+    def test_outbox_retries_with_backoff(self, mock_email, mock_post,
+                                         mock_get):
+        entity = create_vmexpire_model('12345')
+        entity.expire = 1
+        create_vmexpire(entity)
+        cleaner_check(None)
+        cleaner_check(None)
+        # second pass: queued once, not retried before backoff
+        self.assertEqual(1, mock_email.call_count)
+        self.assertFalse(get_vmexpire(entity.id).notified)
+        entries = self.outbox_repo.get_ready(time.time() + 3600)
+        self.assertEqual(1, len(entries))
+        self.assertEqual(1, entries[0].attempts)
+        self.assertEqual('notify_first failed', entries[0].last_error)
+        self.assertTrue(entries[0].next_attempt > time.time())
+
+    @mock.patch('requests.get', side_effect=mocked_requests_get)
+    @mock.patch('requests.post', side_effect=mocked_requests_post)
+    @mock.patch('os_vm_expire.cmd.cleaner.delete_vm',
+                side_effect=mocked_delete_vm)
+    def test_outbox_drops_extended_vm(self, mock_delete, mock_post, mock_get):
+        expired = self.create_expired()
+        now = int(time.time())
+        task = cleaner._get_task(expired)
+        cleaner.enqueue(self.outbox_repo, [(task, cleaner.DELETE)], now)
+        repositories.get_vmexpire_repository().extend_vm(expired.id)
+        repositories.commit()
+        cleaner.drain(repositories.get_vmexpire_repository(),
+                      self.outbox_repo, 'XXX', now,
+                      cleaner.eventlet.GreenPool(1), None)
+        self.assertEqual(0, mock_delete.call_count)
+        self.assertEqual(expired.id, get_vmexpire(expired.id).id)
+        self.assertEqual([], self.outbox_repo.get_ready(now))
+
+
+class WhenTestingScheduler(oslotest.BaseTestCase):
+
+    def setUp(self):
+        super(WhenTestingScheduler, self).setUp()
+        self.repo = mock.MagicMock()
+        self.repo.get_due_times.return_value = []
+        self.scheduler = cleaner.Scheduler(self.repo)
+        self.conf = config.CONF.cleaner
+        patcher = mock.patch('os_vm_expire.model.repositories.commit')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @mock.patch('os_vm_expire.cmd.cleaner.time.time', return_value=1000)
+    @mock.patch('os_vm_expire.cmd.cleaner.check')
+    def test_first_call_runs_a_pass(self, mock_check, mock_time):
+        delay = self.scheduler.run_pending(now=1000)
+        self.assertEqual(1, mock_check.call_count)
+        # nothing due: wait for the next refresh
+        self.assertEqual(self.conf.scheduler_refresh_interval, delay)
+        self.assertEqual(2, self.repo.get_due_times.call_count)
+
+    @mock.patch('os_vm_expire.cmd.cleaner.time.time', return_value=1000)
+    @mock.patch('os_vm_expire.cmd.cleaner.check')
+    def test_sleeps_until_earliest_due(self, mock_check, mock_time):
+        self.scheduler.run_pending(now=1000)
+        self.repo.get_due_times.return_value = [(1200, 'b', 'b'),
+                                                (1100, 'a', 'a')]
+        self.scheduler.refresh(1000)
+        self.assertEqual(100, self.scheduler.run_pending(now=1000))
+        self.assertEqual(1, mock_check.call_count)
+
+        self.repo.get_due_times.return_value = [(1200, 'b', 'b')]
+        mock_time.return_value = 1100
+        self.assertEqual(100, self.scheduler.run_pending(now=1100))
+        self.assertEqual(2, mock_check.call_count)
+
+    @mock.patch('os_vm_expire.cmd.cleaner.time.time', return_value=1000)
+    @mock.patch('os_vm_expire.cmd.cleaner.check')
+    def test_min_check_interval(self, mock_check, mock_time):
+        # action due right after a pass
+        self.repo.get_due_times.return_value = [(1001, 'a', 'a')]
+        delay = self.scheduler.run_pending(now=1000)
+        self.assertEqual(self.conf.min_check_interval, delay)
+        self.scheduler.run_pending(now=1001)
+        self.assertEqual(1, mock_check.call_count)
+
+    @mock.patch('os_vm_expire.cmd.cleaner.check')
+    def test_failing_action_waits_check_interval(self, mock_check):
+        # action which always fails, for instance a user without email
+        self.repo.get_due_times.return_value = [(900, 'a', 'a')]
+        now = 1000
+        with mock.patch('os_vm_expire.cmd.cleaner.time.time',
+                        side_effect=lambda: now):
+            delay = self.scheduler.run_pending(now=now)
+            self.assertEqual(self.conf.scheduler_refresh_interval, delay)
+            while now < 1000 + 2 * self.conf.check_interval:
+                now += self.conf.min_check_interval
+                self.scheduler.run_pending(now=now)
+        # first pass, then one per check_interval
+        self.assertEqual(3, mock_check.call_count)
+
+
+class WhenTestingSharding(oslotest.BaseTestCase):
+
+    def set_shard(self, shard_index, shard_count):
+        config.CONF.set_override('shard_index', shard_index, 'cleaner')
+        config.CONF.set_override('shard_count', shard_count, 'cleaner')
+        self.addCleanup(config.CONF.clear_override, 'shard_index', 'cleaner')
+        self.addCleanup(config.CONF.clear_override, 'shard_count', 'cleaner')
+
+    def test_single_shard_handles_all(self):
+        self.assertTrue(cleaner.in_shard('instance'))
+
+    def test_each_instance_in_one_shard(self):
+        instance_ids = ['instance%d' % i for i in range(100)]
+        handled = []
+        for shard_index in range(3):
+            self.set_shard(shard_index, 3)
+            shard = [i for i in instance_ids if cleaner.in_shard(i)]
+            self.assertTrue(shard)
+            handled.extend(shard)
+        self.assertEqual(sorted(instance_ids), sorted(handled))
+
 
 def create_vmexpire_model(prefix=None):
     if not prefix:
@@ -0,0 +1,215 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import mock
+import subprocess
+import sys
+import threading
+import unittest
+
+from os_vm_expire.cmd import cleaner
+from os_vm_expire.cmd.cleaner import check as cleaner_check
+from os_vm_expire.common import config
+from os_vm_expire.model import repositories
+from os_vm_expire.tests.api.cmd import test_cleaner
+from os_vm_expire.tests import utils
+
+# The asyncio engine modules only import on Python 3.7 or later, the stubs
+# below return futures, instead of being coroutines or AsyncMock (Python
+# 3.8), so that this module imports on any Python.
+if sys.version_info >= (3, 7):
+    import asyncio
+
+    from os_vm_expire.common import aio
+else:
+    aio = None
+
+requires_asyncio = unittest.skipIf(aio is None,
+                                   'asyncio engine needs Python 3.7')
+
+
+def done(result=None, exception=None):
+    """Get an already done future, the result of a stubbed coroutine."""
+    future = asyncio.get_event_loop().create_future()
+    if exception is not None:
+        future.set_exception(exception)
+    else:
+        future.set_result(result)
+    return future
+
+
+def mocked_get_object(object_type, object_id, token=None):
+    if object_type == 'user':
+        return done({'email': 'user@localhost'})
+    return done({'name': 'project'})
+
+
+def mocked_delete(*args, **kwargs):
+    return done(aio.Response(204))
+
+
+def mocked_sendmail(*args, **kwargs):
+    return done()
+
+
+def mocked_sendmail_failure(*args, **kwargs):
+    return done(exception=Exception('down'))
+
+
+class WhenTestingEngineImports(unittest.TestCase):
+
+    def test_eventlet_engine_does_not_import_asyncio_engine(self):
+        code = ('import sys; import os_vm_expire.cmd.cleaner; '
+                'sys.exit("os_vm_expire.common.aio" in sys.modules or '
+                '"os_vm_expire.cmd.cleaner_aio" in sys.modules)')
+        self.assertEqual(0, subprocess.call([sys.executable, '-c', code]))
+
+    @mock.patch.object(cleaner.sys, 'version_info', (3, 6, 0))
+    def test_asyncio_engine_needs_python_37(self):
+        config.CONF.set_override('engine', 'asyncio', group='cleaner')
+        self.addCleanup(config.CONF.clear_override, 'engine', group='cleaner')
+        self.assertRaises(RuntimeError, cleaner.CleanerServer)
+
+
+@requires_asyncio
+class WhenTestingAsyncEngine(utils.OsVMExpireAPIBaseTestCase):
+
+    def setUp(self):
+        super(WhenTestingAsyncEngine, self).setUp()
+        config.CONF.set_override('engine', 'asyncio', group='cleaner')
+        config.CONF.set_override('workers', 4, group='cleaner')
+        config.CONF.set_override('email_smtp_from', 'cleaner@localhost',
+                                 group='smtp')
+        self.addCleanup(config.CONF.clear_override, 'engine', group='cleaner')
+        self.addCleanup(config.CONF.clear_override, 'workers', group='cleaner')
+        self.addCleanup(config.CONF.clear_override, 'email_smtp_from',
+                        group='smtp')
+
+    def tearDown(self):
+        super(WhenTestingAsyncEngine, self).tearDown()
+        repositories.get_vmexpire_repository().delete_all_entities()
+        repositories.commit()
+
+    @mock.patch('requests.post',
+                side_effect=test_cleaner.mocked_requests_post)
+    @mock.patch('os_vm_expire.common.aio.SMTPPool.sendmail',
+                new_callable=mock.MagicMock,
+                side_effect=mocked_sendmail)
+    @mock.patch('os_vm_expire.common.aio.HTTPClient.get_object',
+                new_callable=mock.MagicMock,
+                side_effect=mocked_get_object)
+    @mock.patch('os_vm_expire.common.aio.HTTPClient.request',
+                new_callable=mock.MagicMock,
+                side_effect=mocked_delete)
+    def test_async_engine_cleans(self, mock_request, mock_get_object,
+                                 mock_sendmail, mock_post):
+        ids = []
+        for i in range(3):
+            entity = test_cleaner.create_vmexpire_model('1234' + str(i))
+            entity.expire = 1
+            test_cleaner.create_vmexpire(entity)
+            ids.append(entity.id)
+        expired = test_cleaner.create_vmexpire_model('expired')
+        expired.expire = 1
+        expired.notified = True
+        expired.notified_last = True
+        expired.notified_time = 1
+        test_cleaner.create_vmexpire(expired)
+        cleaner_check(None)
+        for entity_id in ids:
+            self.assertTrue(test_cleaner.get_vmexpire(entity_id).notified)
+        self.assertEqual(
+            sorted(ids),
+            sorted(e.id for e in
+                   repositories.get_vmexpire_repository().get_entities()))
+        mock_request.assert_called_once_with(
+            'delete', mock.ANY, token='XXX', headers=mock.ANY,
+            service='nova')
+        self.assertTrue(
+            mock_request.call_args[0][1].endswith('/servers/expiredinstance'))
+        # 3 first notices and the deletion notice
+        self.assertEqual(4, mock_sendmail.call_count)
+
+    @mock.patch('requests.post',
+                side_effect=test_cleaner.mocked_requests_post)
+    @mock.patch('os_vm_expire.common.aio.SMTPPool.sendmail',
+                new_callable=mock.MagicMock,
+                side_effect=mocked_sendmail_failure)
+    @mock.patch('os_vm_expire.common.aio.HTTPClient.get_object',
+                new_callable=mock.MagicMock,
+                side_effect=mocked_get_object)
+    def test_async_engine_mail_failure(self, mock_get_object, mock_sendmail,
+                                       mock_post):
+        entity = test_cleaner.create_vmexpire_model('12345')
+        entity.expire = 1
+        test_cleaner.create_vmexpire(entity)
+        cleaner_check(None)
+        self.assertFalse(test_cleaner.get_vmexpire(entity.id).notified)
+
+    def test_async_pool_bounds_concurrency(self):
+        state = {'running': 0, 'max': 0}
+
+        def call(pool, value):
+            state['running'] += 1
+            state['max'] = max(state['max'], state['running'])
+            future = pool.loop.create_future()
+
+            def finish():
+                state['running'] -= 1
+                future.set_result(value * 2)
+            pool.loop.call_later(0.01, finish)
+            return future
+
+        pool = aio.Pool(2, {test_cleaner.mocked_email: call}, 1)
+        self.assertEqual([0, 2, 4, 6, 8],
+                         pool.imap(test_cleaner.mocked_email, range(5)))
+        pool.spawn_n(test_cleaner.mocked_email, 5)
+        pool.close()
+        self.assertEqual(2, state['max'])
+
+
+@requires_asyncio
+class WhenTestingAsyncHTTPClient(unittest.TestCase):
+
+    def setUp(self):
+        super(WhenTestingAsyncHTTPClient, self).setUp()
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        self.client = aio.HTTPClient('cleaner')
+
+    @mock.patch('os_vm_expire.common.aio.HTTPClient._send_timed',
+                new_callable=mock.MagicMock)
+    @mock.patch('os_vm_expire.common.keystone.TokenCache.get_token')
+    def test_token_renewed_out_of_the_loop(self, mock_get_token, mock_send):
+        loop_threads = []
+        token_threads = []
+
+        def get_token():
+            token_threads.append(threading.current_thread())
+            return 'token%d' % len(token_threads)
+
+        def send(service, method, url, headers, **kwargs):
+            loop_threads.append(threading.current_thread())
+            if headers['X-Auth-Token'] == 'token1':
+                return done(aio.Response(401))
+            return done(aio.Response(204))
+        mock_get_token.side_effect = get_token
+        mock_send.side_effect = send
+
+        r = self.loop.run_until_complete(
+            self.client.request('delete', 'http://nova/servers/1'))
+        self.assertEqual(204, r.status_code)
+        # initial token, then renewal of the rejected one
+        self.assertEqual(2, len(token_threads))
+        self.assertEqual(2, len(loop_threads))
+        for thread in token_threads:
+            self.assertNotIn(thread, loop_threads)
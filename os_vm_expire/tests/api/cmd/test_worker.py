@@ -16,8 +16,10 @@ import mock
 # import sqlalchemy.orm as sa_orm
 import time
 
+from os_vm_expire.common import metrics
 from os_vm_expire.model import models
 from os_vm_expire.model import repositories
+from os_vm_expire.queue.server import BatchTasks
 from os_vm_expire.queue.server import Tasks
 from os_vm_expire.tests import utils
 
@@ -79,6 +81,36 @@ class WhenTestingVmExpiresResource(utils.OsVMExpireAPIBaseTestCase):
         self.assertEqual(expire.instance_id, create_msg['nova_object.data']['uuid'])
         self.assertTrue(expire.expire > 0)
 
+    @mock.patch('os_vm_expire.model.repositories.get_project_domain',
+                side_effect=mocked_get_project_domain)
+    def test_vm_create_twice(self, mock_get_project_domain):
+        create_msg = notification('instance.create.end', '1-2-3-4-5')
+        self.task.info(None, 'mock', 'instance.create.end',
+                       create_msg['payload'], None)
+        repo = repositories.get_vmexpire_repository()
+        expire_id = repo.get_by_instance('1-2-3-4-5').id
+        create_msg['payload']['nova_object.data']['display_name'] = 'renamed'
+        self.task.info(None, 'mock', 'instance.create.end',
+                       create_msg['payload'], None)
+        entities = repo.get_entities()
+        self.assertEqual(1, len(entities))
+        self.assertEqual(expire_id, entities[0].id)
+        self.assertEqual('renamed', entities[0].instance_name)
+
+    @mock.patch('os_vm_expire.model.repositories.get_project_domain',
+                side_effect=mocked_get_project_domain)
+    def test_vm_create_metrics(self, mock_get_project_domain):
+        labels = {'event_type': 'instance.create.end', 'status': 'ok'}
+        count = metrics.NOTIFICATIONS.get(**labels)
+        create_msg = notification('instance.create.end', '1-2-3-4-5')
+        self.task.info(None, 'mock', 'instance.create.end',
+                       create_msg['payload'], None)
+        self.assertEqual(count + 1, metrics.NOTIFICATIONS.get(**labels))
+        self.assertEqual(
+            count + 1,
+            metrics.NOTIFICATION_SECONDS.get_count(
+                event_type='instance.create.end'))
+
     def test_vm_delete(self):
         self.test_vm_create()
         delete_msg = {
@@ -100,6 +132,12 @@ class WhenTestingVmExpiresResource(utils.OsVMExpireAPIBaseTestCase):
             logging.exception(e)
             found = False
         self.assertFalse(found)
+        self.assertEqual(1, self.task.deletes)
+        self.assertEqual(0, self.task.untracked_deletes)
+
+        self.task.info(None, 'mock', 'instance.delete.end', delete_msg, None)
+        self.assertEqual(2, self.task.deletes)
+        self.assertEqual(1, self.task.untracked_deletes)
 
 
 class WhenTestingVmExcludesResource(utils.OsVMExpireAPIBaseTestCase):
@@ -186,6 +224,118 @@ class WhenTestingVmExcludesResource(utils.OsVMExpireAPIBaseTestCase):
         else:
             self.self.fail('domain is excluded, should not have been created')
 
+    @mock.patch('os_vm_expire.model.repositories.get_project_domain',
+                side_effect=mocked_get_project_domain)
+    def test_vm_exclude_reloaded_on_version_change(
+            self, mock_get_project_domain):
+        create_msg = {
+            'nova_object.data': {
+                'uuid': '1-2-3-4-5',
+                'display_name': '12345',
+                'tenant_id': '12345project',
+                'user_id': '12345user'
+            }
+        }
+        self.task.info(None, 'mock', 'instance.create.end', create_msg, None)
+        repo = repositories.get_vmexpire_repository()
+        repo.get_by_instance('1-2-3-4-5')
+
+        # exclusion added by another process: not seen before the
+        # refresh interval, then reloaded as version changed
+        session = repositories.get_session()
+        session.add(create_vmexclude_model('12345user', 2))
+        session.query(models.VmExcludeVersion).update(
+            {'version': models.VmExcludeVersion.version + 1})
+        repositories.commit()
+        create_msg['nova_object.data']['uuid'] = '6-7-8-9-10'
+        self.task.info(None, 'mock', 'instance.create.end', create_msg, None)
+        repo.get_by_instance('6-7-8-9-10')
+
+        repositories.CONF.set_override('exclude_refresh_interval', 0)
+        self.addCleanup(repositories.CONF.clear_override,
+                        'exclude_refresh_interval')
+        create_msg['nova_object.data']['uuid'] = '11-12-13-14-15'
+        self.task.info(None, 'mock', 'instance.create.end', create_msg, None)
+        self.assertRaises(Exception, repo.get_by_instance, '11-12-13-14-15')
+
+
+def notification(event_type, uuid, prefix='12345'):
+    return {
+        'ctxt': None,
+        'publisher_id': 'mock',
+        'event_type': event_type,
+        'payload': {
+            'nova_object.data': {
+                'uuid': uuid,
+                'display_name': prefix,
+                'tenant_id': prefix + 'project',
+                'user_id': prefix + 'user'
+            }
+        },
+        'metadata': None
+    }
+
+
+class WhenTestingBatchTasks(utils.OsVMExpireAPIBaseTestCase):
+
+    def setUp(self):
+        super(WhenTestingBatchTasks, self).setUp()
+        self.task = BatchTasks()
+
+    def tearDown(self):
+        super(WhenTestingBatchTasks, self).tearDown()
+        repo = repositories.get_vmexpire_repository()
+        repo.delete_all_entities()
+        repositories.commit()
+        exclude_repo = repositories.get_vmexclude_repository()
+        exclude_repo.delete_all_entities()
+        repositories.commit()
+
+    @mock.patch('os_vm_expire.model.repositories.get_project_domain',
+                side_effect=mocked_get_project_domain)
+    def test_batch_coalesces_events(self, mock_get_project_domain):
+        create_vmexpire(create_vmexpire_model('existing'))
+        create_vmexpire(create_vmexpire_model('recreated'))
+        create_vmexclude(create_vmexclude_model('excludeduser', 2))
+        messages = [
+            notification('instance.create.end', 'new'),
+            notification('instance.create.end', 'transient'),
+            notification('instance.delete.end', 'transient'),
+            notification('instance.delete.end', 'existinginstance'),
+            notification('instance.update', 'other'),
+            notification('instance.delete.end', 'recreatedinstance'),
+            notification('instance.create.end', 'recreatedinstance'),
+            notification('instance.create.end', 'skipped', prefix='excluded'),
+        ]
+        with mock.patch('os_vm_expire.model.repositories.commit',
+                        wraps=repositories.commit) as mock_commit:
+            self.task.info(messages)
+            self.assertEqual(1, mock_commit.call_count)
+        repo = repositories.get_vmexpire_repository()
+        self.assertEqual(
+            ['new', 'recreatedinstance'],
+            sorted(e.instance_id for e in repo.get_entities()))
+        # transient was never tracked
+        self.assertEqual(2, self.task.tasks.deletes)
+        self.assertEqual(1, self.task.tasks.untracked_deletes)
+        # one lookup per project
+        self.assertEqual(2, mock_get_project_domain.call_count)
+
+    @mock.patch('os_vm_expire.model.repositories.get_project_domain',
+                side_effect=mocked_get_project_domain)
+    def test_batch_failure_processes_one_by_one(self, mock_get_project_domain):
+        messages = [
+            notification('instance.create.end', 'new1'),
+            notification('instance.create.end', 'new2'),
+        ]
+        with mock.patch.object(self.task, '_process',
+                               side_effect=Exception('error')):
+            self.task.info(messages)
+        repo = repositories.get_vmexpire_repository()
+        self.assertEqual(
+            ['new1', 'new2'],
+            sorted(e.instance_id for e in repo.get_entities()))
+
 
 def create_vmexpire_model(prefix=None):
     if not prefix:
@@ -15,6 +15,8 @@ import mock
 import time
 
 # from os_vm_expire import context
+from os_vm_expire.common import config
+from os_vm_expire.common import metrics
 from os_vm_expire.model import models
 from os_vm_expire.model import repositories
 from os_vm_expire.tests import utils
@@ -87,6 +89,19 @@ class WhenTestingVmExpiresResource(utils.OsVMExpireAPIBaseTestCase):
         self.assertIn('vmexpires', _get_resp.json)
         self.assertEqual(len(_get_resp.json['vmexpires']), 2)
 
+    def test_get_vmexpires_metrics(self):
+        labels = {'controller': 'VmExpireController', 'method': 'on_get',
+                  'status': 200}
+        db_labels = {'repository': 'VmExpireRepo',
+                     'method': 'get_vmexpire_list'}
+        requests = metrics.API_REQUEST_SECONDS.get_count(**labels)
+        queries = metrics.DB_QUERY_SECONDS.get_count(**db_labels)
+        self.app.get('/12345project/vmexpires/')
+        self.assertEqual(requests + 1,
+                         metrics.API_REQUEST_SECONDS.get_count(**labels))
+        self.assertEqual(queries + 1,
+                         metrics.DB_QUERY_SECONDS.get_count(**db_labels))
+
     def test_can_get_vmexpire(self):
         entity = create_vmexpire_model()
         instance = create_vmexpire(entity)
@@ -173,6 +188,121 @@ class WhenTestingVmExpiresResource(utils.OsVMExpireAPIBaseTestCase):
         self.assertIn('vmexpires', _get_resp.json)
         self.assertEqual(len(_get_resp.json['vmexpires']), 0)
 
+    def test_can_page_vmexpires(self):
+        for i in range(3):
+            create_vmexpire(create_vmexpire_model(prefix='page%d' % i))
+        _get_resp = self.app.get(
+            '/page0project/vmexpires/?all_tenants=1&limit=2',
+            extra_environ={
+                'os_vm_expire.context': self._build_context(
+                    self.project_id, is_admin=True)
+            })
+        self.assertEqual(200, _get_resp.status_int)
+        self.assertEqual(2, len(_get_resp.json['vmexpires']))
+        self.assertEqual(3, _get_resp.json['total'])
+        self.assertIn('offset=2', _get_resp.json['next'])
+        self.assertIn('all_tenants=1', _get_resp.json['next'])
+        self.assertNotIn('previous', _get_resp.json)
+
+    def test_can_list_all_vmexpires_without_limit(self):
+        config.CONF.set_override('default_limit_paging', 2)
+        self.addCleanup(config.CONF.clear_override, 'default_limit_paging')
+        for i in range(3):
+            entity = create_vmexpire_model(prefix='all%d' % i)
+            entity.project_id = 'allproject'
+            create_vmexpire(entity)
+        _get_resp = self.app.get('/allproject/vmexpires/')
+        self.assertEqual(200, _get_resp.status_int)
+        self.assertEqual(3, len(_get_resp.json['vmexpires']))
+        self.assertEqual(3, _get_resp.json['total'])
+        self.assertNotIn('next', _get_resp.json)
+        _get_resp = self.app.get('/allproject/vmexpires/?offset=1')
+        self.assertEqual(2, len(_get_resp.json['vmexpires']))
+        self.assertNotIn('next', _get_resp.json)
+
+    def test_can_filter_and_sort_vmexpires(self):
+        for i in range(3):
+            entity = create_vmexpire_model(prefix='sort%d' % i)
+            entity.project_id = 'sortproject'
+            entity.expire = entity.expire + i
+            create_vmexpire(entity)
+        _get_resp = self.app.get(
+            '/sortproject/vmexpires/?sort_key=expire&sort_dir=desc')
+        self.assertEqual(200, _get_resp.status_int)
+        self.assertEqual(
+            ['sort2', 'sort1', 'sort0'],
+            [vm['instance_name'] for vm in _get_resp.json['vmexpires']])
+        _get_resp = self.app.get(
+            '/sortproject/vmexpires/?user_id=sort1user')
+        self.assertEqual(1, _get_resp.json['total'])
+        self.assertEqual('sort1',
+                         _get_resp.json['vmexpires'][0]['instance_name'])
+
+    def test_can_page_vmexpires_with_marker(self):
+        ids = []
+        for i in range(3):
+            entity = create_vmexpire_model(prefix='marker%d' % i)
+            entity.project_id = 'markerproject'
+            entity.expire = entity.expire + i
+            ids.append(create_vmexpire(entity).id)
+        _get_resp = self.app.get(
+            '/markerproject/vmexpires/?limit=1&marker=' + ids[0])
+        self.assertEqual(200, _get_resp.status_int)
+        self.assertEqual(1, len(_get_resp.json['vmexpires']))
+        self.assertEqual(ids[1], _get_resp.json['vmexpires'][0]['id'])
+        self.assertIn('marker=' + ids[1], _get_resp.json['next'])
+
+    def test_invalid_list_params_vmexpires(self):
+        entity = create_vmexpire_model()
+        create_vmexpire(entity)
+        url = '/' + entity.project_id + '/vmexpires/'
+        self.app.get(url + '?sort_key=foo', status=400)
+        self.app.get(url + '?notified=foo', status=400)
+        self.app.get(url + '?marker=foo', status=400)
+
+    @mock.patch('os_vm_expire.model.repositories.get_project_domain',
+                return_value='domain')
+    @mock.patch('os_vm_expire.model.repositories.list_instances')
+    def test_can_bulk_add_vmexpires(self, mock_list, mock_domain):
+        mock_list.return_value = [
+            {'id': 'bulk1', 'display_name': 'bulk1',
+             'tenant_id': 'bulkproject', 'user_id': 'bulkuser'}
+        ]
+        _get_resp = self.app.post_json(
+            '/bulkproject/vmexpires/',
+            {'instance_ids': ['bulk1', 'bulk2']})
+        self.assertEqual(202, _get_resp.status_int)
+        mock_list.assert_called_once_with(project_id='bulkproject')
+        self.assertEqual(
+            [('bulk1', 'added'), ('bulk2', 'not_found')],
+            [(r['instance_id'], r['result'])
+             for r in _get_resp.json['vmexpires']])
+        _get_resp = self.app.get('/bulkproject/vmexpires/')
+        self.assertEqual(1, _get_resp.json['total'])
+
+    def test_invalid_bulk_add_vmexpires(self):
+        url = '/bulkproject/vmexpires/'
+        self.app.post_json(url, {}, status=400)
+        self.app.post_json(url, {'instance_ids': 'bulk1'}, status=400)
+        self.app.post_json(
+            url, {'instance_ids': ['bulk1'], 'all_project': True},
+            status=400)
+
+    def test_can_bulk_extend_vmexpires(self):
+        ids = []
+        for i in range(2):
+            entity = create_vmexpire_model(prefix='bulkext%d' % i)
+            entity.project_id = 'bulkextproject'
+            ids.append(create_vmexpire(entity).id)
+        _get_resp = self.app.put_json(
+            '/bulkextproject/vmexpires/', {'all_project': True})
+        self.assertEqual(202, _get_resp.status_int)
+        self.assertEqual(sorted(ids), sorted(_get_resp.json['extended']))
+        _get_resp = self.app.put_json(
+            '/otherproject/vmexpires/', {'ids': ids})
+        self.assertEqual(202, _get_resp.status_int)
+        self.assertEqual(ids, _get_resp.json['not_found'])
+
 
 def create_vmexpire_model(prefix=None):
     if not prefix:
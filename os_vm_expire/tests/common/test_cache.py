@@ -0,0 +1,56 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import mock
+import oslotest.base as oslotest
+
+from os_vm_expire.common import cache
+
+
+class WhenTestingLRUCache(oslotest.BaseTestCase):
+
+    def test_get_set(self):
+        lru = cache.LRUCache('test', 10, 60)
+        self.assertIs(cache.MISSING, lru.get('a'))
+        lru.set('a', 1)
+        self.assertEqual(1, lru.get('a'))
+        self.assertEqual(1, lru.hits)
+        self.assertEqual(1, lru.misses)
+
+    def test_least_recently_used_is_evicted(self):
+        lru = cache.LRUCache('test', 2, 60)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+        self.assertEqual(1, lru.get('a'))
+        self.assertIs(cache.MISSING, lru.get('b'))
+        self.assertEqual(3, lru.get('c'))
+        self.assertEqual(1, lru.evictions)
+
+    @mock.patch('time.time')
+    def test_entries_expire(self, mock_time):
+        mock_time.return_value = 1000
+        lru = cache.LRUCache('test', 10, 60, negative_ttl=10)
+        lru.set('a', 1)
+        lru.set('b', None, negative=True)
+        mock_time.return_value = 1020
+        self.assertEqual(1, lru.get('a'))
+        self.assertIs(cache.MISSING, lru.get('b'))
+        mock_time.return_value = 1100
+        self.assertIs(cache.MISSING, lru.get('a'))
+        self.assertEqual(0, len(lru))
+
+    def test_disabled(self):
+        lru = cache.LRUCache('test', 0, 60)
+        lru.set('a', 1)
+        self.assertIs(cache.MISSING, lru.get('a'))
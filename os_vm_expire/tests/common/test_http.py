@@ -0,0 +1,53 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import mock
+import oslotest.base as oslotest
+
+from os_vm_expire.common import config
+from os_vm_expire.common import http
+
+
+class WhenTestingHttpClient(oslotest.BaseTestCase):
+
+    def setUp(self):
+        super(WhenTestingHttpClient, self).setUp()
+        http.reset()
+        self.addCleanup(http.reset)
+
+    def test_session_is_shared(self):
+        self.assertIs(http.get_session(), http.get_session())
+
+    def test_session_is_pooled_with_retries(self):
+        config.CONF.set_override('pool_size', 4, group='http')
+        config.CONF.set_override('retries', 2, group='http')
+        self.addCleanup(config.CONF.clear_override, 'pool_size',
+                        group='http')
+        self.addCleanup(config.CONF.clear_override, 'retries', group='http')
+        adapter = http.get_session().get_adapter('https://nova')
+        self.assertEqual(4, adapter._pool_maxsize)
+        self.assertEqual(2, adapter.max_retries.total)
+        self.assertIn(503, adapter.max_retries.status_forcelist)
+
+    @mock.patch('requests.Session.request')
+    def test_request_has_default_timeout(self, mock_request):
+        http.get('http://nova/servers')
+        mock_request.assert_called_once_with(
+            'get', 'http://nova/servers',
+            timeout=(config.CONF.http.connect_timeout,
+                     config.CONF.http.read_timeout))
+
+    @mock.patch('requests.Session.request')
+    def test_request_timeout_can_be_overridden(self, mock_request):
+        http.delete('http://nova/servers/1', timeout=1)
+        mock_request.assert_called_once_with(
+            'delete', 'http://nova/servers/1', timeout=1)
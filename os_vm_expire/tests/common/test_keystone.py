@@ -0,0 +1,144 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import datetime
+
+import mock
+import oslotest.base as oslotest
+
+from os_vm_expire.common import keystone
+from os_vm_expire.tests import utils
+
+
+class MockResponse(object):
+    def __init__(self, json_data, status_code, token=None):
+        self.json_data = json_data
+        self.status_code = status_code
+        self.headers = {}
+        if token:
+            self.headers['X-Subject-Token'] = token
+
+    def json(self):
+        return self.json_data
+
+
+def mocked_auth(expires_in, token='XXX'):
+    expires_at = datetime.datetime.utcnow() + datetime.timedelta(
+        seconds=expires_in)
+    return MockResponse(
+        {'token': {'expires_at': expires_at.isoformat() + 'Z'}},
+        201,
+        token=token
+    )
+
+
+class WhenTestingTokenCache(oslotest.BaseTestCase):
+
+    def setUp(self):
+        super(WhenTestingTokenCache, self).setUp()
+        utils.mock_pooled_http(self)
+        self.cache = keystone.TokenCache('worker')
+
+    @mock.patch('requests.post')
+    def test_token_is_reused(self, mock_post):
+        mock_post.return_value = mocked_auth(3600)
+        for i in range(500):
+            self.assertEqual('XXX', self.cache.get_token())
+        self.assertEqual(1, mock_post.call_count)
+
+    @mock.patch('requests.post')
+    def test_token_is_renewed_before_expiration(self, mock_post):
+        mock_post.side_effect = [mocked_auth(60, 'XXX'),
+                                 mocked_auth(3600, 'YYY')]
+        self.assertEqual('XXX', self.cache.get_token())
+        self.assertEqual('YYY', self.cache.get_token())
+        self.assertEqual('YYY', self.cache.get_token())
+        self.assertEqual(2, mock_post.call_count)
+
+    @mock.patch('requests.post')
+    def test_token_without_expiration(self, mock_post):
+        mock_post.return_value = MockResponse(None, 201, token='XXX')
+        self.assertEqual('XXX', self.cache.get_token())
+        self.assertEqual('XXX', self.cache.get_token())
+        self.assertEqual(1, mock_post.call_count)
+
+    @mock.patch('requests.post')
+    def test_failed_authentication(self, mock_post):
+        mock_post.return_value = MockResponse(None, 401)
+        self.assertIsNone(self.cache.get_token())
+
+
+class WhenTestingKeystoneRequest(oslotest.BaseTestCase):
+
+    def setUp(self):
+        super(WhenTestingKeystoneRequest, self).setUp()
+        utils.mock_pooled_http(self)
+        keystone._TOKEN_CACHES.clear()
+        keystone._METADATA_CACHES.clear()
+        self.addCleanup(keystone._TOKEN_CACHES.clear)
+        self.addCleanup(keystone._METADATA_CACHES.clear)
+
+    @mock.patch('requests.get')
+    @mock.patch('requests.post')
+    def test_retry_once_on_unauthorized(self, mock_post, mock_get):
+        mock_post.side_effect = [mocked_auth(3600, 'XXX'),
+                                 mocked_auth(3600, 'YYY')]
+        mock_get.side_effect = [MockResponse(None, 401),
+                                MockResponse({}, 200)]
+        r = keystone.request('get', 'http://nova/servers/1', 'worker')
+        self.assertEqual(200, r.status_code)
+        self.assertEqual(2, mock_post.call_count)
+        tokens = [c[1]['headers']['X-Auth-Token']
+                  for c in mock_get.call_args_list]
+        self.assertEqual(['XXX', 'YYY'], tokens)
+
+    @mock.patch('requests.get')
+    @mock.patch('requests.post')
+    def test_no_retry_on_success(self, mock_post, mock_get):
+        mock_post.return_value = mocked_auth(3600)
+        mock_get.return_value = MockResponse({}, 200)
+        for i in range(10):
+            keystone.request('get', 'http://nova/servers/1', 'worker')
+        self.assertEqual(1, mock_post.call_count)
+        self.assertEqual(10, mock_get.call_count)
+
+    @mock.patch('requests.get')
+    @mock.patch('requests.post')
+    def test_project_is_cached(self, mock_post, mock_get):
+        mock_post.return_value = mocked_auth(3600)
+        mock_get.return_value = MockResponse(
+            {'project': {'name': 'test', 'domain_id': 'default'}}, 200)
+        for i in range(10):
+            project = keystone.get_project('12345project', 'worker')
+            self.assertEqual('default', project['domain_id'])
+        self.assertEqual(1, mock_get.call_count)
+
+    @mock.patch('requests.get')
+    @mock.patch('requests.post')
+    def test_unknown_user_is_cached(self, mock_post, mock_get):
+        mock_post.return_value = mocked_auth(3600)
+        mock_get.return_value = MockResponse(None, 404)
+        for i in range(10):
+            self.assertIsNone(keystone.get_user('12345user', 'cleaner'))
+        self.assertEqual(1, mock_get.call_count)
+
+    @mock.patch('requests.get')
+    @mock.patch('requests.post')
+    def test_errors_are_not_cached(self, mock_post, mock_get):
+        mock_post.return_value = mocked_auth(3600)
+        mock_get.side_effect = [
+            MockResponse(None, 503),
+            MockResponse({'user': {'email': 'test@localhost'}}, 200)
+        ]
+        self.assertIsNone(keystone.get_user('12345user', 'cleaner'))
+        user = keystone.get_user('12345user', 'cleaner')
+        self.assertEqual('test@localhost', user['email'])
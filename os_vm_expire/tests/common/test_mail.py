@@ -0,0 +1,67 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import smtplib
+
+import mock
+import oslotest.base as oslotest
+
+from os_vm_expire.common import config
+from os_vm_expire.common import mail
+
+
+class WhenTestingSMTPPool(oslotest.BaseTestCase):
+
+    def setUp(self):
+        super(WhenTestingSMTPPool, self).setUp()
+        patcher = mock.patch('smtplib.SMTP')
+        self.mock_smtp = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_connection_is_reused(self):
+        pool = mail.SMTPPool(1)
+        for _ in range(3):
+            pool.sendmail('from', ['to'], 'msg')
+        self.assertEqual(1, self.mock_smtp.call_count)
+        self.assertEqual(3, self.mock_smtp.return_value.sendmail.call_count)
+        self.assertEqual(3, pool.sent)
+        pool.close()
+        self.mock_smtp.return_value.quit.assert_called_once_with()
+
+    def test_reconnect_after_max_messages(self):
+        config.CONF.set_override('email_smtp_max_messages', 2, group='smtp')
+        self.addCleanup(config.CONF.clear_override,
+                        'email_smtp_max_messages', group='smtp')
+        pool = mail.SMTPPool(1)
+        for _ in range(3):
+            pool.sendmail('from', ['to'], 'msg')
+        self.assertEqual(2, self.mock_smtp.call_count)
+
+    def test_reconnect_on_disconnect(self):
+        self.mock_smtp.return_value.sendmail.side_effect = [
+            smtplib.SMTPServerDisconnected(), None]
+        pool = mail.SMTPPool(1)
+        pool.sendmail('from', ['to'], 'msg')
+        self.assertEqual(2, self.mock_smtp.call_count)
+        self.assertEqual(1, pool.sent)
+
+    def test_failure_is_raised(self):
+        self.mock_smtp.return_value.sendmail.side_effect = (
+            smtplib.SMTPRecipientsRefused({}))
+        pool = mail.SMTPPool(1)
+        self.assertRaises(smtplib.SMTPRecipientsRefused,
+                          pool.sendmail, 'from', ['to'], 'msg')
+        self.assertEqual(1, pool.failures)
+
+    def test_one_off_connection_is_closed(self):
+        mail.sendmail('from', ['to'], 'msg')
+        self.mock_smtp.return_value.quit.assert_called_once_with()
@@ -0,0 +1,74 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import oslotest.base as oslotest
+import webob
+import webtest
+
+from os_vm_expire.api.middleware import metrics as metrics_mw
+from os_vm_expire.common import metrics
+
+
+class WhenTestingMetrics(oslotest.BaseTestCase):
+
+    def setUp(self):
+        super(WhenTestingMetrics, self).setUp()
+        self.counter = metrics.Counter('test_total', 'Test counter',
+                                       ['kind'])
+        self.histogram = metrics.Histogram('test_seconds', 'Test histogram',
+                                           buckets=(0.1, 1.0))
+        self.addCleanup(metrics._REGISTRY.remove, self.counter)
+        self.addCleanup(metrics._REGISTRY.remove, self.histogram)
+
+    def test_counter(self):
+        self.counter.inc(kind='a')
+        self.counter.inc(2, kind='a')
+        self.counter.inc(kind='b"c')
+        self.assertEqual(3, self.counter.get(kind='a'))
+        self.assertEqual(
+            ['# HELP test_total Test counter',
+             '# TYPE test_total counter',
+             'test_total{kind="a"} 3.0',
+             'test_total{kind="b\\"c"} 1.0'],
+            self.counter.render())
+        self.assertRaises(ValueError, self.counter.inc, other='a')
+
+    def test_histogram(self):
+        self.histogram.observe(0.05)
+        self.histogram.observe(0.5)
+        self.histogram.observe(5)
+        self.assertEqual(3, self.histogram.get_count())
+        self.assertEqual(
+            ['test_seconds_bucket{le="0.1"} 1.0',
+             'test_seconds_bucket{le="1.0"} 2.0',
+             'test_seconds_bucket{le="+Inf"} 3.0',
+             'test_seconds_count 3.0',
+             'test_seconds_sum 5.55'],
+            self.histogram.render()[2:])
+
+    def test_render(self):
+        self.counter.inc(kind='a')
+        self.assertIn(b'test_total{kind="a"} 1.0\n', metrics.render())
+        self.assertIn(b'# TYPE osvmexpire_db_query_seconds histogram\n',
+                      metrics.render())
+
+    def test_middleware(self):
+        self.counter.inc(kind='a')
+        app = webtest.TestApp(metrics_mw.MetricsMiddleware(
+            webob.Response(body=b'api')))
+        resp = app.get('/metrics')
+        self.assertEqual(metrics.CONTENT_TYPE, resp.headers['Content-Type'])
+        self.assertIn('test_total{kind="a"} 1.0', resp.text)
+        self.assertEqual(b'api', app.get('/v1/').body)
+
+    def test_http_server_disabled(self):
+        self.assertIsNone(metrics.start_http_server('127.0.0.1', 0))
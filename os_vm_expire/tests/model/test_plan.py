@@ -0,0 +1,87 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import mock
+import subprocess
+import sys
+
+from os_vm_expire.common import config
+from os_vm_expire.model import models
+from os_vm_expire.model import plan
+from os_vm_expire.model import repositories
+from os_vm_expire.tests import database_utils
+
+
+def create_vmexpire(prefix, user, expire, notified=False,
+                    notified_last=False):
+    entity = models.VmExpire()
+    entity.user_id = user
+    entity.project_id = 'project1'
+    entity.instance_id = prefix + 'instance'
+    entity.instance_name = prefix
+    entity.expire = expire
+    entity.notified = notified
+    entity.notified_last = notified_last
+    entity.notified_time = 10 if notified else None
+    repositories.get_vmexpire_repository().create_from(entity)
+
+
+class WhenTestingPlan(database_utils.RepositoryTestCase):
+
+    def setUp(self):
+        super(WhenTestingPlan, self).setUp()
+        self.repo = repositories.get_vmexpire_repository()
+        self.addCleanup(self.cleanup)
+        create_vmexpire('first1', 'user1', 100)
+        create_vmexpire('first2', 'user1', 100)
+        create_vmexpire('last', 'user2', 100, notified=True)
+        create_vmexpire('delete', 'user2', 100, notified=True,
+                        notified_last=True)
+        create_vmexpire('later', 'user3', 10 ** 10)
+        repositories.commit()
+
+    def cleanup(self):
+        self.repo.delete_all_entities()
+        repositories.commit()
+
+    @mock.patch('os_vm_expire.common.keystone.get_token')
+    def test_plan(self, mock_token):
+        res = plan.get_plan(now=10 ** 9)
+        self.assertEqual(
+            [('project1', 'user1', 2, 0, 0), ('project1', 'user2', 0, 1, 1)],
+            res['rows'])
+        self.assertEqual([2, 1, 1], list(res['totals'].values()))
+        self.assertEqual({'keystone': 4, 'nova': 1, 'smtp': 4},
+                         dict(res['calls']))
+        self.assertFalse(mock_token.called)
+        self.assertEqual(
+            [('delete', True, True), ('first1', False, False),
+             ('first2', False, False), ('last', True, False),
+             ('later', False, False)],
+            sorted((entity.instance_name, entity.notified,
+                    entity.notified_last)
+                   for entity in self.repo.get_entities()))
+        report = plan.format_plan(res)
+        self.assertIn('2 first notices, 1 last notices, 1 deletions', report)
+        self.assertIn('At most 4 Keystone, 1 Nova and 4 SMTP calls', report)
+
+    def test_plan_digest(self):
+        config.CONF.set_override('email_digest', True, group='cleaner')
+        self.addCleanup(config.CONF.clear_override, 'email_digest',
+                        group='cleaner')
+        self.assertEqual(2, plan.get_plan(now=10 ** 9)['calls']['smtp'])
+
+    def test_manage_does_not_import_cleaner(self):
+        # the cleaner monkey patches the standard library on import
+        code = ('import sys; import os_vm_expire.cmd.expire_manage; '
+                'sys.exit("os_vm_expire.cmd.cleaner" in sys.modules)')
+        self.assertEqual(0, subprocess.call([sys.executable, '-c', code]))
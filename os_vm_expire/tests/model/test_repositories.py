@@ -0,0 +1,736 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import datetime
+import mock
+import sqlalchemy as sa
+
+from os_vm_expire.common import config
+from os_vm_expire.common import metrics
+from os_vm_expire.model import clean
+from os_vm_expire.model import models
+from os_vm_expire.model import query_stats
+from os_vm_expire.model import repositories
+from os_vm_expire.tests import database_utils
+
+
+def explain(session, query):
+    """Get the SQLite query plan details of an ORM query."""
+    statement = query.statement.compile(
+        dialect=session.get_bind().dialect,
+        compile_kwargs={'literal_binds': True})
+    rows = session.execute(sa.text('EXPLAIN QUERY PLAN %s' % statement))
+    return ' '.join(row[-1] for row in rows)
+
+
+class WhenTestingIndexes(database_utils.RepositoryTestCase):
+
+    def setUp(self):
+        super(WhenTestingIndexes, self).setUp()
+        self.session = repositories.get_session()
+
+    def test_cleaner_scan_uses_expire_index(self):
+        query = self.session.query(models.VmExpire).filter(
+            models.VmExpire.expire < 1000,
+            models.VmExpire.notified == sa.false())
+        self.assertIn('ix_vmexpire_expire_notified',
+                      explain(self.session, query))
+
+    def test_user_filter_uses_index(self):
+        query = self.session.query(models.VmExpire).filter_by(
+            user_id='user1')
+        self.assertIn('ix_vmexpire_user_id', explain(self.session, query))
+
+    def test_exclude_lookup_uses_index(self):
+        query = self.session.query(models.VmExclude).filter_by(
+            exclude_id='project1')
+        self.assertIn('ix_vmexclude_exclude_id',
+                      explain(self.session, query))
+
+
+def create_vmexpire(prefix, expire, notified=False, notified_last=False,
+                    notified_time=None):
+    entity = models.VmExpire()
+    entity.user_id = prefix + 'user'
+    entity.project_id = prefix + 'project'
+    entity.instance_id = prefix + 'instance'
+    entity.instance_name = prefix
+    entity.expire = expire
+    entity.notified = notified
+    entity.notified_last = notified_last
+    entity.notified_time = notified_time
+    repositories.get_vmexpire_repository().create_from(entity)
+    return entity.id
+
+
+class WhenTestingCleanerStages(database_utils.RepositoryTestCase):
+
+    def setUp(self):
+        super(WhenTestingCleanerStages, self).setUp()
+        self.repo = repositories.get_vmexpire_repository()
+        self.addCleanup(self.cleanup)
+        self.first = create_vmexpire('first', 100)
+        self.last = create_vmexpire('last', 100, notified=True,
+                                    notified_time=10)
+        self.delete = create_vmexpire('delete', 10, notified=True,
+                                      notified_last=True, notified_time=5)
+        self.recent = create_vmexpire('recent', 10, notified=True,
+                                      notified_last=True, notified_time=45)
+        self.legacy = create_vmexpire('legacy', 10, notified=True,
+                                      notified_last=True)
+        self.later = create_vmexpire('later', 1000)
+        repositories.commit()
+
+    def cleanup(self):
+        self.repo.delete_all_entities()
+        repositories.commit()
+
+    def ids(self, entities):
+        return set(entity.id for entity in entities)
+
+    def test_stages(self):
+        self.assertEqual(
+            set([self.first]),
+            self.ids(self.repo.get_first_notice_entities(500)))
+        self.assertEqual(
+            set([self.last]),
+            self.ids(self.repo.get_last_notice_entities(500)))
+        self.assertEqual(
+            set([self.delete]),
+            self.ids(self.repo.get_deletion_entities(50, 40)))
+
+    def test_get_plan_counts(self):
+        self.assertEqual(
+            [('deleteproject', 'deleteuser', 0, 0, 1),
+             ('firstproject', 'firstuser', 1, 0, 0),
+             ('lastproject', 'lastuser', 0, 1, 0)],
+            self.repo.get_plan_counts(50, 500, 500, 40))
+
+    def test_set_missing_notified_time(self):
+        self.assertEqual(1, self.repo.set_missing_notified_time(50))
+        repositories.commit()
+        self.assertEqual(50, self.repo.get(self.legacy).notified_time)
+        self.assertEqual(
+            set([self.delete]),
+            self.ids(self.repo.get_deletion_entities(50, 40)))
+
+    def test_set_notified(self):
+        self.repo.set_notified(self.first, notified_time=50)
+        self.repo.set_notified(self.last, last=True)
+        repositories.commit()
+        self.assertEqual(
+            set(), self.ids(self.repo.get_first_notice_entities(500)))
+        # first notice sent, now waiting for the last one
+        self.assertEqual(
+            set([self.first]),
+            self.ids(self.repo.get_last_notice_entities(500)))
+        self.assertEqual(50, self.repo.get(self.first).notified_time)
+
+
+class WhenTestingShards(database_utils.RepositoryTestCase):
+
+    def setUp(self):
+        super(WhenTestingShards, self).setUp()
+        self.repo = repositories.get_vmexpire_repository()
+        self.addCleanup(self.cleanup)
+        for i in range(20):
+            create_vmexpire('shard%d' % i, 100)
+        repositories.commit()
+
+    def cleanup(self):
+        self.repo.delete_all_entities()
+        repositories.commit()
+
+    def in_shard(self, instance_id, shard_index):
+        return models.get_shard_hash(instance_id) % 3 == shard_index
+
+    def test_shard_hash_stored(self):
+        self.repo.create_all([repositories.get_vmexpire_values(
+            'bulk', listed_instance('bulk'))])
+        entities = self.repo.get_entities()
+        self.assertEqual(21, len(entities))
+        for entity in entities:
+            self.assertEqual(models.get_shard_hash(entity.instance_id),
+                             entity.shard_hash)
+
+    def test_due_times_of_shard(self):
+        # rows of other shards do not fill the limit
+        for shard_index in range(3):
+            due_times = self.repo.get_due_times(1000, 10, 5, limit=2,
+                                                shard=(shard_index, 3))
+            self.assertEqual(2, len(due_times))
+            for (_, _, instance_id) in due_times:
+                self.assertTrue(self.in_shard(instance_id, shard_index))
+
+    def test_stage_entities_of_shard(self):
+        handled = []
+        for shard_index in range(3):
+            instance_ids = [entity.instance_id for entity in
+                            self.repo.get_first_notice_entities(
+                                500, shard=(shard_index, 3))]
+            for instance_id in instance_ids:
+                self.assertTrue(self.in_shard(instance_id, shard_index))
+            handled.extend(instance_ids)
+        self.assertEqual(20, len(set(handled)))
+
+    def test_rows_without_hash_in_first_shard(self):
+        self.repo.get_session().query(models.VmExpire).update(
+            {'shard_hash': None}, synchronize_session=False)
+        repositories.commit()
+        self.assertEqual(20, len(list(self.repo.get_first_notice_entities(
+            500, shard=(0, 3)))))
+        self.assertEqual([], list(self.repo.get_first_notice_entities(
+            500, shard=(1, 3))))
+
+
+class WhenTestingOutboxShards(database_utils.RepositoryTestCase):
+
+    def setUp(self):
+        super(WhenTestingOutboxShards, self).setUp()
+        self.outbox_repo = repositories.get_outbox_repository()
+        self.addCleanup(self.cleanup)
+        self.outbox_repo.enqueue_all(
+            [('notify_first', {'vmexpire_id': 'id%d' % i,
+                               'instance_id': 'shard%dinstance' % i,
+                               'instance_name': 'shard%d' % i,
+                               'project_id': 'project',
+                               'user_id': 'user',
+                               'expire': 100})
+             for i in range(20)], 10)
+        repositories.commit()
+
+    def cleanup(self):
+        self.outbox_repo.delete_all_entities()
+        repositories.commit()
+
+    def test_get_ready_of_shard(self):
+        # ready actions of other shards do not fill the limit
+        handled = []
+        for shard_index in range(3):
+            entities = self.outbox_repo.get_ready(50, limit=2,
+                                                  shard=(shard_index, 3))
+            self.assertEqual(2, len(entities))
+            for entity in entities:
+                self.assertEqual(models.get_shard_hash(entity.instance_id),
+                                 entity.shard_hash)
+                self.assertEqual(shard_index, entity.shard_hash % 3)
+            handled.extend(entity.id for entity in entities)
+        self.assertEqual(6, len(set(handled)))
+
+    def test_get_next_attempts_of_shard(self):
+        for shard_index in range(3):
+            for (_, _, instance_id) in self.outbox_repo.get_next_attempts(
+                    50, shard=(shard_index, 3)):
+                self.assertEqual(
+                    shard_index, models.get_shard_hash(instance_id) % 3)
+
+    def test_repository_singleton(self):
+        self.assertIs(self.outbox_repo,
+                      repositories.get_outbox_repository())
+
+
+class WhenTestingStreamedReads(database_utils.RepositoryTestCase):
+
+    def setUp(self):
+        super(WhenTestingStreamedReads, self).setUp()
+        self.repo = repositories.get_vmexpire_repository()
+        self.addCleanup(self.cleanup)
+        for i in range(5):
+            create_vmexpire('stream%d' % i, 100 * i)
+        repositories.commit()
+
+    def cleanup(self):
+        self.repo.delete_all_entities()
+        repositories.commit()
+
+    def test_iter_all_by(self):
+        entities = self.repo.iter_all_by(expire_before=300, batch_size=2)
+        self.assertEqual([0, 100, 200, 300],
+                         [entity.expire for entity in entities])
+
+    def test_iter_entities(self):
+        entities = list(self.repo.iter_entities(expiration_filter=200,
+                                                batch_size=1))
+        self.assertEqual(2, len(entities))
+
+    def test_iter_project_entities(self):
+        entities = list(self.repo.iter_project_entities('stream1project'))
+        self.assertEqual(['stream1'],
+                         [entity.instance_name for entity in entities])
+
+
+class WhenTestingBatchedDeletes(database_utils.RepositoryTestCase):
+
+    def setUp(self):
+        super(WhenTestingBatchedDeletes, self).setUp()
+        self.repo = repositories.get_vmexpire_repository()
+        self.addCleanup(self.cleanup)
+        for i in range(5):
+            create_vmexpire('batch%d' % i, 100)
+        create_vmexpire('other', 100)
+        repositories.commit()
+
+    def cleanup(self):
+        self.repo.delete_all_entities()
+        repositories.commit()
+
+    def batch_query(self):
+        return repositories.get_session().query(models.VmExpire).filter(
+            models.VmExpire.instance_name.like('batch%'))
+
+    @mock.patch('time.sleep')
+    def test_delete_in_batches(self, mock_sleep):
+        count = repositories.delete_in_batches(self.batch_query(),
+                                               batch_size=2, sleep=1)
+        self.assertEqual(5, count)
+        self.assertEqual(0, self.batch_query().count())
+        self.assertEqual(1, len(self.repo.get_entities()))
+        # no sleep after the last, incomplete, batch
+        self.assertEqual(2, mock_sleep.call_args_list.count(mock.call(1)))
+
+    def test_delete_project_entities(self):
+        self.repo.delete_project_entities('batch1project')
+        self.assertEqual(4, self.batch_query().count())
+
+    def test_cleanup_softdeletes(self):
+        self.batch_query().update({'deleted': True},
+                                  synchronize_session=False)
+        repositories.commit()
+        count = clean.cleanup_softdeletes(models.VmExpire, batch_size=2)
+        self.assertEqual(5, count)
+        self.assertEqual(1, len(self.repo.get_entities()))
+
+    def test_clean_command_db_url(self):
+        yesterday = datetime.datetime.utcnow() - datetime.timedelta(days=1)
+        self.batch_query().update(
+            {'deleted': True, 'deleted_at': yesterday},
+            synchronize_session=False)
+        repositories.commit()
+        # the [database] options are not registered yet
+        conf = config.new_config()
+        with mock.patch.object(clean, 'CONF', conf):
+            clean.clean_command('sqlite:///test.db', -1, False, None,
+                                batch_size=2)
+        self.assertEqual(1, len(self.repo.get_entities()))
+        self.assertIsNone(conf.database.connection)
+
+
+class MockResponse(object):
+    def __init__(self, json_data, status_code=200):
+        self.json_data = json_data
+        self.status_code = status_code
+
+    def json(self):
+        return self.json_data
+
+
+def nova_server(instance_id, project_id='project'):
+    return {'id': instance_id, 'name': 'vm' + instance_id,
+            'tenant_id': project_id, 'user_id': 'user'}
+
+
+def listed_instance(instance_id, project_id='project'):
+    return {'id': instance_id, 'display_name': 'vm' + instance_id,
+            'tenant_id': project_id, 'user_id': 'user'}
+
+
+class WhenTestingReconcile(database_utils.RepositoryTestCase):
+
+    def setUp(self):
+        super(WhenTestingReconcile, self).setUp()
+        self.repo = repositories.get_vmexpire_repository()
+        self.exclude_repo = repositories.get_vmexclude_repository()
+        self.addCleanup(self.cleanup)
+        create_vmexpire('live', 100)
+        create_vmexpire('gone', 100)
+        database_utils.create_vmexclude('excludedproject',
+                                        repositories.EXCLUDE_PROJECT)
+        repositories.commit()
+
+    def cleanup(self):
+        self.repo.delete_all_entities()
+        self.exclude_repo.delete_all_entities()
+        repositories.commit()
+
+    @mock.patch('os_vm_expire.common.keystone.request')
+    def test_list_instances_pages(self, mock_request):
+        mock_request.side_effect = [
+            MockResponse({'servers': [nova_server('1'), nova_server('2')]}),
+            MockResponse({'servers': [nova_server('3')]}),
+            MockResponse({'servers': []}),
+        ]
+        servers = list(repositories.list_instances(page_size=2))
+        self.assertEqual(['1', '2', '3'], [s['id'] for s in servers])
+        self.assertEqual(
+            {'all_tenants': 1, 'limit': 2, 'marker': '3'},
+            mock_request.call_args[1]['params'])
+
+    @mock.patch('os_vm_expire.common.keystone.request')
+    def test_list_instances_pages_capped_by_nova(self, mock_request):
+        # Nova [api] max_limit of 2, below the requested page size
+        next_link = [{'rel': 'next', 'href': 'http://nova/servers?marker=x'}]
+        mock_request.side_effect = [
+            MockResponse({'servers': [nova_server('1'), nova_server('2')],
+                          'servers_links': next_link}),
+            MockResponse({'servers': [nova_server('3'), nova_server('4')],
+                          'servers_links': next_link}),
+            MockResponse({'servers': [nova_server('5')],
+                          'servers_links': []}),
+        ]
+        servers = list(repositories.list_instances(page_size=10))
+        self.assertEqual(['1', '2', '3', '4', '5'],
+                         [s['id'] for s in servers])
+        self.assertEqual(3, mock_request.call_count)
+        self.assertEqual(
+            {'all_tenants': 1, 'limit': 10, 'marker': '4'},
+            mock_request.call_args[1]['params'])
+
+    @mock.patch('os_vm_expire.common.keystone.request')
+    def test_list_instances_fails_on_error(self, mock_request):
+        mock_request.return_value = MockResponse(None, 500)
+        self.assertRaises(Exception, list, repositories.list_instances())
+
+    @mock.patch('os_vm_expire.model.repositories.get_project_domain',
+                return_value='domain')
+    @mock.patch('os_vm_expire.model.repositories.list_instances')
+    def test_reconcile(self, mock_list, mock_domain):
+        mock_list.return_value = [
+            listed_instance('liveinstance'),
+            listed_instance('new1'),
+            listed_instance('new2'),
+            listed_instance('skipped', project_id='excludedproject'),
+        ]
+        res = self.repo.reconcile()
+        self.assertEqual(['goneinstance'], res['removed'])
+        self.assertEqual(['new1', 'new2'], res['added'])
+        self.assertEqual(['skipped'], res['excluded'])
+        self.assertEqual(
+            ['liveinstance', 'new1', 'new2'],
+            sorted(e.instance_id for e in self.repo.get_entities()))
+        mock_domain.assert_any_call('project')
+        self.assertEqual(2, mock_domain.call_count)
+
+    @mock.patch('os_vm_expire.model.repositories.get_project_domain',
+                return_value='domain')
+    @mock.patch('os_vm_expire.model.repositories.list_instances')
+    def test_reconcile_dry_run(self, mock_list, mock_domain):
+        mock_list.return_value = [listed_instance('new1')]
+        res = self.repo.reconcile(dry_run=True)
+        self.assertEqual(['goneinstance', 'liveinstance'], res['removed'])
+        self.assertEqual(['new1'], res['added'])
+        self.assertEqual(2, len(self.repo.get_entities()))
+
+    def test_create_all_skips_tracked(self):
+        values = [
+            repositories.get_vmexpire_values(
+                instance_id, {'display_name': 'vm', 'tenant_id': 'project',
+                              'user_id': 'user'})
+            for instance_id in ('liveinstance', 'new1', 'new2')
+        ]
+        self.assertEqual(['new1', 'new2'],
+                         self.repo.create_all(values, batch_size=2))
+        self.assertEqual(4, len(self.repo.get_entities()))
+
+    @mock.patch('os_vm_expire.model.repositories.get_project_domain',
+                return_value='domain')
+    @mock.patch('os_vm_expire.model.repositories.list_instances')
+    def test_add_vms(self, mock_list, mock_domain):
+        mock_list.return_value = [
+            listed_instance('liveinstance'),
+            listed_instance('new1'),
+            listed_instance('skipped', project_id='excludedproject'),
+            listed_instance('other'),
+        ]
+        res = self.repo.add_vms(
+            instance_uuids=['new1', 'liveinstance', 'skipped', 'unknown',
+                            'new1'])
+        self.assertEqual(
+            [('new1', 'added'), ('liveinstance', 'exists'),
+             ('skipped', 'excluded'), ('unknown', 'not_found')],
+            [(r['instance_id'], r['result']) for r in res])
+        self.assertEqual(
+            res[0]['id'],
+            self.repo.get_by_instance('new1').id)
+        self.assertEqual(
+            ['goneinstance', 'liveinstance', 'new1'],
+            sorted(e.instance_id for e in self.repo.get_entities()))
+
+    @mock.patch('os_vm_expire.model.repositories.get_project_domain',
+                return_value='domain')
+    @mock.patch('os_vm_expire.model.repositories.list_instances')
+    def test_add_vms_all_project(self, mock_list, mock_domain):
+        mock_list.return_value = [
+            listed_instance('liveinstance'),
+            listed_instance('new1'),
+        ]
+        res = self.repo.add_vms(project_id='project')
+        mock_list.assert_called_once_with(project_id='project')
+        self.assertEqual(
+            [('liveinstance', 'exists'), ('new1', 'added')],
+            [(r['instance_id'], r['result']) for r in res])
+
+
+class WhenTestingBulkExtend(database_utils.RepositoryTestCase):
+
+    def setUp(self):
+        super(WhenTestingBulkExtend, self).setUp()
+        self.repo = repositories.get_vmexpire_repository()
+        self.addCleanup(self.cleanup)
+        self.recent_id = create_vmexpire('recent', 100, notified=True)
+        self.old_id = create_vmexpire('old', 100)
+        self.other_id = create_vmexpire('other', 100)
+        session = self.repo.get_session()
+        session.query(models.VmExpire).filter_by(id=self.old_id).update(
+            {'created_at': datetime.datetime(2000, 1, 1)})
+        session.query(models.VmExpire).filter_by(
+            id=self.other_id).update({'project_id': 'recentproject'})
+        repositories.commit()
+
+    def cleanup(self):
+        self.repo.delete_all_entities()
+        repositories.commit()
+
+    def test_extend_project(self):
+        res = self.repo.extend_vms(project_id='recentproject')
+        repositories.commit()
+        self.assertEqual(sorted([self.recent_id, self.other_id]),
+                         sorted(res['extended']))
+        self.assertEqual([], res['capped'])
+        entity = self.repo.get(self.recent_id)
+        self.assertEqual(res['expire'], entity.expire)
+        self.assertFalse(entity.notified)
+        self.assertEqual(100, self.repo.get(self.old_id).expire)
+
+    def test_extend_ids_reports_capped(self):
+        res = self.repo.extend_vms(
+            entity_ids=[self.recent_id, self.old_id, 'unknown'])
+        repositories.commit()
+        self.assertEqual([self.recent_id], res['extended'])
+        self.assertEqual([self.old_id], res['capped'])
+        self.assertEqual(['unknown'], res['not_found'])
+        self.assertEqual(100, self.repo.get(self.old_id).expire)
+        self.assertEqual(100, self.repo.get(self.other_id).expire)
+
+    def test_extend_ids_of_project(self):
+        res = self.repo.extend_vms(project_id='oldproject',
+                                   entity_ids=[self.recent_id])
+        self.assertEqual([], res['extended'])
+        self.assertEqual([self.recent_id], res['not_found'])
+
+    def test_extend_requires_filter(self):
+        self.assertRaises(ValueError, self.repo.extend_vms)
+
+
+class WhenTestingUpsert(database_utils.RepositoryTestCase):
+
+    def setUp(self):
+        super(WhenTestingUpsert, self).setUp()
+        self.repo = repositories.get_vmexpire_repository()
+        self.addCleanup(self.cleanup)
+
+    def cleanup(self):
+        self.repo.delete_all_entities()
+        repositories.commit()
+
+    def test_upsert_inserts_then_replaces(self):
+        values = repositories.get_vmexpire_values(
+            'upserted', {'display_name': 'vm', 'tenant_id': 'project',
+                         'user_id': 'user'})
+        self.repo.upsert(values)
+        repositories.commit()
+        entity_id = self.repo.get_by_instance('upserted').id
+        self.assertEqual(values['id'], entity_id)
+        self.repo.set_notified(entity_id)
+        repositories.commit()
+
+        values = repositories.get_vmexpire_values(
+            'upserted', {'display_name': 'renamed', 'tenant_id': 'project',
+                         'user_id': 'user'})
+        self.repo.upsert(values)
+        repositories.commit()
+        repositories.clear()
+        entities = self.repo.get_entities()
+        self.assertEqual(1, len(entities))
+        self.assertEqual(entity_id, entities[0].id)
+        self.assertEqual('renamed', entities[0].instance_name)
+        self.assertFalse(entities[0].notified)
+
+    def test_delete_by_instance_id(self):
+        create_vmexpire('deleted', 100)
+        repositories.commit()
+        self.assertEqual(1, self.repo.delete_by_instance_id('deletedinstance'))
+        self.assertEqual(0, self.repo.delete_by_instance_id('deletedinstance'))
+        repositories.commit()
+        self.assertEqual(0, len(self.repo.get_entities()))
+
+
+class WhenTestingDueTimes(database_utils.RepositoryTestCase):
+
+    def setUp(self):
+        super(WhenTestingDueTimes, self).setUp()
+        self.repo = repositories.get_vmexpire_repository()
+        self.addCleanup(self.cleanup)
+
+    def cleanup(self):
+        self.repo.delete_all_entities()
+        repositories.commit()
+
+    def test_get_due_times(self):
+        first = create_vmexpire('first', 1000)
+        last = create_vmexpire('last', 1000, notified=True,
+                               notified_time=500)
+        deleted = create_vmexpire('deleted', 1000, notified=True,
+                                  notified_last=True, notified_time=950)
+        create_vmexpire('later', 5000)
+        repositories.commit()
+        due_times = self.repo.get_due_times(1100, 100, 20)
+        self.assertEqual(
+            [(900, first, 'firstinstance'), (980, last, 'lastinstance'),
+             (1050, deleted, 'deletedinstance')],
+            sorted(due_times))
+
+
+class WhenTestingQueryStats(database_utils.RepositoryTestCase):
+
+    def setUp(self):
+        config.CONF.set_override('slow_query_threshold', 0.000001,
+                                 group='metrics')
+        config.CONF.set_override('query_stats_interval', 3600,
+                                 group='metrics')
+        self.addCleanup(self.reset_stats)
+        self.addCleanup(config.CONF.clear_override, 'slow_query_threshold',
+                        group='metrics')
+        self.addCleanup(config.CONF.clear_override, 'query_stats_interval',
+                        group='metrics')
+        super(WhenTestingQueryStats, self).setUp()
+        self.repo = repositories.get_vmexpire_repository()
+        self.addCleanup(self.cleanup)
+        create_vmexpire('stats', 1000)
+        repositories.commit()
+        query_stats.get_stats().reset()
+
+    def cleanup(self):
+        self.repo.delete_all_entities()
+        repositories.commit()
+
+    def reset_stats(self):
+        query_stats.setup(repositories._ENGINE)
+
+    def get_stats(self, prefix):
+        (stats,) = [stats for (key, stats)
+                    in query_stats.get_stats().statements.items()
+                    if key.startswith(prefix)]
+        return stats
+
+    def test_fingerprint(self):
+        self.assertEqual(
+            'SELECT a FROM t WHERE b = ? AND c IN (?+) AND d = ?',
+            query_stats.fingerprint(
+                "SELECT a\n  FROM t WHERE b = 'it''s' AND c IN (?, ?, ?)"
+                " AND d = 12.5"))
+        self.assertEqual(
+            'UPDATE t SET a=? WHERE b IN (?+)',
+            query_stats.fingerprint(
+                'UPDATE t SET a=%(a)s WHERE b IN (%s, %s)'))
+
+    def test_statements_tagged_with_method(self):
+        slow = metrics.SLOW_QUERIES.get(method='VmExpireRepo.get_count')
+        with mock.patch.object(query_stats.LOG, 'warning') as warning:
+            self.assertEqual(1, self.repo.get_count('statsproject'))
+        self.assertEqual('VmExpireRepo.get_count',
+                         warning.call_args[0][1]['tag'])
+        self.assertEqual(slow + warning.call_count,
+                         metrics.SLOW_QUERIES.get(
+                             method='VmExpireRepo.get_count'))
+        self.assertEqual(['VmExpireRepo.get_count'],
+                         list(self.get_stats('SELECT count').tags))
+
+    def test_iterator_statements_tagged(self):
+        entities = self.repo.iter_entities()
+        self.assertEqual('-', query_stats.current_tag())
+        self.assertEqual(1, len(list(entities)))
+        self.assertEqual(['VmExpireRepo.iter_entities'],
+                         list(self.get_stats('SELECT vmexpire').tags))
+
+    def test_stage_query_tagged_and_timed(self):
+        labels = {'repository': 'VmExpireRepo',
+                  'method': 'get_first_notice_entities'}
+        queries = metrics.DB_QUERY_SECONDS.get_count(**labels)
+        entities = self.repo.get_first_notice_entities(2000)
+        self.assertEqual(queries,
+                         metrics.DB_QUERY_SECONDS.get_count(**labels))
+        self.assertEqual(1, len(list(entities)))
+        self.assertEqual(queries + 1,
+                         metrics.DB_QUERY_SECONDS.get_count(**labels))
+        self.assertEqual(['VmExpireRepo.get_first_notice_entities'],
+                         list(self.get_stats('SELECT vmexpire').tags))
+
+    def test_streamed_reads_stay_queries(self):
+        for entities in (self.repo.iter_entities(),
+                         self.repo.iter_all_by(project_id='statsproject'),
+                         self.repo.iter_project_entities('statsproject'),
+                         repositories.get_vmexclude_repository()
+                         .iter_type_entities(),
+                         self.repo.get_first_notice_entities(2000),
+                         self.repo.get_last_notice_entities(2000),
+                         self.repo.get_deletion_entities(2000, 2000)):
+            self.assertIsInstance(entities, sa.orm.Query)
+        entities = self.repo.get_first_notice_entities(2000)
+        self.assertEqual(1, entities.count())
+        self.assertEqual('stats', entities.first().instance_name)
+        self.assertEqual(0, entities.filter_by(project_id='other').count())
+        tags = set()
+        for (key, stats) in query_stats.get_stats().statements.items():
+            if 'FROM vmexpire' in key:
+                tags.update(stats.tags)
+        self.assertEqual(set(['VmExpireRepo.get_first_notice_entities']),
+                         tags)
+
+    def test_statements_do_not_dump(self):
+        stats = query_stats.get_stats()
+        stats.started -= 7200
+        with mock.patch.object(stats, 'dump') as dump:
+            self.repo.get_count('statsproject')
+        self.assertFalse(dump.called)
+        self.assertEqual(1, self.get_stats('SELECT count').count)
+
+    def test_dump_timer(self):
+        tg = mock.Mock()
+        query_stats.add_dump_timer(tg)
+        tg.add_timer.assert_called_once_with(
+            3600, query_stats.dump_stats, initial_delay=3600)
+        self.repo.get_count('statsproject')
+        callback = tg.add_timer.call_args[0][1]
+        with mock.patch.object(query_stats.LOG, 'info') as info:
+            callback()
+        self.assertIn('SELECT count', ' '.join(
+            call[0][1]['sql'] for call in info.call_args_list[1:]))
+        self.assertEqual({}, query_stats.get_stats().statements)
+
+    def test_no_dump_timer_without_aggregates(self):
+        config.CONF.set_override('query_stats_interval', 0, group='metrics')
+        tg = mock.Mock()
+        query_stats.add_dump_timer(tg)
+        self.assertFalse(tg.add_timer.called)
+        self.assertIsNone(query_stats.start_dump_thread())
+
+    def test_dump(self):
+        self.repo.get_count('statsproject')
+        self.repo.get_count('otherproject')
+        self.assertEqual(2, self.get_stats('SELECT count').count)
+        stats = query_stats.get_stats()
+        with mock.patch.object(query_stats.LOG, 'info') as info:
+            stats.dump()
+        self.assertIn('executions', info.call_args_list[0][0][0])
+        self.assertIn('SELECT count', ' '.join(
+            call[0][1]['sql'] for call in info.call_args_list[1:]))
+        self.assertEqual({}, stats.statements)
@@ -25,6 +25,7 @@ from oslo_config import cfg
 from oslo_utils import uuidutils
 import oslotest.base as oslotest
 from oslotest import createfile
+import requests
 
 import six
 from six.moves.urllib import parse
@@ -47,6 +48,22 @@ def mock_pecan_request(test_instance, host=None):
     mock_req.url = host
 
 
+def _requests_module_request(method, url, **kwargs):
+    return getattr(requests, method)(url, **kwargs)
+
+
+def mock_pooled_http(test_instance):
+    """Send the pooled HTTP requests through the requests functions.
+
+    Keystone and Nova are stubbed in tests by patching requests.get,
+    requests.post and requests.delete.
+    """
+    patcher_obj = mock.patch('os_vm_expire.common.http.request',
+                             side_effect=_requests_module_request)
+    patcher_obj.start()
+    test_instance.addCleanup(patcher_obj.stop)
+
+
 @contextmanager
 def pecan_context(test_instance, host=None):
     mock_pecan_request(test_instance, host=host)
@@ -70,6 +87,7 @@ class OsVMExpireAPIBaseTestCase(oslotest.BaseTestCase):
 
     def setUp(self):
         super(OsVMExpireAPIBaseTestCase, self).setUp()
+        mock_pooled_http(self)
         # Make sure we have a test db and session to work with
         database_utils.setup_in_memory_db()
 
@@ -0,0 +1,162 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Benchmark a cleaner pass against stub Nova, Keystone and SMTP servers.
+
+The stub servers of tools/cleaner_stub_servers.py run in a child process
+listening on localhost, the cleaner reaches them through its [cleaner]
+auth_uri, nova_url and [smtp] options as it would reach the real
+services. Each request or mail is answered after --latency seconds, the
+pass duration is measured for each requested number of VMs, cleaner
+engine and number of cleaner workers:
+
+    PYTHONPATH=. python tools/cleaner_benchmark.py --vms 1000 --workers 1 10 50
+    PYTHONPATH=. python tools/cleaner_benchmark.py --vms 1000 10000 50000 \
+        --engines eventlet asyncio --workers 50
+
+The asyncio engine needs Python 3.7 with aiohttp and aiosmtplib.
+"""
+from __future__ import print_function
+
+import argparse
+import datetime
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+
+from os_vm_expire.cmd import cleaner
+from os_vm_expire.common import config
+from os_vm_expire.common import keystone
+from os_vm_expire.model import models
+from os_vm_expire.model import repositories
+from oslo_db import options
+
+STUB_SERVERS = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'cleaner_stub_servers.py')
+
+
+def start_servers(latency):
+    """Start the stub servers process and point the cleaner to it.
+
+    :returns: the process and the url of its calls counter
+    """
+    process = subprocess.Popen(
+        [sys.executable, STUB_SERVERS, '--latency', str(latency)],
+        stdout=subprocess.PIPE)
+    http_port, smtp_port = [int(port) for port in
+                            process.stdout.readline().split()]
+    http_url = 'http://127.0.0.1:%d' % http_port
+    config.CONF.set_override('auth_uri', http_url + '/v3', group='cleaner')
+    config.CONF.set_override('nova_url', http_url + '/v2.1/%(tenant_id)s',
+                             group='cleaner')
+    config.CONF.set_override('email_smtp_host', '127.0.0.1', group='smtp')
+    config.CONF.set_override('email_smtp_port', smtp_port, group='smtp')
+    config.CONF.set_override('email_smtp_tls', False, group='smtp')
+    config.CONF.set_override('email_smtp_user', None, group='smtp')
+    return process, http_url + '/calls'
+
+
+def get_calls(calls_url):
+    return requests.get(calls_url).json()['calls']
+
+
+def setup_db(path):
+    options.set_defaults(config.CONF, connection='sqlite:///' + path)
+    repositories.hard_reset()
+    models.BASE.metadata.create_all(repositories._ENGINE)
+
+
+def populate(count):
+    """Create count VMs, a third of each in every cleaner stage."""
+    repo = repositories.get_vmexpire_repository()
+    repo.delete_all_entities()
+    repositories.commit()
+    now = int(time.mktime(datetime.datetime.now().timetuple()))
+    values = []
+    for i in range(count):
+        value = repositories.get_vmexpire_values('instance-%d' % i, {
+            'display_name': 'vm-%d' % i,
+            'tenant_id': 'project-%d' % (i % 10),
+            'user_id': 'user-%d' % (i % 50),
+        })
+        value.update({
+            'expire': now - 3600,
+            'notified': i % 3 > 0,
+            'notified_last': i % 3 > 1,
+            'notified_time': 1,
+        })
+        values.append(value)
+    repo.create_all(values)
+
+
+def run(count, engine, workers, calls_url):
+    populate(count)
+    calls = get_calls(calls_url)
+    # keystone token, users and projects must be fetched by each run
+    keystone.get_token_cache('cleaner').invalidate()
+    for name in ('user', 'project'):
+        keystone.get_metadata_cache(name).invalidate()
+    config.CONF.set_override('engine', engine, group='cleaner')
+    config.CONF.set_override('workers', workers, group='cleaner')
+    config.CONF.set_override('email_smtp_from', 'cleaner@localhost',
+                             group='smtp')
+    start = time.time()
+    cleaner.check(None)
+    duration = time.time() - start
+    repositories.clear()
+    return duration, get_calls(calls_url) - calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cleaner pass benchmark')
+    parser.add_argument('--vms', type=int, nargs='+', default=[300],
+                        help='numbers of expiring VMs to compare')
+    parser.add_argument('--engines', nargs='+', default=['eventlet'],
+                        choices=['eventlet', 'asyncio'],
+                        help='cleaner engines to compare')
+    parser.add_argument('--workers', type=int, nargs='+',
+                        default=[1, 5, 10, 20, 50],
+                        help='cleaner workers values to compare')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='latency in seconds of each remote call')
+    args = parser.parse_args()
+    if 'asyncio' in args.engines and not cleaner._asyncio_available():
+        parser.error('engine asyncio needs Python 3.7 or later, aiohttp '
+                     'and aiosmtplib')
+
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    process, calls_url = start_servers(args.latency)
+    try:
+        setup_db(path)
+        print('%8s %10s %8s %12s %12s' % (
+            'vms', 'engine', 'workers', 'calls', 'duration'))
+        for vms in args.vms:
+            for engine in args.engines:
+                for workers in args.workers:
+                    duration, calls = run(vms, engine, workers, calls_url)
+                    print('%8d %10s %8d %12d %11.2fs' % (
+                        vms, engine, workers, calls, duration))
+    finally:
+        process.terminate()
+        process.wait()
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
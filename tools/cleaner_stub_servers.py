@@ -0,0 +1,147 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Stub Keystone, Nova and SMTP servers of tools/cleaner_benchmark.py.
+
+Runs in its own process, out of the eventlet monkey patching of the
+cleaner. Prints the HTTP and SMTP ports, then answers each request or mail
+after --latency seconds until killed. GET /calls on the HTTP port returns
+the number of requests and mails answered so far.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import sys
+import threading
+import time
+
+from six.moves import BaseHTTPServer
+from six.moves import socketserver
+
+
+class StubServer(socketserver.ThreadingMixIn):
+    """Threaded server answering each request after a fixed latency."""
+
+    daemon_threads = True
+    latency = 0
+    # shared by the HTTP and SMTP servers
+    calls = 0
+    _lock = threading.Lock()
+
+    def wait(self):
+        with StubServer._lock:
+            StubServer.calls += 1
+        time.sleep(self.latency)
+
+
+class StubOpenStackHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Keystone authentication, users and projects, and Nova deletions."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def _reply(self, status, body=None, headers=None, wait=True):
+        if wait:
+            self.server.wait()
+        data = b''
+        if body is not None:
+            data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if body is not None:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if self.path.endswith('/auth/tokens'):
+            self._reply(201, {'token': {}}, {'X-Subject-Token': 'benchmark'})
+        else:
+            self._reply(404, {})
+
+    def do_GET(self):
+        if self.path == '/calls':
+            self._reply(200, {'calls': StubServer.calls}, wait=False)
+        elif '/users/' in self.path:
+            self._reply(200, {'user': {'email': 'user@localhost'}})
+        elif '/projects/' in self.path:
+            self._reply(200, {'project': {'name': 'benchmark',
+                                          'domain_id': 'default'}})
+        else:
+            self._reply(404, {})
+
+    def do_DELETE(self):
+        if '/servers/' in self.path:
+            self._reply(204)
+        else:
+            self._reply(404, {})
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubSMTPHandler(socketserver.StreamRequestHandler):
+    """SMTP dialog without extensions, accepting any message."""
+
+    def _reply(self, line):
+        self.wfile.write((line + '\r\n').encode('ascii'))
+
+    def handle(self):
+        self._reply('220 localhost stub SMTP')
+        for line in iter(self.rfile.readline, b''):
+            command = line.strip().upper()
+            if command == b'DATA':
+                self._reply('354 End data with <CR><LF>.<CR><LF>')
+                for data in iter(self.rfile.readline, b''):
+                    if data.rstrip(b'\r\n') == b'.':
+                        break
+                self.server.wait()
+                self._reply('250 OK')
+            elif command == b'QUIT':
+                self._reply('221 Bye')
+                return
+            else:
+                self._reply('250 OK')
+
+
+class StubHTTPServer(StubServer, BaseHTTPServer.HTTPServer):
+    pass
+
+
+class StubSMTPServer(StubServer, socketserver.TCPServer):
+    pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cleaner stub servers')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='latency in seconds of each remote call')
+    args = parser.parse_args()
+    StubServer.latency = args.latency
+
+    http_server = StubHTTPServer(('127.0.0.1', 0), StubOpenStackHandler)
+    smtp_server = StubSMTPServer(('127.0.0.1', 0), StubSMTPHandler)
+    thread = threading.Thread(target=smtp_server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    print(http_server.server_address[1], smtp_server.server_address[1])
+    sys.stdout.flush()
+    http_server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()